@@ -0,0 +1,54 @@
+import os
+import tempfile
+
+import pytest
+
+from kingfisher import eodata
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmpdir):
+    # the outputs are written into the working directory
+    cwd = os.getcwd()
+    tmpdir.chdir()
+    yield tmpdir
+    os.chdir(cwd)
+
+
+def test_get_ndvi(measure, eo_data):
+    safe, _ = eo_data
+    measure(eodata.get_ndvi, safe)
+
+
+def test_get_ndvi_from_zip(measure, eo_data):
+    _, archive = eo_data
+    measure(eodata.get_ndvi, archive)
+
+
+def test_get_bai(measure, eo_data):
+    safe, _ = eo_data
+    measure(eodata.get_bai, safe)
+
+
+def test_get_ndvi_threads(measure, eo_data):
+    safe, _ = eo_data
+    measure(eodata.get_ndvi, safe, threads=4)
+
+
+def test_merge(measure, index_tiles, tile_size):
+    measure(eodata.merge, index_tiles, megapixels=2 * tile_size ** 2 / 1e6)
+
+
+def extract(archive, directory):
+    # every round extracts into an empty directory
+    return eodata.extract(archive, tempfile.mkdtemp(dir=directory))
+
+
+def test_extract(measure, eo_data, workdir):
+    _, archive = eo_data
+    measure(extract, archive, str(workdir))
+
+
+def test_quicklook(measure, index_tiles):
+    cog = eodata.materialize(index_tiles[0])
+    measure(eodata.quicklook, cog, colorscheme='NDVI')
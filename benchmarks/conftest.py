@@ -0,0 +1,109 @@
+import multiprocessing
+import tracemalloc
+
+import pytest
+
+from kingfisher.testing import make_index, make_safe, zip_safe
+
+
+def pytest_addoption(parser):
+    parser.addoption('--tile-size', type=int, default=1098,
+                     help='edge length in pixel of the 10 m bands of the synthetic products (a real tile has 10980)')
+    parser.addoption('--bands', default='B04,B08',
+                     help='comma separated bands of the synthetic products')
+
+
+@pytest.fixture(scope='session')
+def tile_size(request):
+    return request.config.getoption('--tile-size')
+
+
+@pytest.fixture(scope='session')
+def eo_data(request, tmpdir_factory, tile_size):
+    """SAFE directory tree and zip archive of a synthetic product"""
+    directory = tmpdir_factory.mktemp('eo-data')
+    safe = make_safe(str(directory), size=tile_size, bands=request.config.getoption('--bands').split(','))
+    return safe, zip_safe(safe)
+
+
+@pytest.fixture(scope='session')
+def index_tiles(tmpdir_factory, tile_size):
+    """two neighbouring synthetic index rasters"""
+    directory = tmpdir_factory.mktemp('tiles')
+    return [make_index(str(directory.join('ndvi_{}.tif'.format(i))), size=tile_size, seed=i,
+                       origin=(600000 + i * tile_size * 10, 5000040)) for i in range(2)]
+
+
+def _status(key):
+    # sizes of /proc/self/status in MB
+    with open('/proc/self/status') as fp:
+        for line in fp:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) / 1024.
+
+
+def _run_child(queue, func, args, kwargs):
+    try:
+        # resets the high water mark of the resident size to the current size
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        start = _status('VmRSS')
+        func(*args, **kwargs)
+        queue.put((_status('VmHWM') - start, None))
+    except Exception as ex:
+        queue.put((None, repr(ex)))
+
+
+def peak_rss(func, *args, **kwargs):
+    """
+    returns the growth of the resident size of a process running a function, in MB.
+    The function runs in a fresh interpreter, so caches filled by earlier benchmarks (e.g. GDAL's block cache)
+    do not count, and the function and its arguments must be picklable. Unlike tracemalloc, the resident size
+    covers the allocations of GDAL and numpy in C. Returns None where the resident size cannot be read
+    (no /proc file system, e.g. on macOS).
+    """
+    try:
+        _status('VmHWM')
+    except (IOError, OSError):
+        return None
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_child, args=(queue, func, args, kwargs))
+    process.start()
+    try:
+        delta, error = queue.get()
+    finally:
+        process.join()
+    if error is not None:
+        raise RuntimeError('failed to measure the resident size: {}'.format(error))
+    return delta
+
+
+@pytest.fixture
+def measure(benchmark, tile_size):
+    """
+    runs a function once in a fresh interpreter for its peak resident size, once under tracemalloc for its
+    peak python memory, then benchmarks it. Stored as extra info of the benchmark:
+
+    * ``peak_rss_mb``: growth of the resident size of the interpreter while it runs the function, including
+      GDAL's block cache and other C allocations, see :func:`peak_rss`
+    * ``python_peak_mb``: peak of the memory allocated through python (numpy arrays included), without
+      GDAL's allocations
+    * ``megapixels`` and ``megapixels_per_s``: throughput
+    """
+    def run(func, *args, **kwargs):
+        megapixels = kwargs.pop('megapixels', tile_size ** 2 / 1e6)
+        rss = peak_rss(func, *args, **kwargs)
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result = benchmark.pedantic(func, args=args, kwargs=kwargs, rounds=3, iterations=1)
+        benchmark.extra_info['peak_rss_mb'] = round(rss, 1) if rss is not None else None
+        benchmark.extra_info['python_peak_mb'] = round(peak / 1024. ** 2, 1)
+        benchmark.extra_info['megapixels'] = megapixels
+        benchmark.extra_info['megapixels_per_s'] = round(megapixels / benchmark.stats.stats.mean, 2)
+        return result
+    return run
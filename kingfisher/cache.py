@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+
+"""
+Caches of the scihub queries and of the products in the ``eo-data`` directory.
+
+The same areas and periods are queried over and over, and each OpenSearch round trip takes seconds.
+Query results are stored in a SQLite database, so all WPS workers share them, and expire after a time to live.
+The number of cached queries is bounded, the least recently used queries are dropped first.
+
+The products are kept within a byte budget. When it is exceeded, the least recently used extracted
+SAFE directories are removed first, then zip archives and last derived products. Products used by a
+running job are pinned in the catalog and never removed.
+
+Derived products are cached under a key of everything their content depends on: product, index,
+kernel version, bounding box, resolution, output format and compression. Identical requests link the
+cached file into their working directory instead of computing it again.
+
+Example usage::
+
+    from kingfisher.cache import QueryCache
+    cache = QueryCache(join(Paths(kingfisher).cache, 'queries.sqlite'), ttl=3600)
+    products = cache.query(api, footprint, date=(start, end), platformname='Sentinel-2',
+                           cloudcoverpercentage=(0, cloud_cover))
+
+    from kingfisher.cache import CacheManager
+    manager = CacheManager(catalog, budget=50 * 1024 ** 3, lockfile=join(DIR_EO, 'cache.lock'))
+    owner = manager.pin(product_ids)
+    ...
+    manager.unpin(owner)
+    manager.evict()
+
+    from kingfisher.cache import DerivedCache
+    derived = DerivedCache(join(DIR_EO, 'derived'), catalog=catalog)
+    tile = derived.get(product_id, 'NDVI', bbox=bbox)
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date
+from datetime import datetime as dt
+from os import makedirs
+from os.path import abspath, dirname, exists, getsize, isdir, join
+from tempfile import mkstemp
+
+from kingfisher.catalog import TIME_FORMAT
+from kingfisher.indices import INDICES, get_index
+from kingfisher.stats import sidecar_path
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    key TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    result BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queries_accessed ON queries (accessed);
+"""
+
+DERIVED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    product_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    created REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters VALUES ('hits', 0);
+INSERT OR IGNORE INTO counters VALUES ('misses', 0);
+"""
+
+# pins of jobs on other hosts expire after this time in seconds, local pins with their process
+PIN_TIMEOUT = 24 * 3600
+
+# artifacts are evicted tier by tier, least recently used first within a tier
+TIERS = ['safe', 'zip', 'derived']
+
+
+def _normalize(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def normalize_footprint(wkt, precision=6):
+    """
+    returns a canonical form of a WKT footprint, so equal areas written differently share a cache entry
+
+    :param wkt: footprint as well-known text
+    :param precision: number of decimals the coordinates are rounded to
+
+    :return str: geometry type followed by the rounded coordinates
+    """
+    geometry = wkt.strip().split('(', 1)[0].strip().upper()
+    coordinates = [round(float(value), precision)
+                   for value in re.findall(r'-?\d+(?:\.\d+)?(?:[eE]-?\d+)?', wkt)]
+    return '{} {}'.format(geometry, ' '.join(repr(c) for c in coordinates))
+
+
+def query_key(footprint, **kwargs):
+    """
+    returns the cache key of a query
+
+    :param footprint: area of the query as well-known text
+    :param kwargs: further query parameters (e.g. date, platformname, cloudcoverpercentage)
+
+    :return str: sha1 hex digest of the normalized query
+    """
+    query = dict((key, _normalize(value)) for key, value in kwargs.items())
+    query['footprint'] = normalize_footprint(footprint)
+    return hashlib.sha1(json.dumps(query, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class QueryCache(object):
+    """Query results shared by all workers, expiring after ``ttl`` seconds."""
+
+    def __init__(self, filename, ttl=3600, max_entries=256):
+        """
+        :param filename: path of the SQLite database, created if it does not exist
+        :param ttl: time to live of a cached result in seconds, 0 disables the cache
+        :param max_entries: maximum number of cached queries
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        if dirname(filename) and not exists(dirname(filename)):
+            makedirs(dirname(filename))
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        """
+        opens a connection committing on success and rolling back on errors
+        """
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """
+        returns a cached result
+
+        :param key: cache key of the query
+
+        :return: result of the query, None if it is not cached or expired
+        """
+        now = time.time()
+        with self.connect() as conn:
+            row = conn.execute('SELECT result FROM queries WHERE key = ? AND created > ?',
+                               (key, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE queries SET accessed = ? WHERE key = ?', (now, key))
+        return pickle.loads(bytes(row[0]))
+
+    def put(self, key, result):
+        """
+        caches the result of a query and drops expired and least recently used results
+
+        :param key: cache key of the query
+        :param result: result of the query
+        """
+        now = time.time()
+        blob = sqlite3.Binary(pickle.dumps(result, protocol=2))
+        with self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)', (key, now, now, blob))
+            conn.execute('DELETE FROM queries WHERE created <= ?', (now - self.ttl,))
+            conn.execute('DELETE FROM queries WHERE key NOT IN '
+                         '(SELECT key FROM queries ORDER BY accessed DESC LIMIT ?)', (self.max_entries,))
+
+    def query(self, api, footprint, **kwargs):
+        """
+        answers a query from the cache or from the scihub
+
+        :param api: ``SentinelAPI`` instance used on cache misses
+        :param footprint: area of the query as well-known text
+        :param kwargs: further parameters of ``SentinelAPI.query``
+
+        :return OrderedDict: products found
+        """
+        if self.ttl <= 0:
+            return api.query(footprint, **kwargs)
+        key = query_key(footprint, **kwargs)
+        products = self.get(key)
+        if products is not None:
+            LOGGER.info('query cache hit: {} products of query {}'.format(len(products), key))
+            return products
+        LOGGER.info('query cache miss: querying the scihub for query {}'.format(key))
+        products = api.query(footprint, **kwargs)
+        self.put(key, products)
+        return products
+
+
+def disk_usage(path):
+    """
+    returns the size of a file or directory tree in bytes, 0 if it does not exist
+
+    :param path: path of a file or directory
+    """
+    if not exists(path):
+        return 0
+    if not isdir(path):
+        return getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += getsize(join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def _alive(pin):
+    if pin['host'] != socket.gethostname():
+        created = dt.strptime(pin['created'], TIME_FORMAT)
+        return (dt.now() - created).total_seconds() < PIN_TIMEOUT
+    try:
+        os.kill(pin['pid'], 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+
+class CacheManager(object):
+    """Keeps the products of the catalog within a byte budget by evicting the least recently used."""
+
+    def __init__(self, catalog, budget, lockfile):
+        """
+        :param catalog: ``Catalog`` of the cached products
+        :param budget: maximum size of the cached products in bytes, 0 for no limit
+        :param lockfile: file locked while pins are taken or products are evicted
+        """
+        self.catalog = catalog
+        self.budget = budget
+        self.lockfile = lockfile
+
+    @contextmanager
+    def lock(self):
+        """
+        locks the cache for all workers, also across hosts sharing the cache over NFS
+        """
+        with open(self.lockfile, 'a') as fp:
+            fcntl.lockf(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(fp, fcntl.LOCK_UN)
+
+    def pin(self, product_ids):
+        """
+        pins products until ``unpin`` is called or the process ends
+
+        :param product_ids: identifiers of the products used by a job
+
+        :return str: owner of the pins
+        """
+        owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        with self.lock():
+            self.catalog.pin(owner, product_ids, host=socket.gethostname(), pid=os.getpid())
+        return owner
+
+    def unpin(self, owner):
+        """
+        releases the pins of a job
+
+        :param owner: owner returned by ``pin``
+        """
+        self.catalog.unpin(owner)
+
+    def artifacts(self):
+        """
+        returns the cached artifacts in eviction order
+
+        :return list: dicts with tier, product_id, path, size and accessed
+        """
+        products = dict((product['id'], product) for product in self.catalog.query())
+        artifacts = []
+        for product in products.values():
+            accessed = product['accessed'] or product['updated'] or ''
+            for tier, path in (('safe', product['safe_path']), ('zip', product['zip_path'])):
+                if path:
+                    artifacts.append({'tier': tier, 'product_id': product['id'], 'path': path,
+                                      'size': disk_usage(path), 'accessed': accessed})
+        for derived in self.catalog.derived():
+            product = products.get(derived['product_id'], {})
+            artifacts.append({'tier': 'derived', 'product_id': derived['product_id'], 'path': derived['path'],
+                              'size': disk_usage(derived['path']),
+                              'accessed': product.get('accessed') or derived['created'] or ''})
+        artifacts.sort(key=lambda a: (TIERS.index(a['tier']), a['accessed']))
+        return artifacts
+
+    def evict(self, reserve=0):
+        """
+        removes the least recently used artifacts of unpinned products until the cache fits the budget
+
+        :param reserve: bytes to be freed in addition, e.g. for products about to be downloaded
+
+        :return list: paths of the removed artifacts
+        """
+        removed = []
+        if not self.budget:
+            return removed
+        with self.lock():
+            pinned = set()
+            for pin in self.catalog.pins():
+                if _alive(pin):
+                    pinned.add(pin['product_id'])
+                else:
+                    LOGGER.debug('releasing stale pin of {} on {}'.format(pin['owner'], pin['product_id']))
+                    self.catalog.unpin(pin['owner'])
+
+            artifacts = self.artifacts()
+            usage = sum(a['size'] for a in artifacts)
+            for artifact in artifacts:
+                if usage + reserve <= self.budget:
+                    break
+                if artifact['product_id'] in pinned:
+                    continue
+                path = artifact['path']
+                if isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif exists(path):
+                    os.remove(path)
+                if artifact['tier'] == 'derived':
+                    if exists(sidecar_path(path)):
+                        os.remove(sidecar_path(path))
+                    self.catalog.remove_derived(artifact['product_id'], path)
+                else:
+                    self.catalog.remove_path(artifact['product_id'], artifact['tier'] + '_path')
+                usage -= artifact['size']
+                removed.append(path)
+        if removed:
+            LOGGER.info('evicted {} artifacts from the cache, {:.0f} MB in use'.format(
+                len(removed), usage / 1024. ** 2))
+        return removed
+
+
+def derived_key(product_id, name, bbox=None, resolution=None, output_format='COG', compress='DEFLATE',
+                cloud_mask=True, **kwargs):
+    """
+    returns the cache key of a derived product.
+    Options not changing the content (e.g. window_size, threads) are ignored.
+
+    :param product_id: identifier of the source product
+    :param name: name of the index
+    :param bbox: bounding box the index is clipped to
+    :param resolution: resolution of the output grid
+    :param output_format: output format of the index file
+    :param compress: compression of the index file
+    :param cloud_mask: whether clouds are masked in the index file
+
+    :return str: sha1 hex digest
+    """
+    key = {'product': product_id, 'index': name, 'version': get_index(name).version,
+           'bbox': [round(float(v), 6) for v in bbox] if bbox is not None else None,
+           'resolution': resolution, 'format': output_format, 'compress': compress,
+           'cloud_mask': bool(cloud_mask)}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _link(source, target):
+    # hard links cost neither time nor space, copies are made across file systems
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class DerivedCache(object):
+    """
+    Content-addressed cache of index files with hit statistics.
+    The statistics sidecars of the files (see :mod:`kingfisher.stats`) are cached along.
+    ``stats()`` returns the counters of all workers, ``hits`` and ``misses`` count the requests of this instance.
+    """
+
+    def __init__(self, directory, catalog=None):
+        """
+        :param directory: directory of the cached files, created if it does not exist
+        :param catalog: ``Catalog`` the cached files are recorded in, so they are subject to eviction
+        """
+        self.directory = directory
+        self.catalog = catalog
+        self.hits = 0
+        self.misses = 0
+        if not exists(directory):
+            try:
+                makedirs(directory)
+            except OSError:
+                # created by another worker in the meantime
+                pass
+        self.filename = join(directory, 'derived.sqlite')
+        with self.connect() as conn:
+            conn.executescript(DERIVED_SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        """
+        opens a connection committing on success and rolling back on errors
+        """
+        conn = sqlite3.connect(self.filename, timeout=60)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def path(self, key):
+        """
+        returns the path of a cached file
+
+        :param key: cache key of the derived product
+        """
+        return join(self.directory, key[:2], '{}.tif'.format(key))
+
+    def _count(self, conn, counter):
+        conn.execute('UPDATE counters SET value = value + 1 WHERE name = ?', (counter,))
+        setattr(self, counter, getattr(self, counter) + 1)
+
+    def contains(self, product_id, name, **options):
+        """
+        checks if an index is cached, without counting a hit or miss
+
+        :param product_id: identifier of the source product
+        :param name: name of the index
+        :param options: options of :func:`kingfisher.eodata.get_indices`
+        """
+        with self.connect() as conn:
+            row = conn.execute('SELECT path FROM entries WHERE key = ?',
+                               (derived_key(product_id, name, **options),)).fetchone()
+        return row is not None and exists(row['path'])
+
+    def get(self, product_id, name, directory='.', **options):
+        """
+        links a cached index file and its statistics sidecar into a directory
+
+        :param product_id: identifier of the source product
+        :param name: name of the index
+        :param directory: directory the file is linked into (default: working directory)
+        :param options: options of :func:`kingfisher.eodata.get_indices`
+
+        :return str: path of the linked file, None if the index is not cached
+        """
+        key = derived_key(product_id, name, **options)
+        with self.connect() as conn:
+            row = conn.execute('SELECT path FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None and not exists(row['path']):
+                # evicted in the meantime
+                conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                row = None
+            if row is None:
+                self._count(conn, 'misses')
+                return None
+            _, target = mkstemp(dir=directory, prefix='{}_{}_'.format(product_id, name), suffix='.tif')
+            os.remove(target)
+            try:
+                _link(row['path'], target)
+                if exists(sidecar_path(row['path'])):
+                    _link(sidecar_path(row['path']), sidecar_path(target))
+            except (IOError, OSError):
+                LOGGER.debug('cached {} of {} vanished'.format(name, product_id))
+                conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self._count(conn, 'misses')
+                return None
+            self._count(conn, 'hits')
+            conn.execute('UPDATE entries SET hits = hits + 1 WHERE key = ?', (key,))
+        LOGGER.debug('{} of {} taken from the derived cache'.format(name, product_id))
+        return target
+
+    def put(self, product_id, name, tile, **options):
+        """
+        caches an index file and its statistics sidecar
+
+        :param product_id: identifier of the source product
+        :param name: name of the index
+        :param tile: path of the index file
+        :param options: options of :func:`kingfisher.eodata.get_indices` the file was computed with
+
+        :return str: path of the cached file
+        """
+        key = derived_key(product_id, name, **options)
+        path = self.path(key)
+        if not exists(dirname(path)):
+            try:
+                makedirs(dirname(path))
+            except OSError:
+                pass
+        # the files are renamed into place, readers never see them half written
+        if exists(sidecar_path(tile)):
+            # the sidecar first, so a cached file always has its sidecar
+            part = '{}.{}.part'.format(sidecar_path(path), uuid.uuid4().hex)
+            _link(sidecar_path(tile), part)
+            os.rename(part, sidecar_path(path))
+        elif exists(sidecar_path(path)):
+            os.remove(sidecar_path(path))
+        part = '{}.{}.part'.format(path, uuid.uuid4().hex)
+        _link(tile, part)
+        os.rename(part, path)
+        with self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO entries (key, product_id, name, version, path, created) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (key, product_id, name, get_index(name).version, abspath(path), time.time()))
+        if self.catalog is not None:
+            self.catalog.add_derived(product_id, name, abspath(path))
+        return path
+
+    def purge(self):
+        """
+        removes the cached files of outdated kernel versions
+
+        :return int: number of removed files
+        """
+        removed = []
+        with self.connect() as conn:
+            for index in INDICES.values():
+                rows = conn.execute('SELECT key, product_id, path FROM entries WHERE name = ? AND version != ?',
+                                    (index.name, index.version)).fetchall()
+                for row in rows:
+                    for path in (row['path'], sidecar_path(row['path'])):
+                        if exists(path):
+                            os.remove(path)
+                    conn.execute('DELETE FROM entries WHERE key = ?', (row['key'],))
+                    removed.append((row['product_id'], row['path']))
+        if self.catalog is not None:
+            for product_id, path in removed:
+                self.catalog.remove_derived(product_id, path)
+        if removed:
+            LOGGER.info('{} derived products of outdated index versions removed'.format(len(removed)))
+        return len(removed)
+
+    def stats(self):
+        """
+        returns the statistics of the cache
+
+        :return dict: hits, misses, hit_rate and number of entries
+        """
+        with self.connect() as conn:
+            counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+            entries = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        requests = counters['hits'] + counters['misses']
+        return {'hits': counters['hits'], 'misses': counters['misses'], 'entries': entries,
+                'hit_rate': float(counters['hits']) / requests if requests else 0.}
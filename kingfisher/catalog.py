@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local catalog of the Earth-Observation products in the ``eo-data`` cache.
+
+The catalog is a SQLite database next to the products. It records the metadata of every
+fetched product (footprint, sensing time, cloud cover, size) and the local paths of its
+zip archive, SAFE directory and derived products. An R-tree on the footprints and an index on
+the sensing time answer area and time queries without touching the file system.
+
+Example usage::
+
+    from kingfisher.catalog import Catalog
+    catalog = Catalog(join(DIR_EO, 'catalog.sqlite'))
+    catalog.add_from_query(key, products[key], zip_path=file_zip)
+    catalog.query(bbox=(14, 8, 15, 9), start=start, end=end)
+"""
+
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime as dt
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT UNIQUE NOT NULL,
+    uuid TEXT,
+    footprint TEXT,
+    sensing_time TEXT,
+    cloud_cover REAL,
+    size INTEGER,
+    zip_path TEXT,
+    safe_path TEXT,
+    updated TEXT,
+    accessed TEXT
+);
+CREATE INDEX IF NOT EXISTS products_sensing_time ON products (sensing_time);
+CREATE VIRTUAL TABLE IF NOT EXISTS products_rtree USING rtree (rowid, min_x, max_x, min_y, max_y);
+CREATE TABLE IF NOT EXISTS derived (
+    product_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    created TEXT,
+    PRIMARY KEY (product_id, name, path)
+);
+CREATE TABLE IF NOT EXISTS pins (
+    owner TEXT NOT NULL,
+    product_id TEXT NOT NULL,
+    host TEXT,
+    pid INTEGER,
+    created TEXT,
+    PRIMARY KEY (owner, product_id)
+);
+"""
+
+PRODUCT_FIELDS = ['id', 'uuid', 'footprint', 'sensing_time', 'cloud_cover', 'size', 'zip_path', 'safe_path', 'updated',
+                  'accessed']
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+
+def footprint_bounds(wkt):
+    """
+    returns the bounds of a WKT footprint (POLYGON or MULTIPOLYGON)
+
+    :param wkt: footprint as well-known text
+
+    :return tuple: min_x, min_y, max_x, max_y
+    """
+    values = [float(value) for value in re.findall(r'-?\d+(?:\.\d+)?(?:[eE]-?\d+)?', wkt)]
+    if len(values) < 2:
+        raise ValueError('no coordinates found in footprint {}'.format(wkt))
+    xs, ys = values[0::2], values[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def parse_size(size):
+    """
+    converts a size given by the scihub (e.g. '791.49 MB') or in the configuration (e.g. '50gb') into bytes
+
+    :param size: size string or number of bytes
+
+    :return int: size in bytes
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$', size, re.IGNORECASE)
+    if match is None:
+        raise ValueError('invalid size: {}'.format(size))
+    value, unit = match.groups()
+    return int(float(value) * UNITS[unit.upper() + 'B'])
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, str):
+        return value
+    return value.strftime(TIME_FORMAT)
+
+
+class Catalog(object):
+    """SQLite catalog with R-tree and time index of the products in the eo-data cache."""
+
+    def __init__(self, filename):
+        """
+        :param filename: path of the SQLite database, created if it does not exist
+        """
+        self.filename = filename
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        """
+        opens a connection committing on success and rolling back on errors.
+        Connections are short-lived, so several WPS workers can share the catalog.
+        """
+        conn = sqlite3.connect(self.filename, timeout=60)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def add_product(self, product_id, **fields):
+        """
+        adds a product or updates the given fields of a known product
+
+        :param product_id: product identifier (e.g. S2A_MSIL1C_20180101T101021_N0206_R022_T32TQM_20180101T122129)
+        :param fields: values of the fields in ``PRODUCT_FIELDS``, fields set to None are not updated
+        """
+        unknown = set(fields) - set(PRODUCT_FIELDS)
+        if unknown:
+            raise ValueError('unknown fields: {}'.format(', '.join(sorted(unknown))))
+        fields = dict((key, value) for key, value in fields.items() if value is not None)
+        if 'sensing_time' in fields:
+            fields['sensing_time'] = _timestamp(fields['sensing_time'])
+        if 'accessed' in fields:
+            fields['accessed'] = _timestamp(fields['accessed'])
+        fields['updated'] = _timestamp(dt.now())
+
+        with self.connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO products (id, accessed) VALUES (?, ?)', (product_id, fields['updated']))
+            assignments = ', '.join('{} = ?'.format(key) for key in fields)
+            conn.execute('UPDATE products SET {} WHERE id = ?'.format(assignments),
+                         list(fields.values()) + [product_id])
+            if 'footprint' in fields:
+                rowid = conn.execute('SELECT rowid FROM products WHERE id = ?', (product_id,)).fetchone()[0]
+                min_x, min_y, max_x, max_y = footprint_bounds(fields['footprint'])
+                conn.execute('INSERT OR REPLACE INTO products_rtree VALUES (?, ?, ?, ?, ?)',
+                             (rowid, min_x, max_x, min_y, max_y))
+
+    def add_from_query(self, uuid, properties, **fields):
+        """
+        adds a product found by a scihub query (``SentinelAPI.query``)
+
+        :param uuid: scihub key of the product
+        :param properties: metadata of the product as returned by the query
+        :param fields: further fields, e.g. zip_path
+        """
+        self.add_product(str(properties['identifier']),
+                         uuid=uuid,
+                         footprint=properties.get('footprint'),
+                         sensing_time=properties.get('beginposition'),
+                         cloud_cover=properties.get('cloudcoverpercentage'),
+                         size=parse_size(properties['size']) if 'size' in properties else None,
+                         **fields)
+
+    def add_derived(self, product_id, name, path):
+        """
+        records a product derived from a cached product (e.g. an index file)
+
+        :param product_id: identifier of the source product
+        :param name: name of the derived product (e.g. 'NDVI')
+        :param path: local path of the derived product
+        """
+        with self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO derived VALUES (?, ?, ?, ?)',
+                         (product_id, name, path, _timestamp(dt.now())))
+
+    def remove_derived(self, product_id, path):
+        """
+        forgets a derived product
+
+        :param product_id: identifier of the source product
+        :param path: local path of the derived product
+        """
+        with self.connect() as conn:
+            conn.execute('DELETE FROM derived WHERE product_id = ? AND path = ?', (product_id, path))
+
+    def remove_path(self, product_id, field):
+        """
+        forgets a local copy of a product, e.g. after it was evicted
+
+        :param product_id: product identifier
+        :param field: 'zip_path' or 'safe_path'
+        """
+        if field not in ('zip_path', 'safe_path'):
+            raise ValueError('unknown path field: {}'.format(field))
+        with self.connect() as conn:
+            conn.execute('UPDATE products SET {} = NULL WHERE id = ?'.format(field), (product_id,))
+
+    def pin(self, owner, product_ids, host=None, pid=None):
+        """
+        pins products used by a job and records the access
+
+        :param owner: unique name of the job holding the pins
+        :param product_ids: identifiers of the products
+        :param host: host name of the job
+        :param pid: process id of the job
+        """
+        now = _timestamp(dt.now())
+        with self.connect() as conn:
+            for product_id in product_ids:
+                conn.execute('INSERT OR IGNORE INTO products (id, accessed) VALUES (?, ?)', (product_id, now))
+                conn.execute('UPDATE products SET accessed = ? WHERE id = ?', (now, product_id))
+                conn.execute('INSERT OR REPLACE INTO pins VALUES (?, ?, ?, ?, ?)', (owner, product_id, host, pid, now))
+
+    def unpin(self, owner):
+        """
+        releases all pins of a job
+
+        :param owner: name of the job holding the pins
+        """
+        with self.connect() as conn:
+            conn.execute('DELETE FROM pins WHERE owner = ?', (owner,))
+
+    def pins(self):
+        """
+        returns the pins of all jobs
+
+        :return list: dicts with owner, product_id, host, pid and created
+        """
+        with self.connect() as conn:
+            rows = conn.execute('SELECT * FROM pins').fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, product_id):
+        """
+        returns the record of a product
+
+        :param product_id: product identifier
+
+        :return dict: fields of the product, None if the product is not in the catalog
+        """
+        with self.connect() as conn:
+            row = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def derived(self, product_id=None):
+        """
+        returns the derived products of a product
+
+        :param product_id: product identifier, None for the derived products of all products
+
+        :return list: dicts with product_id, name, path and creation time of the derived products
+        """
+        sql = 'SELECT product_id, name, path, created FROM derived'
+        args = []
+        if product_id is not None:
+            sql += ' WHERE product_id = ?'
+            args.append(product_id)
+        with self.connect() as conn:
+            rows = conn.execute(sql + ' ORDER BY created', args).fetchall()
+        return [dict(row) for row in rows]
+
+    def query(self, bbox=None, start=None, end=None, max_cloud_cover=None):
+        """
+        finds the cached products intersecting an area and period
+
+        :param bbox: bounding box (min_lon, min_lat, max_lon, max_lat); None for any area
+        :param start: datetime of the beginning of the period; None for no lower limit
+        :param end: datetime of the end of the period; None for no upper limit
+        :param max_cloud_cover: maximum cloud cover percentage; None for any cloud cover
+
+        :return list: dicts with the fields of the products, ordered by sensing time
+        """
+        sql = 'SELECT p.* FROM products p'
+        where = []
+        args = []
+        if bbox is not None:
+            # the R-tree holds the bounding boxes of the footprints
+            sql += ' JOIN products_rtree r ON r.rowid = p.rowid'
+            where.append('r.max_x >= ? AND r.min_x <= ? AND r.max_y >= ? AND r.min_y <= ?')
+            args.extend([min(bbox[0], bbox[2]), max(bbox[0], bbox[2]), min(bbox[1], bbox[3]), max(bbox[1], bbox[3])])
+        if start is not None:
+            where.append('p.sensing_time >= ?')
+            args.append(_timestamp(start))
+        if end is not None:
+            where.append('p.sensing_time <= ?')
+            args.append(_timestamp(end))
+        if max_cloud_cover is not None:
+            where.append('p.cloud_cover <= ?')
+            args.append(max_cloud_cover)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY p.sensing_time'
+
+        with self.connect() as conn:
+            rows = conn.execute(sql, args).fetchall()
+        return [dict(row) for row in rows]
+
+    def inventory(self):
+        """
+        returns a summary of the cached products
+
+        :return dict: number of products, zip archives, extracted products and derived products,
+                      and the size of the zip archives in bytes
+        """
+        with self.connect() as conn:
+            row = conn.execute('SELECT COUNT(*), COUNT(zip_path), COUNT(safe_path), '
+                               'COALESCE(SUM(CASE WHEN zip_path IS NOT NULL THEN size END), 0) '
+                               'FROM products').fetchone()
+            derived = conn.execute('SELECT COUNT(*) FROM derived').fetchone()[0]
+        return {'products': row[0], 'zips': row[1], 'extracted': row[2], 'derived': derived, 'size': row[3]}
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+"""
+Access to the ``[kingfisher]`` section of the PyWPS configuration.
+
+Example usage::
+
+    from kingfisher.config import get_option
+    window_size = get_option('window_size', 1024, int)
+"""
+
+from pywps.configuration import get_config_value
+
+SECTION = 'kingfisher'
+
+
+def get_option(option, default=None, convert=None):
+    """
+    returns an option of the ``[kingfisher]`` configuration section
+
+    :param option: name of the option
+    :param default: value returned if the option is not configured
+    :param convert: optional callable to convert the configured string value (e.g. ``int``)
+
+    :return: configured value or default
+    """
+    value = get_config_value(SECTION, option)
+    if value is None or value == '':
+        return default
+    if convert is not None and not isinstance(value, bool):
+        value = convert(value)
+    return value
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+Concurrent and resumable download of Sentinel products from the scihub.
+
+Products are streamed into ``<identifier>.zip.part`` files which are renamed to ``<identifier>.zip``
+once complete. An interrupted download resumes from the end of its ``.part`` file with an HTTP range
+request. The checksum published by the scihub is computed on the chunks while they are written.
+A lock file per product makes workers wait for a download already running elsewhere.
+
+Example usage::
+
+    from kingfisher.download import DownloadManager
+    manager = DownloadManager(api, DIR_EO, workers=4, progress=lambda done, total: ...)
+    downloaded, failed = manager.download_all(products.keys())
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from os import remove, rename
+from os.path import exists, getsize, join
+
+from kingfisher.locks import FileLock
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+CHUNK_SIZE = 1024 * 1024
+
+# checksum algorithms published by the scihub, in order of preference. The first one hashlib supports is used.
+CHECKSUMS = ['sha3-256', 'md5']
+
+
+def _checksum(info):
+    for name in CHECKSUMS:
+        # sha3-256 is missing in hashlib of python 2.7, md5 is always there
+        if info.get(name) and name.replace('-', '_') in hashlib.algorithms_available:
+            return name, info[name]
+    return None, None
+
+
+def _new_hash(name):
+    if name is None:
+        return None
+    return hashlib.new(name.replace('-', '_'))
+
+
+class DownloadManager(object):
+    """Downloads products on a bounded pool of threads and reports the aggregate progress."""
+
+    def __init__(self, api, directory, workers=2, progress=None, chunk_size=CHUNK_SIZE, total=0):
+        """
+        :param api: authenticated ``SentinelAPI`` instance
+        :param directory: directory the products are downloaded into
+        :param workers: number of concurrent downloads
+        :param progress: callable ``progress(done, total)`` called with the downloaded and total bytes
+                         of all products whenever another percent is done
+        :param chunk_size: size of the streamed chunks in bytes
+        :param total: expected bytes of the products passed one by one to ``download``,
+                      ``download_all`` adds the sizes of its products itself
+        """
+        self.api = api
+        self.directory = directory
+        self.workers = max(1, workers)
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.done = 0
+        self.total = total
+        self._reported = -1
+        self._lock = threading.Lock()
+
+    def path(self, info):
+        """
+        returns the local path of a product
+
+        :param info: OData metadata of the product (``SentinelAPI.get_product_odata``)
+        """
+        return join(self.directory, '{}.zip'.format(info['title']))
+
+    def _update(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+            percent = 100 * self.done // self.total if self.total else 100
+            if percent == self._reported:
+                return
+            self._reported = percent
+            done, total = self.done, self.total
+        if self.progress is not None:
+            self.progress(done, total)
+
+    def download(self, info):
+        """
+        downloads a product, resuming a partial download
+
+        :param info: OData metadata of the product (``SentinelAPI.get_product_odata``)
+
+        :return str: path of the downloaded zip archive
+        """
+        target = self.path(info)
+        if exists(target):
+            self._update(info['size'])
+            return target
+        # a concurrent download of the same product by another worker is waited for
+        with FileLock(target + '.lock'):
+            if exists(target):
+                LOGGER.debug('{} downloaded by another worker'.format(info['title']))
+                self._update(info['size'])
+                return target
+            return self._download(info, target)
+
+    def _download(self, info, target):
+        part = target + '.part'
+        algorithm, expected = _checksum(info)
+        checksum = _new_hash(algorithm)
+
+        offset = getsize(part) if exists(part) else 0
+        if offset > info['size']:
+            remove(part)
+            offset = 0
+        if offset and checksum is not None:
+            # the hash of a resumed download starts with the bytes already on disk
+            with open(part, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(self.chunk_size), b''):
+                    checksum.update(chunk)
+        self._update(offset)
+
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        response = self.api.session.get(info['url'], headers=headers, stream=True)
+        try:
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                LOGGER.debug('server ignored the range request, restarting {}'.format(info['title']))
+                self._update(-offset)
+                offset = 0
+                checksum = _new_hash(algorithm)
+            elif offset:
+                LOGGER.debug('resuming {} at byte {}'.format(info['title'], offset))
+            with open(part, 'ab' if offset else 'wb') as fp:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    fp.write(chunk)
+                    if checksum is not None:
+                        checksum.update(chunk)
+                    self._update(len(chunk))
+        finally:
+            response.close()
+
+        size = getsize(part)
+        if size != info['size']:
+            # keep the partial file, the next attempt resumes it
+            raise IOError('incomplete download of {}: {} of {} bytes'.format(info['title'], size, info['size']))
+        if checksum is not None and checksum.hexdigest().lower() != expected.lower():
+            remove(part)
+            raise IOError('{} checksum of {} does not match'.format(algorithm, info['title']))
+        rename(part, target)
+        LOGGER.info('{} downloaded'.format(info['title']))
+        return target
+
+    def _info(self, uuid):
+        try:
+            return uuid, self.api.get_product_odata(uuid), None
+        except Exception as ex:
+            LOGGER.exception('failed to get the metadata of {}'.format(uuid))
+            return uuid, None, 'failed to get the metadata of {}: {}'.format(uuid, ex)
+
+    def _fetch(self, info):
+        try:
+            return info['id'], self.download(info), None
+        except Exception as ex:
+            LOGGER.exception('failed to download {}'.format(info['title']))
+            return info['id'], None, 'failed to download {}: {}'.format(info['title'], ex)
+
+    def download_all(self, uuids):
+        """
+        downloads products concurrently
+
+        :param uuids: scihub keys of the products
+
+        :return tuple: OrderedDict of uuid to path of the downloaded products, and
+                       OrderedDict of uuid to error message of the failed products
+        """
+        uuids = list(uuids)
+        downloaded = OrderedDict()
+        failed = OrderedDict()
+        if not uuids:
+            return downloaded, failed
+
+        pool = ThreadPool(min(self.workers, len(uuids)))
+        try:
+            results = {}
+            infos = []
+            for uuid, info, error in pool.map(self._info, uuids):
+                if error is None:
+                    infos.append(info)
+                else:
+                    results[uuid] = None, error
+            self.total += sum(info['size'] for info in infos)
+            for uuid, path, error in pool.imap_unordered(self._fetch, infos):
+                results[uuid] = path, error
+        finally:
+            pool.close()
+            pool.join()
+
+        for uuid in uuids:
+            path, error = results[uuid]
+            if error is None:
+                downloaded[uuid] = path
+            else:
+                failed[uuid] = error
+        return downloaded, failed
@@ -6,71 +6,738 @@ from eggshell.visual import visualisation as vs
 import io
 from PIL import Image
 import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
 import numpy as np
 from os import path, listdir
 import glob
-import subprocess
+import threading
+import warnings
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
-from .dependencies import ProductIO
-from .dependencies import jpy
-# from snappy import ProductIO
-# from snappy import jpy
+from .config import get_option
+from .indices import QUANTIFICATION_VALUE, Workspace, get_index, required_bands, to_reflectance
+from .locks import FileLock
+from .stats import RasterStats, read_sidecar
 
 import logging
 LOGGER = logging.getLogger("PYWPS")
 
+OUTPUT_FORMATS = ['COG', 'GTiff']
+COMPRESSIONS = ['DEFLATE', 'ZSTD', 'LZW', 'NONE']
+COG_BLOCKSIZE = 512
 
-def get_bai(basedir, product='Sentinel2'):
+# control points (value, RGB color) of the quicklook color maps, named after the colorscheme of an index
+COLORMAPS = {
+    'NDVI': [(-1.0, (0, 0, 140)), (0.0, (190, 170, 130)), (0.2, (235, 230, 140)), (0.4, (150, 200, 80)),
+             (0.6, (60, 150, 40)), (1.0, (0, 80, 0))],
+    'BAI': [(0.0, (255, 255, 255)), (100.0, (255, 220, 120)), (250.0, (240, 120, 30)), (500.0, (160, 0, 0)),
+            (1000.0, (60, 0, 0))],
+}
+QUICKLOOK_SIZE = 1024
+
+# band_id of the band specific elements (e.g. RADIO_ADD_OFFSET) in the product metadata
+BAND_IDS = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12']
+
+# cloud masks of Sentinel2 products in order of preference, see get_mask
+MASKS = ['SCL', 'MSK_CLASSI_B00.jp2', 'MSK_CLOUDS_B00.gml']
+# scene classes masked out: no data, saturated or defective, cloud shadows, medium and high probability clouds, cirrus
+SCL_MASKED = [0, 1, 3, 8, 9, 10]
+
+# reducers of composite, 'median' is approximated with a per pixel histogram
+REDUCERS = ['max', 'min', 'mean', 'count', 'median', 'median_exact']
+MEDIAN_BINS = 256
+
+
+def get_bai(basedir, product='Sentinel2', **kwargs):
     """
     :param basedir: path of basedir for EO data
     :param product: EO product e.g. "Sentinel2" (default)
+    :param kwargs: options of :func:`get_indices` (e.g. window_size, output_format)
 
     :retrun: bai file
     """
+    return get_indices(basedir, ['BAI'], product=product, **kwargs)['BAI']
+
+
+def get_bands(basedir):
+    """
+    returns the JPEG2000 band files of a Sentinel2 product.
+    For a zip archive the bands are resolved from its central directory
+    and returned as GDAL ``/vsizip/`` paths, so nothing needs to be extracted.
+    L2A products hold a band in several resolutions, the finest one is returned.
+
+    :param basedir: path of basedir for EO data or of the zip archive of the product
+
+    :return dict: band name (e.g. 'B04', 'SCL') as key and file path as value
+    """
+    if basedir.endswith('.zip'):
+        return get_zip_bands(basedir)
+    bands = {}
+    filenames = glob.glob(basedir + '/GRANULE/*/IMG_DATA/*jp2') + glob.glob(basedir + '/GRANULE/*/IMG_DATA/R*m/*jp2')
+    # R10m sorts before R20m and R60m
+    for filename in sorted(filenames):
+        bands.setdefault(_band_name(filename), filename)
+    return bands
+
+
+def _band_name(member):
+    """
+    returns the band name of a zip member if it is a band file of a Sentinel2 product, otherwise None
+    """
+    parts = member.split('/')
+    if not member.endswith('jp2'):
+        return None
+    # L1C: <ID>.SAFE/GRANULE/<granule>/IMG_DATA/<tile>_<band>.jp2
+    if len(parts) >= 4 and parts[-4] == 'GRANULE' and parts[-2] == 'IMG_DATA':
+        return path.splitext(parts[-1])[0].split('_')[-1]
+    # L2A: <ID>.SAFE/GRANULE/<granule>/IMG_DATA/R<res>m/<tile>_<band>_<res>m.jp2
+    if len(parts) >= 5 and parts[-5] == 'GRANULE' and parts[-3] == 'IMG_DATA':
+        return path.splitext(parts[-1])[0].split('_')[-2]
+    return None
+
+
+def _mask_name(member):
+    """
+    returns the name of a zip member if it is one of the cloud masks of ``MASKS``, otherwise None
+    """
+    parts = member.split('/')
+    if _band_name(member) == 'SCL':
+        return 'SCL'
+    # <ID>.SAFE/GRANULE/<granule>/QI_DATA/MSK_CLASSI_B00.jp2
+    if len(parts) >= 4 and parts[-4] == 'GRANULE' and parts[-2] == 'QI_DATA' and parts[-1] in MASKS:
+        return parts[-1]
+    return None
+
+
+def _is_metadata(member):
+    """
+    checks if a zip member is one of the metadata files describing the product and its granules
+    """
+    parts = member.split('/')
+    if len(parts) == 2:
+        # <ID>.SAFE/MTD_MSIL1C.xml, <ID>.SAFE/manifest.safe
+        return parts[1].startswith('MTD_') or parts[1] == 'manifest.safe'
+    # <ID>.SAFE/GRANULE/<granule>/MTD_TL.xml
+    return len(parts) == 4 and parts[1] == 'GRANULE' and parts[3].startswith('MTD_')
+
+
+def get_zip_bands(file_zip):
+    """
+    returns the JPEG2000 band files of a zipped Sentinel2 product as GDAL virtual file system paths
+
+    :param file_zip: path of the zip archive (as downloaded from the scihub)
+
+    :return dict: band name (e.g. 'B04') as key and ``/vsizip/`` path as value
+    """
+    import zipfile
+
+    bands = {}
+    with zipfile.ZipFile(file_zip, 'r') as zf:
+        for member in sorted(zf.namelist()):
+            band = _band_name(member)
+            if band is not None:
+                bands.setdefault(band, '/vsizip/{}/{}'.format(path.abspath(file_zip), member))
+    return bands
+
+
+def get_mask(basedir):
+    """
+    returns the cloud mask of a Sentinel2 product, the first one found of ``MASKS``:
+    the scene classification of L2A products, the classification mask of L1C products
+    (processing baseline 04.00 on, the bits 10 and 11 of QA60) or the cloud mask polygons of older L1C products.
+
+    :param basedir: path of basedir for EO data or of the zip archive of the product
+
+    :return tuple: name of the mask (one of ``MASKS``) and its path (``/vsizip/`` for a zip archive),
+                   (None, None) if the product has no cloud mask
+    """
+    import zipfile
+
+    if basedir.endswith('.zip'):
+        with zipfile.ZipFile(basedir, 'r') as zf:
+            members = ['/vsizip/{}/{}'.format(path.abspath(basedir), member) for member in zf.namelist()]
+    else:
+        members = glob.glob(basedir + '/GRANULE/*/IMG_DATA/R*m/*jp2') + glob.glob(basedir + '/GRANULE/*/QI_DATA/*')
+    found = {}
+    for member in sorted(members):
+        found.setdefault(_mask_name(member), member)
+    for name in MASKS:
+        if name in found:
+            return name, found[name]
+    return None, None
+
+
+def _read_member(filename):
+    """
+    returns the content of a file or of a ``/vsizip/`` zip member
+    """
+    import zipfile
+
+    if filename.startswith('/vsizip/'):
+        file_zip, member = filename[len('/vsizip/'):].split('.zip/', 1)
+        with zipfile.ZipFile(file_zip + '.zip', 'r') as zf:
+            return zf.read(member)
+    with open(filename, 'rb') as fp:
+        return fp.read()
+
+
+def radiometry(basedir):
+    """
+    returns the radiometric offsets and the quantification value of a Sentinel2 product,
+    read from its metadata (MTD_MSIL1C.xml or MTD_MSIL2A.xml).
+    From processing baseline 04.00 on the digital numbers are shifted by an offset (-1000) per band
+    and reflectances are (dn + offset) / quantification value, see :func:`kingfisher.indices.to_reflectance`.
+
+    :param basedir: path of basedir for EO data or of the zip archive of the product
+
+    :return tuple: dict of band name and offset (empty before baseline 04.00), quantification value
+    """
+    import zipfile
+    import xml.etree.ElementTree as ET
+
+    if basedir.endswith('.zip'):
+        with zipfile.ZipFile(basedir, 'r') as zf:
+            members = ['/vsizip/{}/{}'.format(path.abspath(basedir), member) for member in zf.namelist()
+                       if len(member.split('/')) == 2 and member.split('/')[1].startswith('MTD_MSIL')]
+    else:
+        members = glob.glob(basedir + '/MTD_MSIL*.xml')
+    offsets, quantification = {}, QUANTIFICATION_VALUE
+    if not members:
+        LOGGER.warning('no metadata found in %s, digital numbers are scaled without offsets' % basedir)
+        return offsets, quantification
+    filename = sorted(members)[0]
+    # L1C: top of atmosphere reflectances, L2A: bottom of atmosphere reflectances
+    prefix = 'BOA_' if filename.endswith('MTD_MSIL2A.xml') else ''
+    try:
+        root = ET.fromstring(_read_member(filename))
+    except ET.ParseError as e:
+        LOGGER.warning('metadata of %s not readable, digital numbers are scaled without offsets: %s' % (basedir, e))
+        return offsets, quantification
+    for element in root.iter():
+        tag = element.tag.split('}')[-1]
+        if tag == prefix + 'QUANTIFICATION_VALUE':
+            quantification = float(element.text)
+        elif tag == ('BOA_ADD_OFFSET' if prefix else 'RADIO_ADD_OFFSET'):
+            offsets[BAND_IDS[int(element.get('band_id'))]] = float(element.text)
+    return offsets, quantification
+
+
+def mask_polygons(filename):
+    """
+    returns the polygons of a Sentinel2 GML mask (e.g. MSK_CLOUDS_B00.gml), in the CRS of the tile
+
+    :param filename: path of the GML file, ``/vsizip/`` paths are read from the zip archive
+
+    :return list: GeoJSON like polygons
+    """
+    import xml.etree.ElementTree as ET
+
+    def ring(pos_list):
+        dimension = int(pos_list.get('srsDimension', 2))
+        values = [float(v) for v in pos_list.text.split()]
+        return [tuple(values[i:i + 2]) for i in range(0, len(values), dimension)]
+
+    polygons = []
+    for element in ET.fromstring(_read_member(filename)).iter():
+        if not element.tag.endswith('}Polygon'):
+            continue
+        rings = []
+        for part in element:
+            pos_list = next((e for e in part.iter() if e.tag.endswith('}posList')), None)
+            if pos_list is None or not pos_list.text:
+                continue
+            # the exterior ring comes first
+            if part.tag.endswith('}exterior'):
+                rings.insert(0, ring(pos_list))
+            else:
+                rings.append(ring(pos_list))
+        if rings:
+            polygons.append({'type': 'Polygon', 'coordinates': rings})
+    return polygons
+
+
+class CloudMask(object):
+    """Cloud mask of a product on the grid of the indices, read window by window."""
+
+    def __init__(self, name, filename, transform, width, height):
+        """
+        :param name: name of the mask, one of ``MASKS``
+        :param filename: path of the mask, see :func:`get_mask`
+        :param transform: affine transform of the grid
+        :param width: number of columns of the grid
+        :param height: number of rows of the grid
+        """
+        self.name = name
+        self.transform = transform
+        self._handles = []
+        if name == 'MSK_CLOUDS_B00.gml':
+            self.shapes = mask_polygons(filename)
+            return
+        src = rasterio.open(filename)
+        self._handles.append(src)
+        if (src.transform, src.width, src.height) != (transform, width, height):
+            # classes must not be interpolated
+            src = align(src, transform, width, height, upsampling=Resampling.nearest,
+                        downsampling=Resampling.nearest)
+            self._handles.append(src)
+        self.src = src
+
+    def read(self, window):
+        """
+        reads the mask of a window
+
+        :param window: window of the grid
+
+        :return: bool array, True for masked pixels
+        """
+        from rasterio.features import rasterize
+        from rasterio.windows import transform as window_transform
+
+        if self.name == 'SCL':
+            return np.isin(self.src.read(1, window=window), SCL_MASKED)
+        if self.name == 'MSK_CLASSI_B00.jp2':
+            # opaque clouds and cirrus
+            classes = self.src.read([1, 2], window=window)
+            return (classes[0] > 0) | (classes[1] > 0)
+        shape = (int(window.height), int(window.width))
+        if not self.shapes:
+            return np.zeros(shape, dtype=bool)
+        return rasterize(self.shapes, out_shape=shape, transform=window_transform(window, self.transform),
+                         fill=0, default_value=1, dtype=rasterio.uint8).astype(bool)
+
+    def close(self):
+        for src in reversed(self._handles):
+            src.close()
+
+
+def extract(file_zip, directory, bands=None):
+    """
+    extracts a zipped Sentinel2 product.
+    With ``bands`` only these band files, the cloud masks and the product and granule metadata are extracted,
+    members already extracted by earlier requests are not touched again.
+
+    :param file_zip: path of the zip archive (as downloaded from the scihub)
+    :param directory: directory to extract the SAFE directory tree into
+    :param bands: list of band names to extract (e.g. ['B04', 'B08']), None extracts the whole archive
+
+    :return str: path of the SAFE directory
+    """
+    import shutil
+    import uuid
+    import zipfile
+    from os import makedirs, rename
+    from os.path import dirname, exists, getsize, join, realpath, sep
+
+    root = realpath(directory)
+    extracted = 0
+    with zipfile.ZipFile(file_zip, 'r') as zf:
+        members = zf.infolist()
+        safe = members[0].filename.split('/')[0]
+        # one worker extracts a product at a time, members appear complete through atomic renames
+        with FileLock(join(root, safe + '.lock')):
+            for info in members:
+                member = info.filename
+                target = realpath(join(root, member))
+                if not target.startswith(root + sep):
+                    raise ValueError('zip member {} points outside of {}'.format(member, directory))
+                if bands is not None and not _is_metadata(member) and _mask_name(member) is None \
+                        and _band_name(member) not in bands:
+                    continue
+                if member.endswith('/') or (exists(target) and getsize(target) == info.file_size):
+                    continue
+                if not exists(dirname(target)):
+                    makedirs(dirname(target))
+                part = '{}.{}.part'.format(target, uuid.uuid4().hex)
+                with zf.open(info) as src, open(part, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                rename(part, target)
+                extracted += 1
+    LOGGER.debug('%s members of %s extracted' % (extracted, file_zip))
+
+    return join(directory, safe)
+
+
+def windows(width, height, window_size):
+    """
+    splits a raster grid into windows
+
+    :param width: number of columns of the raster
+    :param height: number of rows of the raster
+    :param window_size: edge length in pixel of the windows
+
+    :return generator: rasterio windows covering the raster, row by row
+    """
+    for row in range(0, height, window_size):
+        for col in range(0, width, window_size):
+            yield Window(col, row,
+                         min(window_size, width - col),
+                         min(window_size, height - row))
+
+
+def bbox_window(src, bbox, crs='EPSG:4326'):
+    """
+    returns the pixel window of a raster intersecting a bounding box.
+    The bounding box is reprojected into the CRS of the raster.
+
+    :param src: opened rasterio dataset
+    :param bbox: bounding box (min_lon, min_lat, max_lon, max_lat)
+    :param crs: CRS of the bounding box (default: 'EPSG:4326')
+
+    :return Window: intersecting window, rounded outwards to full pixels; None if the raster is not intersected
+    """
+    import math
+    from rasterio.warp import transform_bounds
+    from rasterio.windows import from_bounds
+
+    min_x, max_x = sorted([bbox[0], bbox[2]])
+    min_y, max_y = sorted([bbox[1], bbox[3]])
+    left, bottom, right, top = transform_bounds(crs, src.crs, min_x, min_y, max_x, max_y, densify_pts=21)
+    window = from_bounds(left, bottom, right, top, transform=src.transform)
+
+    col_off = max(int(math.floor(window.col_off)), 0)
+    row_off = max(int(math.floor(window.row_off)), 0)
+    col_end = min(int(math.ceil(window.col_off + window.width)), src.width)
+    row_end = min(int(math.ceil(window.row_off + window.height)), src.height)
+    if col_end <= col_off or row_end <= row_off:
+        return None
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def output_profile(profile, output_format='COG', compress='DEFLATE', dtype=rasterio.float32):
+    """
+    returns the creation options of an index geotiff
+
+    :param profile: rasterio profile of the source grid
+    :param output_format: 'COG' for an internally tiled Cloud-Optimized GeoTIFF with overviews,
+                          'GTiff' for a plain striped GeoTIFF
+    :param compress: compression of the output, one of ``COMPRESSIONS``
+    :param dtype: data type of the output (default: float32)
+
+    :return dict: profile for ``rasterio.open``
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('unknown output format {}, allowed are: {}'.format(output_format, ', '.join(OUTPUT_FORMATS)))
+    if compress not in COMPRESSIONS:
+        raise ValueError('unknown compression {}, allowed are: {}'.format(compress, ', '.join(COMPRESSIONS)))
+
+    profile = dict(profile)
+    profile.update(driver='GTiff')
+    profile.update(dtype=dtype)
+    for option in ('tiled', 'blockxsize', 'blockysize', 'compress', 'predictor', 'interleave'):
+        profile.pop(option, None)
+    if output_format == 'COG':
+        profile.update(tiled=True, blockxsize=COG_BLOCKSIZE, blockysize=COG_BLOCKSIZE)
+    if compress != 'NONE':
+        # floating point or horizontal differencing predictor
+        profile.update(compress=compress, predictor=3 if np.dtype(dtype).kind == 'f' else 2)
+    return profile
+
+
+def overview_factors(width, height, blocksize=COG_BLOCKSIZE):
+    """
+    returns the decimation factors of the overviews needed until a level fits into one block
+
+    :param width: number of columns of the raster
+    :param height: number of rows of the raster
+    :param blocksize: edge length of the internal tiles
+
+    :return list: factors e.g. [2, 4, 8]
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / float(factor) >= blocksize / 2.:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def to_cog(source, target, profile):
+    """
+    builds the overviews of a tiled geotiff and copies it into a Cloud-Optimized GeoTIFF,
+    with the overviews stored ahead of the full resolution data.
+
+    :param source: tiled geotiff, removed afterwards
+    :param target: path of the Cloud-Optimized GeoTIFF
+    :param profile: profile created by :func:`output_profile`
+    """
+    from os import remove
+
+    with rasterio.open(source, 'r+') as src:
+        factors = overview_factors(src.width, src.height)
+        if factors:
+            src.build_overviews(factors, Resampling.average)
+            src.update_tags(ns='rio_overview', resampling='average')
+
+    options = dict((key, value) for key, value in profile.items()
+                   if key in ('tiled', 'blockxsize', 'blockysize', 'compress', 'predictor'))
+    rasterio.shutil.copy(source, target, driver='GTiff', copy_src_overviews=True, **options)
+    remove(source)
+
+
+def _imap_ordered(pool, func, items, ahead):
+    """
+    like ``pool.imap`` but with at most ``ahead`` results pending,
+    so results produced faster than they are consumed do not pile up in memory
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
-    LOGGER.debug("Start calculating BAI")
+
+def get_indices(basedir, indices, product='Sentinel2', window_size=None, threads=None,
+                output_format='COG', compress='DEFLATE', bbox=None, resolution=None, cloud_mask=None,
+                accumulators=None, write=True, statistics=True):
+    """
+    computes several spectral indices in one pass over the bands.
+    Every band needed by the indices is read once per window and all indices
+    are computed out of these shared buffers and written window by window.
+
+    With ``threads`` > 1 the windows are decoded and computed on a thread pool
+    (GDAL releases the GIL while decoding). Each thread reads through its own dataset
+    handles and the windows are written in the same order as in the serial path,
+    so the output is identical.
+
+    Pixels without data (digital number 0 in any band of the index) and, with ``cloud_mask``, pixels masked
+    by the cloud mask of the product are set to NaN. The nodata pixels of an index only depend on its own
+    bands, whatever other indices are computed along. The mask is read ahead of the bands: fully masked
+    windows are neither decoded nor computed, nor are bands only needed by fully masked indices.
+
+    :param basedir: path of basedir for EO data or of the zip archive of the product
+    :param indices: list of index names registered in :mod:`kingfisher.indices` (e.g. ['NDVI', 'BAI'])
+    :param product: EO product e.g. "Sentinel2" (default)
+    :param window_size: edge length in pixel of the windows processed at once
+                        (default: ``window_size`` of the ``[kingfisher]`` configuration)
+    :param threads: number of threads processing windows of the tile concurrently
+                    (default: ``window_threads`` of the ``[kingfisher]`` configuration)
+    :param output_format: 'COG' (default) for Cloud-Optimized GeoTIFFs with internal tiles and overviews,
+                          'GTiff' for plain striped GeoTIFFs
+    :param compress: compression of the output, one of 'DEFLATE' (default), 'ZSTD', 'LZW' or 'NONE'
+    :param bbox: bounding box (min_lon, min_lat, max_lon, max_lat) to clip the indices to.
+                 Only the pixels intersecting the bounding box are read. If None, the whole tile is computed.
+    :param resolution: resolution in meter of the output grid (e.g. 10, 20 or 60).
+                       If None, the finest resolution of the needed bands is used. Bands of other resolutions
+                       are resampled lazily window by window, see :func:`align`.
+    :param cloud_mask: mask clouds with the mask of the product, see :func:`get_mask`
+                       (default: ``cloud_mask`` of the ``[kingfisher]`` configuration)
+    :param accumulators: objects consuming the computed windows, e.g. :class:`kingfisher.zonal.ZonalStatistics`.
+                         ``start(profile)`` is called with the output profile before the first window and
+                         ``update(name, window, values)`` for every index and window, in the order of the windows.
+    :param write: write the index files; without, the indices are only passed to the ``accumulators``
+    :param statistics: accumulate the statistics of the index files while they are written and store them as
+                       GDAL statistics metadata and JSON sidecar, see :mod:`kingfisher.stats`
+
+    :return OrderedDict: index name as key and path to the index geotiff as value, empty without ``write``
+    """
+    if window_size is None:
+        window_size = get_option('window_size', 1024, int)
+    if threads is None:
+        threads = get_option('window_threads', 1, int)
+    if cloud_mask is None:
+        cloud_mask = get_option('cloud_mask', True)
 
     prefix = path.basename(path.normpath(basedir)).split('.')[0]
+    indices = [get_index(name) for name in OrderedDict.fromkeys(indices)]
+    jps = get_bands(basedir)
+
+    LOGGER.debug('Start calculating %s for %s' % (', '.join(i.name for i in indices), prefix))
+
+    needed = required_bands([i.name for i in indices])
+    missing = [band for band in needed if band not in jps]
+    if missing:
+        raise ValueError('bands {} not found in {}'.format(', '.join(missing), basedir))
+
+    offsets, quantification = radiometry(basedir)
+    mask_name, mask_file = get_mask(basedir) if cloud_mask else (None, None)
+    if cloud_mask and mask_name is None:
+        LOGGER.warning('no cloud mask found in %s, only pixels without data are masked' % basedir)
 
-    jps = []
-    fname = basedir.split('/')[-1]
-    ID = fname.replace('.SAFE', '')
+    def open_sources():
+        sources = OrderedDict()
+        for band in needed:
+            src = rasterio.open(jps[band])
+            handles.append(src)
+            if src.transform != grid_transform or (src.width, src.height) != (grid_width, grid_height):
+                # digital number 0 is nodata
+                src = align(src, grid_transform, grid_width, grid_height, nodata=0)
+                handles.append(src)
+            sources[band] = src
+        mask = None
+        if mask_name is not None:
+            mask = CloudMask(mask_name, mask_file, grid_transform, grid_width, grid_height)
+            handles.append(mask)
+        return sources, mask
 
-    LOGGER.debug("Start calculating BAI for %s " % ID)
+    def masked_window(shape):
+        return [np.full(shape, np.nan, dtype=np.float32) for _ in indices]
 
-    for filename in glob.glob(basedir + '/GRANULE/*/IMG_DATA/*jp2'):
-        jps.append(filename)
+    def compute(window, sources, mask, workspace):
+        # windows are relative to the clipped output grid
+        shape = (int(window.height), int(window.width))
+        window = Window(window.col_off + clip.col_off, window.row_off + clip.row_off, window.width, window.height)
+        clouds = mask.read(window) if mask is not None else None
+        if clouds is not None and clouds.all():
+            return masked_window(shape)
+        # the invalid pixels of every index: clouds and nodata of its own bands
+        invalid = [workspace.get('invalid_{}'.format(index.name), shape, np.bool_) for index in indices]
+        for values in invalid:
+            if clouds is None:
+                values.fill(False)
+            else:
+                values[...] = clouds
+        masked = [False] * len(indices)
+        bands = {}
+        for band, src in sources.items():
+            users = [i for i, index in enumerate(indices) if band in index.bands and not masked[i]]
+            if not users:
+                # only needed by fully masked indices
+                continue
+            dn = src.read(1, window=window, out=workspace.get('dn', shape, src.dtypes[0]))
+            nodata = np.equal(dn, 0, out=workspace.get('nodata', shape, np.bool_))
+            for i in users:
+                np.logical_or(invalid[i], nodata, out=invalid[i])
+                masked[i] = invalid[i].all()
+            if all(masked):
+                # e.g. the nodata border of a tile, the other bands are not decoded
+                return masked_window(shape)
+            bands[band] = to_reflectance(dn, out=workspace.get(band, shape), offset=offsets.get(band, 0.),
+                                         quantification=quantification)
+        tmp = workspace.get('tmp', shape)
+        results = []
+        for index, values, skip in zip(indices, invalid, masked):
+            if skip:
+                results.append(np.full(shape, np.nan, dtype=np.float32))
+                continue
+            # the results leave the workspace, so they get their own buffers
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = index(bands, out=np.empty(shape, dtype=np.float32), tmp=tmp)
+            if values.any():
+                result[values] = np.nan
+            results.append(result)
+        return results
 
-    jp_B04 = [jp for jp in jps if '_B04.jp2' in jp][0]
-    jp_B08 = [jp for jp in jps if '_B08.jp2' in jp][0]
+    local = threading.local()
 
-    with rasterio.open(jp_B04) as red:
-        RED = red.read()
-    with rasterio.open(jp_B08) as nir:
-        NIR = nir.read()
+    def compute_threaded(window):
+        # rasterio datasets and workspaces must not be shared between threads
+        if getattr(local, 'sources', None) is None:
+            with lock:
+                local.sources, local.mask = open_sources()
+            local.workspace = Workspace()
+        return compute(window, local.sources, local.mask, local.workspace)
 
+    handles = []
+    lock = threading.Lock()
+    outputs = OrderedDict()
+    pool = None
     try:
-        # compute the BAI burned area index
-        # 1 / ((0.1 - RED)^2 + (0.06 -NIR)^2)
-        bai = 1 / (np.power((0.1 - RED), 2) + np.power((0.06 - NIR), 2))
+        grid_transform, grid_width, grid_height = target_grid([jps[band] for band in needed], resolution)
+        sources, mask = open_sources()
+        grid = next(iter(sources.values()))
+
+        if bbox is None:
+            clip = Window(0, 0, grid.width, grid.height)
+        else:
+            clip = bbox_window(grid, bbox)
+            if clip is None:
+                raise ValueError('bbox {} does not intersect {}'.format(bbox, prefix))
+            LOGGER.debug('bbox {} clipped to window {}'.format(bbox, clip))
+
+        profile = output_profile(grid.meta, output_format=output_format, compress=compress)
+        profile.update(width=int(clip.width), height=int(clip.height), transform=grid.window_transform(clip),
+                       nodata=float('nan'))
+
+        # the sensing time makes the index files groupable by acquisition day, see merge_daily
+        timestamp = sensing_time(prefix)
+        files = OrderedDict()
+        for index in (indices if write else []):
+            _, files[index.name] = mkstemp(dir='.', prefix='{}_{}_'.format(prefix, index.name), suffix='.tif')
+            # COGs are written into a temporary tiled geotiff first and get their overviews afterwards
+            target = files[index.name] + '.tmp' if output_format == 'COG' else files[index.name]
+            outputs[index.name] = rasterio.open(target, 'w', **profile)
+            if timestamp is not None:
+                outputs[index.name].update_tags(TIFFTAG_DATETIME=timestamp.strftime('%Y:%m:%d %H:%M:%S'))
 
-        LOGGER.debug("BAI values are calculated")
+        grid_windows = list(windows(int(clip.width), int(clip.height), window_size))
+        if threads > 1:
+            LOGGER.debug('processing %s windows with %s threads' % (len(grid_windows), threads))
+            pool = ThreadPool(threads)
+            results = _imap_ordered(pool, compute_threaded, grid_windows, 2 * threads)
+        else:
+            workspace = Workspace()
+            results = (compute(window, sources, mask, workspace) for window in grid_windows)
 
-        profile = red.meta
-        profile.update(driver='GTiff')
-        profile.update(dtype=rasterio.float32)
+        accumulators = list(accumulators or [])
+        stats = RasterStats([index.name for index in indices]) if write and statistics else None
+        if stats is not None:
+            accumulators.append(stats)
+        for accumulator in accumulators:
+            accumulator.start(profile)
 
-        _, bai_file = mkstemp(dir='.', prefix=prefix, suffix='.tif')
-        with rasterio.open(bai_file, 'w', **profile) as dst:
-            dst.write(bai.astype(rasterio.float32))
+        for window, data in zip(grid_windows, results):
+            for index, values in zip(indices, data):
+                if write:
+                    outputs[index.name].write(values, 1, window=window)
+                for accumulator in accumulators:
+                    accumulator.update(index.name, window, values)
+
+        if stats is not None:
+            for name, dst in outputs.items():
+                dst.update_tags(1, **stats.tags(name))
+        if output_format == 'COG':
+            for name, dst in outputs.items():
+                dst.close()
+                to_cog(dst.name, files[name], profile)
+        if stats is not None:
+            for name in files:
+                stats.write_sidecar(name, files[name])
     except Exception:
-        LOGGER.exception("Failed to Calculate BAI for %s " % prefix)
-    return bai_file
+        LOGGER.exception('Failed to calculate indices for %s' % prefix)
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for ds in outputs.values():
+            ds.close()
+        # warped datasets are closed before their sources
+        for ds in reversed(handles):
+            ds.close()
+
+    LOGGER.debug('indices calculated for %s' % prefix)
+    return files
+
+
+def sensing_time(name):
+    """
+    returns the sensing time encoded in the name of a Sentinel2 product or of a file derived from it
+    (e.g. S2A_MSIL1C_20180101T101021_N0206_R022_T32TQM_20180101T122129)
+
+    :param name: product ID or file path
+
+    :return datetime: sensing time, None if the name contains no timestamp
+    """
+    import re
+    from datetime import datetime as dt
+
+    match = re.search(r'_(\d{8}T\d{6})(_|\.|$)', path.basename(name))
+    if match is None:
+        return None
+    return dt.strptime(match.group(1), '%Y%m%dT%H%M%S')
 
 
 def get_timestamp(tile):
     """
     returns the creation timestamp of a tile image as datetime.
+    Falls back to the sensing time in the file name if the tile has no ``TIFFTAG_DATETIME``.
 
     :param tile: path to geotiff confom to gdal metadata http://www.gdal.org/gdal_datamodel.html
 
@@ -79,153 +746,498 @@ def get_timestamp(tile):
 
     from datetime import datetime as dt
     try:
-        ds = gdal.Open(tile, 0)
-        ts = ds.GetMetadataItem("TIFFTAG_DATETIME")
+        with rasterio.open(tile) as ds:
+            ts = ds.tags().get('TIFFTAG_DATETIME')
 
         LOGGER.debug("timestamp: %s " % ts)
-        ds = None  # to close the dataset
 
-        timestamp = dt.strptime(ts, '%Y:%m:%d %H:%M:%S')
+        if ts:
+            timestamp = dt.strptime(ts, '%Y:%m:%d %H:%M:%S')
+        else:
+            timestamp = sensing_time(tile)
+        if timestamp is None:
+            raise ValueError('no timestamp found for {}'.format(tile))
     except Exception:
         LOGGER.exception('failed to get timestamp for: %s' % tile)
+        raise
 
     return timestamp
 
 
-def resample(DIR, band, resolution):
+def timestamp_index(tiles, threads=1):
     """
-    resamples a band of a SENTINEL product to a given target resolution
+    builds an index of the timestamps of a set of tiles, reading every tile header once
+
+    :param tiles: list of geotiffs
+    :param threads: number of threads reading the headers
+
+    :return OrderedDict: tile as key and timestamp as value, ordered by timestamp
+    """
+    tiles = list(tiles)
+    if threads > 1 and len(tiles) > 1:
+        pool = ThreadPool(min(threads, len(tiles)))
+        try:
+            timestamps = pool.map(get_timestamp, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        timestamps = [get_timestamp(tile) for tile in tiles]
+    return OrderedDict(sorted(zip(tiles, timestamps), key=lambda item: item[1]))
 
-    :param DIR: base directory of Sentinel2 directory tree
-    :param band: band name (e.g. B4)
-    :param resolution: target resolution in meter (e.g 10)
 
-    :return: resampled band
+def group_by_day(tiles, threads=1, index=None):
     """
+    groups tiles by their day of acquisition
 
-    from snappy import GPF
+    :param tiles: list of geotiffs
+    :param threads: number of threads reading the timestamps
+    :param index: timestamps of the tiles as returned by :func:`timestamp_index`, built if not given
+
+    :return OrderedDict: date as key and list of tiles as value, ordered by date
+    """
+    if index is None:
+        index = timestamp_index(tiles, threads=threads)
+    days = OrderedDict()
+    for tile, timestamp in index.items():
+        days.setdefault(timestamp.date(), []).append(tile)
+    return days
 
-    GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
 
-    HashMap = jpy.get_type('java.util.HashMap')
-    # TODO: BandDescriptor not used
-    # BandDescriptor = jpy.get_type('org.esa.snap.core.gpf.common.BandMathsOp$BandDescriptor')
+def merge_daily(tiles, prefix='mosaic_', workers=None, **kwargs):
+    """
+    mosaics the tiles of each acquisition day on its own.
+    The timestamps are indexed once for all tiles and the days are merged in parallel.
 
-    parameters = HashMap()
-    parameters.put('targetResolution', resolution)
-    parameters.put('upsampling', 'Bicubic')
-    parameters.put('downsampling', 'Mean')
-    parameters.put('flagDownsampling', 'FlagMedianAnd')
-    parameters.put('resampleOnPyramidLevels', True)
+    :param tiles: list of geotiffs
+    :param prefix: prefix of the output file names, followed by the date
+    :param workers: number of days merged concurrently
+                    (default: ``mosaic_workers`` of the ``[kingfisher]`` configuration)
+    :param kwargs: options of :func:`merge` (e.g. virtual, output_format)
 
-    product = ProductIO.readProduct(DIR)
-    product = GPF.createProduct('Resample', parameters, product)
+    :return OrderedDict: date as key and path of the mosaic as value, ordered by date
+    """
+    if workers is None:
+        workers = get_option('mosaic_workers', 1, int)
 
-    rsp_band = product.getBand(band)
+    # the timestamps are also needed for the tags of the mosaics
+    index = timestamp_index(tiles, threads=workers)
+    days = group_by_day(tiles, index=index)
+    LOGGER.debug('%s tiles acquired on %s days' % (len(index), len(days)))
 
-    return rsp_band
+    def merge_day(item):
+        day, day_tiles = item
+        # the mosaic carries the first acquisition time of the day
+        tags = {'TIFFTAG_DATETIME': index[day_tiles[0]].strftime('%Y:%m:%d %H:%M:%S')}
+        return merge(day_tiles, prefix='{}{}_'.format(prefix, day.strftime('%Y%m%d')), tags=tags, **kwargs)
 
+    if workers > 1 and len(days) > 1:
+        # GDAL releases the GIL while reading and compressing, so threads are sufficient
+        pool = ThreadPool(min(workers, len(days)))
+        try:
+            mosaics = pool.map(merge_day, days.items())
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        mosaics = [merge_day(item) for item in days.items()]
+    return OrderedDict(zip(days.keys(), mosaics))
 
-def merge(tiles, prefix="mosaic_"):
+
+def sentinel_tile(name):
     """
-    merging a given list of files with gdal_merge.py
+    returns the MGRS tile encoded in the name of a Sentinel2 product or of a file derived from it
+    (e.g. 'T32TQM' for S2A_MSIL1C_20180101T101021_N0206_R022_T32TQM_20180101T122129)
 
-    :param tiles: list of geotiffs to be merged_tiles
+    :param name: product ID or file path
+
+    :return str: tile, None if the name contains no tile
+    """
+    import re
+
+    match = re.search(r'_(T\d{2}[A-Z]{3})(_|\.|$)', path.basename(name))
+    return match.group(1) if match is not None else None
+
+
+def group_by_tile(files):
+    """
+    groups files by the MGRS tile of their product, e.g. the dated index files of a period
+
+    :param files: list of file paths named after their Sentinel2 product
+
+    :return OrderedDict: tile as key and list of files as value
+    """
+    tiles = OrderedDict()
+    for filename in files:
+        tiles.setdefault(sentinel_tile(filename), []).append(filename)
+    return tiles
+
+
+def _reduce(reducer, sources, window, bins, value_range):
+    shape = (int(window.height), int(window.width))
+    data = np.empty(shape, dtype=np.float32)
+    valid = np.empty(shape, dtype=bool)
+
+    if reducer == 'median_exact':
+        stack = np.empty((len(sources),) + shape, dtype=np.float32)
+        for i, src in enumerate(sources):
+            src.read(1, window=window, out=stack[i])
+        with warnings.catch_warnings():
+            # all-NaN pixels
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmedian(stack, axis=0).astype(np.float32)
+
+    count = np.zeros(shape, dtype=np.uint16)
+    if reducer in ('max', 'min'):
+        result = np.full(shape, np.nan, dtype=np.float32)
+        combine = np.fmax if reducer == 'max' else np.fmin
+    elif reducer == 'mean':
+        result = np.zeros(shape, dtype=np.float32)
+    elif reducer == 'median':
+        low, high = value_range
+        hist = np.zeros((bins,) + shape, dtype=np.uint16)
+        rows, cols = np.indices(shape)
+        idx = np.empty(shape, dtype=np.float32)
+
+    for src in sources:
+        src.read(1, window=window, out=data)
+        np.isfinite(data, out=valid)
+        count += valid
+        if reducer in ('max', 'min'):
+            # fmax and fmin skip NaN
+            combine(result, data, out=result)
+        elif reducer == 'mean':
+            np.add(result, data, out=result, where=valid)
+        elif reducer == 'median':
+            np.subtract(data, np.float32(low), out=idx)
+            np.multiply(idx, np.float32(bins / float(high - low)), out=idx)
+            np.clip(idx, 0, bins - 1, out=idx)
+            # every pixel is counted once per raster, so fancy indexing has no duplicates
+            hist[idx[valid].astype(np.intp), rows[valid], cols[valid]] += 1
+
+    if reducer == 'count':
+        return count.astype(np.float32)
+    if reducer == 'mean':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(result, count, out=result)
+    elif reducer == 'median':
+        # bins of the two middle values (the same for an odd count), at their centers
+        cumulated = np.cumsum(hist, axis=0, dtype=np.uint16)
+        lower = np.argmax(cumulated >= (count + 1) // 2, axis=0)
+        upper = np.argmax(cumulated >= count // 2 + 1, axis=0)
+        result = (low + ((lower + upper) / 2. + 0.5) * (high - low) / bins).astype(np.float32)
+        result[count == 0] = np.nan
+    return result
 
-    :return geotiff: mosaic of merged files
+
+def composite(rasters, reducer='max', prefix='composite_', output_format='COG', compress='DEFLATE',
+              window_size=None, value_range=(-1., 1.), bins=MEDIAN_BINS):
     """
+    reduces a stack of dated rasters of the same area (e.g. the NDVI of a season) pixel by pixel.
+    The stack is streamed window by window, memory stays bounded whatever the number of rasters.
+    NaN values (e.g. masked clouds) are ignored. Rasters on another grid are resampled onto the grid
+    of the first raster with nearest neighbour.
+
+    :param rasters: list of single band rasters
+    :param reducer: one of ``REDUCERS``: 'max' (e.g. max-NDVI composites), 'min', 'mean', 'count' of valid
+                    values, 'median' approximated from a histogram of ``bins`` bins over ``value_range``,
+                    or 'median_exact'
+    :param prefix: prefix of the output file name
+    :param output_format: 'COG' (default) or 'GTiff', see :func:`output_profile`
+    :param compress: compression of the output, one of ``COMPRESSIONS``
+    :param window_size: edge length in pixel of the windows of the max, min, mean and count reducers
+                        (default: ``window_size`` of the ``[kingfisher]`` configuration). The median reducers
+                        keep a value per raster or bin, their windows are shrunk to keep the same memory.
+    :param value_range: range of the values (min, max) for the approximated median, e.g. ``Index.value_range``.
+                        It is narrowed to the ``STATISTICS_MINIMUM`` and ``STATISTICS_MAXIMUM`` of the rasters
+                        when all of them have these statistics.
+    :param bins: number of histogram bins for the approximated median
 
-    from eggshell.eo import gdal_merge as gm
-    from os.path import join, basename
-    from subprocess import CalledProcessError
-    from eggshell.config import _PATH
+    :return str: path of the composite geotiff
+    """
+    if reducer not in REDUCERS:
+        raise ValueError('unknown reducer {}, allowed are: {}'.format(reducer, ', '.join(REDUCERS)))
+    if not rasters:
+        raise ValueError('no rasters to composite')
+    if window_size is None:
+        window_size = get_option('window_size', 1024, int)
+    if reducer in ('median', 'median_exact'):
+        depth = bins if reducer == 'median' else len(rasters)
+        window_size = max(16, int(window_size / max(1., (depth / 4.) ** 0.5)) // 16 * 16)
 
+    _, filename = mkstemp(dir='.', prefix=prefix, suffix='.tif')
+    handles = []
     try:
-        LOGGER.debug('start merging of %s files' % len(tiles))
-        # prefix = dt.strftime(date, "%Y%m%d")
-        _, filename = mkstemp(dir='.', prefix=prefix, suffix='.tif')
-        gdal_merge = '%s/gdal_merge.py' % _PATH
-        cmd = ['python', gdal_merge, '-o', filename, '-of', 'GTiff', '-v']
-        for tile in tiles:
-            LOGGER.debug('extent tile %s ', tile)
-            cmd.append(tile)
-
-        LOGGER.debug('cmd: %s' % cmd)
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        LOGGER.debug('gdal_merge log: \n %s', output)
-
-    except CalledProcessError as e:
-        LOGGER.exception('failed to merge tiles:\n{0}'.format(e.output))
-
-    # import sys
-    # try:
-    #     LOGGER.debug('start merging')
-    #     # prefix = dt.strftime(date, "%Y%m%d")
-    #     _, filename = mkstemp(dir='.', prefix=prefix, suffix='.tif')
-    #     call = ['-o',  "%s" % filename, '-of', 'GTiff', '-v']
-    #     #
-    #     # tiles_day = [tile for tile in tiles if date.date() == get_timestamp(tile).date()]
-    #
-    #     for tile in tiles:
-    #         call.extend([tile])
-    #     sys.argv[1:] = call
-    #     gm.main()
-    #
-    #     LOGGER.debug("files merged for %s tiles " % len(tiles))
-    # except:
-    #     LOGGER.exception("failed to merge tiles")
+        grid = rasterio.open(rasters[0])
+        handles.append(grid)
+        sources = [grid]
+        statistics = [grid.tags(1)]
+        for raster in rasters[1:]:
+            src = rasterio.open(raster)
+            handles.append(src)
+            statistics.append(src.tags(1))
+            if (src.crs, src.transform, src.width, src.height) != (grid.crs, grid.transform, grid.width, grid.height):
+                src = WarpedVRT(src, crs=grid.crs, transform=grid.transform, width=grid.width, height=grid.height,
+                                resampling=Resampling.nearest)
+                handles.append(src)
+            sources.append(src)
+        if reducer == 'median' and all('STATISTICS_MINIMUM' in tags and 'STATISTICS_MAXIMUM' in tags
+                                       for tags in statistics):
+            value_range = (max(value_range[0], min(float(tags['STATISTICS_MINIMUM']) for tags in statistics)),
+                           min(value_range[1], max(float(tags['STATISTICS_MAXIMUM']) for tags in statistics)))
+            if value_range[0] >= value_range[1]:
+                # a constant stack still needs a bin of some width
+                value_range = (value_range[0], value_range[0] + 1.)
 
+        profile = output_profile(grid.profile, output_format=output_format, compress=compress)
+        profile.update(count=1, nodata=float('nan'))
+        target = filename + '.tmp' if output_format == 'COG' else filename
+        LOGGER.debug('%s composite of %s rasters in windows of %s pixel' % (reducer, len(rasters), window_size))
+        with rasterio.open(target, 'w', **profile) as dst:
+            dst.update_tags(COMPOSITE_REDUCER=reducer, COMPOSITE_COUNT=len(rasters))
+            timestamps = [sensing_time(raster) for raster in rasters]
+            if None not in timestamps:
+                dst.update_tags(COMPOSITE_START=min(timestamps).isoformat(), COMPOSITE_END=max(timestamps).isoformat())
+            for window in windows(grid.width, grid.height, window_size):
+                dst.write(_reduce(reducer, sources, window, bins, value_range), 1, window=window)
+    finally:
+        for src in reversed(handles):
+            src.close()
+    if output_format == 'COG':
+        to_cog(target, filename, profile)
     return filename
 
 
-def get_ndvi(basedir, product='Sentinel2'):
+def target_grid(files, resolution=None):
     """
-    :param basedir: path of basedir for EO data
-    :param product: EO product e.g. "Sentinel2" (default)
+    returns the grid a set of bands of a tile is aligned to
+
+    :param files: paths of the band files
+    :param resolution: resolution in meter of the grid. If None, the finest resolution of the bands is used.
 
-    :retrun files, plots : list of calculated files and plots
+    :return tuple: affine transform, width and height of the grid
     """
-    import rasterio
-    import numpy as np
-    from os import path
-    from tempfile import mkstemp
-    from osgeo import gdal
-    # import os, rasterio
-    import glob
+    from affine import Affine
 
-    prefix = path.basename(path.normpath(basedir)).split('.')[0]
+    finest = None
+    for filename in files:
+        with rasterio.open(filename) as src:
+            if finest is None or src.res[0] < finest[0][0]:
+                finest = (src.res, src.transform, src.width, src.height)
+    res, transform, width, height = finest
+    if resolution is None or float(resolution) == res[0]:
+        return transform, width, height
 
-    jps = []
-    # TODO: fname is not used
-    # fname = basedir.split('/')[-1]
-    # TODO: ID not used
-    # ID = fname.replace('.SAFE', '')
+    resolution = float(resolution)
+    return (Affine(resolution, 0, transform.c, 0, -resolution, transform.f),
+            int(round(width * res[0] / resolution)),
+            int(round(height * abs(res[1]) / resolution)))
 
-    for filename in glob.glob(basedir + '/GRANULE/*/IMG_DATA/*jp2'):
-        jps.append(filename)
 
-    jp_B04 = [jp for jp in jps if '_B04.jp2' in jp][0]
-    jp_B08 = [jp for jp in jps if '_B08.jp2' in jp][0]
+def align(src, transform, width, height, upsampling=Resampling.cubic, downsampling=Resampling.average,
+          nodata=None):
+    """
+    aligns a band lazily to another grid of the same CRS.
+    Pixels are only resampled when a window of the returned dataset is read.
 
-    with rasterio.open(jp_B04) as red:
-        RED = red.read()
-    with rasterio.open(jp_B08) as nir:
-        NIR = nir.read()
+    :param src: opened rasterio dataset
+    :param transform: affine transform of the target grid
+    :param width: number of columns of the target grid
+    :param height: number of rows of the target grid
+    :param upsampling: resampling method used if the target grid is finer than the band
+    :param downsampling: resampling method used if the target grid is coarser than the band
+    :param nodata: value of pixels without data (e.g. 0 of the Sentinel2 bands). They are left out of
+                   the resampling kernel, so a nodata border does not blend into the valid pixels next to it.
 
-    try:
-        # compute the ndvi
-        ndvi = (NIR.astype(float) - RED.astype(float)) / (NIR + RED)
+    :return WarpedVRT: band on the target grid, to be closed before ``src``
+    """
+    resampling = upsampling if abs(transform.a) < src.res[0] else downsampling
+    if nodata is None:
+        return WarpedVRT(src, crs=src.crs, transform=transform, width=width, height=height, resampling=resampling)
+    return WarpedVRT(src, crs=src.crs, transform=transform, width=width, height=height, resampling=resampling,
+                     src_nodata=nodata, nodata=nodata)
+
+
+@contextmanager
+def resample(DIR, band, resolution, upsampling=Resampling.cubic, downsampling=Resampling.average):
+    """
+    resamples a band of a SENTINEL product to a given target resolution.
+    The band is not read here; windows read from the returned dataset are resampled on the fly::
+
+        with resample(DIR, 'B12', 10) as b12:
+            data = b12.read(1, window=window)
+
+    :param DIR: base directory of Sentinel2 directory tree or its zip archive
+    :param band: band name (e.g. B04)
+    :param resolution: target resolution in meter (e.g 10)
+    :param upsampling: resampling method used if the target resolution is finer than the band
+    :param downsampling: resampling method used if the target resolution is coarser than the band
+
+    :return: resampled band as WarpedVRT
+    """
+    filename = get_bands(DIR)[band]
+    transform, width, height = target_grid([filename], resolution)
+    with rasterio.open(filename) as src:
+        with align(src, transform, width, height, upsampling=upsampling, downsampling=downsampling,
+                   nodata=0) as vrt:
+            yield vrt
+
+
+def merge(tiles, prefix="mosaic_", virtual=False, output_format='COG', compress='DEFLATE', window_size=None,
+          tags=None):
+    """
+    merging a given list of files in-process.
+    A virtual mosaic (VRT) is built over the tiles first and, unless ``virtual`` is set,
+    materialized window by window into a tiled and compressed geotiff.
+
+    :param tiles: list of geotiffs to be merged_tiles
+    :param prefix: prefix of the output file name
+    :param virtual: return the virtual mosaic without writing the mosaic raster
+    :param output_format: 'COG' (default) or 'GTiff', see :func:`output_profile`
+    :param compress: compression of the mosaic, one of ``COMPRESSIONS``
+    :param window_size: edge length in pixel of the windows copied at once
+                        (default: ``window_size`` of the ``[kingfisher]`` configuration)
+    :param tags: dict of metadata items written into the mosaic geotiff
 
-        profile = red.meta
-        profile.update(driver='GTiff')
-        profile.update(dtype=rasterio.float32)
+    :return: path of the mosaic geotiff, or of the VRT file if ``virtual`` is set
+    """
+    from os import remove
+
+    try:
+        LOGGER.debug('start merging of %s files' % len(tiles))
+        _, vrt_file = mkstemp(dir='.', prefix=prefix, suffix='.vrt')
+        vrt = gdal.BuildVRT(vrt_file, [str(tile) for tile in tiles])
+        if vrt is None:
+            raise Exception('failed to build the virtual mosaic {}'.format(vrt_file))
+        vrt = None  # to close the dataset and write the VRT file
+        LOGGER.debug('virtual mosaic of %s tiles built: %s' % (len(tiles), vrt_file))
+        if virtual:
+            return vrt_file
 
-        _, ndvifile = mkstemp(dir='.', prefix=prefix, suffix='.tif')
-        with rasterio.open(ndvifile, 'w', **profile) as dst:
-            dst.write(ndvi.astype(rasterio.float32))
+        filename = materialize(vrt_file, prefix=prefix, output_format=output_format,
+                               compress=compress, window_size=window_size, tags=tags)
+        remove(vrt_file)
     except Exception:
-        LOGGER.exception("Failed to Calculate NDVI for %s " % prefix)
-    return ndvifile
+        LOGGER.exception('failed to merge tiles')
+        raise
+    return filename
+
+
+def materialize(source, prefix='raster_', output_format='COG', compress='DEFLATE', window_size=None, tags=None):
+    """
+    copies a raster (e.g. a virtual mosaic) window by window into a tiled and compressed geotiff
+
+    :param source: path of the raster to be copied
+    :param prefix: prefix of the output file name
+    :param output_format: 'COG' (default) or 'GTiff', see :func:`output_profile`
+    :param compress: compression of the output, one of ``COMPRESSIONS``
+    :param window_size: edge length in pixel of the windows copied at once
+                        (default: ``window_size`` of the ``[kingfisher]`` configuration)
+    :param tags: dict of metadata items written into the geotiff
+
+    :return str: path of the geotiff
+    """
+    if window_size is None:
+        window_size = get_option('window_size', 1024, int)
+
+    _, filename = mkstemp(dir='.', prefix=prefix, suffix='.tif')
+    with rasterio.open(source) as src:
+        profile = output_profile(src.profile, output_format=output_format, compress=compress, dtype=src.dtypes[0])
+        target = filename + '.tmp' if output_format == 'COG' else filename
+        with rasterio.open(target, 'w', **profile) as dst:
+            if tags:
+                dst.update_tags(**tags)
+            for window in windows(src.width, src.height, window_size):
+                dst.write(src.read(window=window), window=window)
+    if output_format == 'COG':
+        to_cog(target, filename, profile)
+    return filename
+
+
+def colormap_lut(colorscheme=None, entries=255):
+    """
+    returns the lookup table of a color map.
+    Values are mapped linearly onto the first ``entries`` rows, the last row is transparent for nodata.
+
+    :param colorscheme: name of a color map in ``COLORMAPS``, None for grayscale
+    :param entries: number of colors
+
+    :return tuple: lut as uint8 array of shape (entries + 1, 4) and the (min, max) value range of the color map
+    """
+    if colorscheme is None:
+        points = [(0., (0, 0, 0)), (1., (255, 255, 255))]
+    else:
+        points = COLORMAPS[colorscheme]
+    values = np.array([value for value, _ in points], dtype=np.float64)
+    colors = np.array([color for _, color in points], dtype=np.float64)
+    steps = np.linspace(values[0], values[-1], entries)
+    lut = np.zeros((entries + 1, 4), dtype=np.uint8)
+    for channel in range(3):
+        lut[:entries, channel] = np.round(np.interp(steps, values, colors[:, channel]))
+    lut[:entries, 3] = 255
+    return lut, (values[0], values[-1])
+
+
+def quicklook(source, colorscheme=None, size=QUICKLOOK_SIZE, filename=None):
+    """
+    renders a raster into a PNG quicklook.
+    Only a decimated level of the raster sized to the quicklook is read, which GDAL takes from the
+    overviews of Cloud-Optimized GeoTIFFs. Colors are applied with a vectorized lookup table.
+
+    :param source: path of a single band raster (e.g. an index geotiff)
+    :param colorscheme: name of a color map in ``COLORMAPS`` (e.g. 'NDVI'), None for grayscale
+                        stretched between the 2nd and 98th percentile, taken from the statistics sidecar
+                        of the raster if there is one
+    :param size: edge length in pixel of the longer side of the quicklook
+    :param filename: path of the PNG file, defaults to the path of the source with the extension .png
+
+    :return str: path of the PNG file
+    """
+    if filename is None:
+        filename = path.splitext(source)[0] + '.png'
+
+    with rasterio.open(source) as src:
+        scale = max(1., max(src.width, src.height) / float(size))
+        shape = (max(1, int(round(src.height / scale))), max(1, int(round(src.width / scale))))
+        data = src.read(1, out_shape=shape, resampling=Resampling.nearest).astype(np.float32)
+        nodata = src.nodata
+
+    valid = np.isfinite(data)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= data != nodata
+
+    entries = 255
+    lut, (vmin, vmax) = colormap_lut(colorscheme, entries)
+    stats = read_sidecar(source) if colorscheme is None else None
+    if stats is not None and stats['percentiles']:
+        vmin, vmax = stats['percentiles']['2'], stats['percentiles']['98']
+    elif colorscheme is None and valid.any():
+        vmin, vmax = np.percentile(data[valid], [2, 98])
+    if vmax <= vmin:
+        vmax = vmin + 1.
+
+    # values scaled onto the lut, nodata onto its transparent last row
+    data[~valid] = vmin
+    np.subtract(data, np.float32(vmin), out=data)
+    np.multiply(data, np.float32((entries - 1) / (vmax - vmin)), out=data)
+    np.clip(data, 0, entries - 1, out=data)
+    idx = data.astype(np.uint8)
+    idx[~valid] = entries
+
+    Image.fromarray(lut[idx], 'RGBA').save(filename, 'PNG')
+    LOGGER.debug('quicklook of {} written to {}'.format(source, filename))
+    return filename
+
+
+def get_ndvi(basedir, product='Sentinel2', **kwargs):
+    """
+    :param basedir: path of basedir for EO data
+    :param product: EO product e.g. "Sentinel2" (default)
+    :param kwargs: options of :func:`get_indices` (e.g. window_size, output_format)
+
+    :retrun: ndvi file
+    """
+    return get_indices(basedir, ['NDVI'], product=product, **kwargs)['NDVI']
 
 
 # def plot_RGB(DIR, colorscheem='natural_color'):
@@ -1,2 +1,6 @@
 class SnappyWarning(UserWarning):
     pass
+
+
+class LockTimeout(Exception):
+    pass
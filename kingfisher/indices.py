@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""
+Registry of the spectral indices which can be computed out of Sentinel2 bands.
+
+Each index declares the bands it needs and a vectorized kernel working on the
+float32 reflectances of a window. Kernels write into a preallocated float32 ``out``
+buffer with in-place ufuncs and may use the scratch buffer ``tmp`` of the same shape,
+so no full size temporaries are allocated. New indices are added with the ``register`` decorator::
+
+    @register('NDVI', ['B04', 'B08'], title='Normalized Difference Vegetation Index')
+    def ndvi(bands, out, tmp):
+        np.add(bands['B08'], bands['B04'], out=tmp)
+        np.subtract(bands['B08'], bands['B04'], out=out)
+        return np.divide(out, tmp, out=out)
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+# digital numbers of Sentinel2 L1C products are reflectances scaled by this value
+QUANTIFICATION_VALUE = 10000.
+
+INDICES = OrderedDict()
+
+
+class Index(object):
+    """A spectral index computed by a vectorized kernel out of a set of bands."""
+
+    def __init__(self, name, bands, formula, title=None, colorscheme=None, version=1, value_range=(-1., 1.)):
+        """
+        :param name: name of the index (e.g. 'NDVI')
+        :param bands: list of band names needed by the kernel (e.g. ['B04', 'B08'])
+        :param formula: kernel computing the index out of a dict of float32 reflectance arrays
+                        into the ``out`` buffer, using the scratch buffer ``tmp``
+        :param title: human readable name of the index
+        :param colorscheme: colorscheme used to plot the index, None for grayscale
+        :param version: version of the kernel, to be increased whenever its results change.
+                        Cached results of other versions are discarded.
+        :param value_range: (min, max) of the usual values, e.g. for the histograms of zonal statistics
+        """
+        self.name = name
+        self.bands = list(bands)
+        self.formula = formula
+        self.title = title or name
+        self.colorscheme = colorscheme
+        self.version = version
+        self.value_range = value_range
+
+    def __call__(self, bands, out=None, tmp=None):
+        """
+        computes the index
+
+        :param bands: dict of float32 reflectance arrays of the same shape
+        :param out: float32 array the index is written into, allocated if None
+        :param tmp: float32 scratch array, allocated if None
+
+        :return: out
+        """
+        shape = bands[self.bands[0]].shape
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        if tmp is None:
+            tmp = np.empty(shape, dtype=np.float32)
+        return self.formula(bands, out, tmp)
+
+    def __repr__(self):
+        return 'Index({!r}, {!r})'.format(self.name, self.bands)
+
+
+def register(name, bands, title=None, colorscheme=None, version=1, value_range=(-1., 1.)):
+    """
+    decorator registering a kernel as spectral index
+
+    :param name: name of the index
+    :param bands: list of band names needed by the kernel
+    :param title: human readable name of the index
+    :param colorscheme: colorscheme used to plot the index, None for grayscale
+    :param version: version of the kernel, to be increased whenever its results change
+    :param value_range: (min, max) of the usual values of the index
+    """
+    def decorator(formula):
+        INDICES[name] = Index(name, bands, formula, title=title, colorscheme=colorscheme, version=version,
+                              value_range=value_range)
+        return formula
+    return decorator
+
+
+def get_index(name):
+    """
+    returns a registered index
+
+    :param name: name of the index
+
+    :return Index: registered index
+    """
+    try:
+        return INDICES[name]
+    except KeyError:
+        raise ValueError('unknown index {}, allowed are: {}'.format(name, ', '.join(INDICES)))
+
+
+def required_bands(names):
+    """
+    returns the bands needed to compute a set of indices
+
+    :param names: list of index names
+
+    :return list: sorted band names, every band listed once
+    """
+    bands = set()
+    for name in names:
+        bands.update(get_index(name).bands)
+    return sorted(bands)
+
+
+def to_reflectance(dn, out=None, offset=0., quantification=QUANTIFICATION_VALUE):
+    """
+    scales digital numbers to float32 reflectances: (dn + offset) / quantification
+
+    :param dn: array of digital numbers
+    :param out: float32 array the reflectances are written into, allocated if None
+    :param offset: radiometric offset of the band, -1000 from processing baseline 04.00 on (see eodata.radiometry)
+    :param quantification: quantification value of the product
+
+    :return: out
+    """
+    if out is None:
+        out = np.empty(dn.shape, dtype=np.float32)
+    if offset:
+        np.add(dn, np.float32(offset), out=out)
+        return np.true_divide(out, np.float32(quantification), out=out)
+    return np.true_divide(dn, np.float32(quantification), out=out)
+
+
+class Workspace(object):
+    """Buffers reused for all windows of the same shape."""
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, key, shape, dtype=np.float32):
+        """
+        returns the buffer registered for a key and shape, allocated at first use
+
+        :param key: name of the buffer (e.g. a band name)
+        :param shape: shape of the buffer
+        :param dtype: dtype of the buffer (default: float32)
+        """
+        buf = self._buffers.get((key, shape, dtype))
+        if buf is None:
+            buf = self._buffers[(key, shape, dtype)] = np.empty(shape, dtype=dtype)
+        return buf
+
+
+def _normalized_difference(a, b, out, tmp):
+    np.add(a, b, out=tmp)
+    np.subtract(a, b, out=out)
+    return np.divide(out, tmp, out=out)
+
+
+@register('NDVI', ['B04', 'B08'], title='Normalized Difference Vegetation Index', colorscheme='NDVI', version=2)
+def ndvi(bands, out, tmp):
+    return _normalized_difference(bands['B08'], bands['B04'], out, tmp)
+
+
+@register('BAI', ['B04', 'B08'], title='Burned Area Index', colorscheme='BAI', value_range=(0., 1000.), version=2)
+def bai(bands, out, tmp):
+    # 1 / ((0.1 - RED)^2 + (0.06 - NIR)^2)
+    np.subtract(np.float32(0.1), bands['B04'], out=out)
+    np.multiply(out, out, out=out)
+    np.subtract(np.float32(0.06), bands['B08'], out=tmp)
+    np.multiply(tmp, tmp, out=tmp)
+    np.add(out, tmp, out=out)
+    return np.reciprocal(out, out=out)
+
+
+@register('NBR', ['B8A', 'B12'], title='Normalized Burn Ratio', version=2)
+def nbr(bands, out, tmp):
+    return _normalized_difference(bands['B8A'], bands['B12'], out, tmp)
+
+
+@register('NDWI', ['B03', 'B08'], title='Normalized Difference Water Index', version=2)
+def ndwi(bands, out, tmp):
+    return _normalized_difference(bands['B03'], bands['B08'], out, tmp)
+
+
+@register('NDMI', ['B8A', 'B11'], title='Normalized Difference Moisture Index', version=2)
+def ndmi(bands, out, tmp):
+    return _normalized_difference(bands['B8A'], bands['B11'], out, tmp)
+
+
+@register('EVI', ['B02', 'B04', 'B08'], title='Enhanced Vegetation Index', version=2)
+def evi(bands, out, tmp):
+    # 2.5 * (NIR - RED) / (NIR + 6 * RED - 7.5 * BLUE + 1)
+    np.multiply(bands['B04'], np.float32(6), out=tmp)
+    np.add(tmp, bands['B08'], out=tmp)
+    np.multiply(bands['B02'], np.float32(7.5), out=out)
+    np.subtract(tmp, out, out=tmp)
+    np.add(tmp, np.float32(1), out=tmp)
+    np.subtract(bands['B08'], bands['B04'], out=out)
+    np.multiply(out, np.float32(2.5), out=out)
+    return np.divide(out, tmp, out=out)
+
+
+@register('SAVI', ['B04', 'B08'], title='Soil Adjusted Vegetation Index', value_range=(-1.5, 1.5), version=2)
+def savi(bands, out, tmp):
+    # 1.5 * (NIR - RED) / (NIR + RED + 0.5)
+    np.add(bands['B08'], bands['B04'], out=tmp)
+    np.add(tmp, np.float32(0.5), out=tmp)
+    np.subtract(bands['B08'], bands['B04'], out=out)
+    np.multiply(out, np.float32(1.5), out=out)
+    return np.divide(out, tmp, out=out)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lock files coordinating the WPS workers, also across hosts sharing the cache over NFS.
+
+A lock is a file created with ``O_CREAT | O_EXCL``, which is atomic on local file systems and NFSv3+.
+The holder touches the file periodically. A waiting worker breaks a lock whose holder died on the same
+host, or whose file did not change for ``stale`` seconds. Staleness is measured with the clock of the
+waiting worker only, so clocks of different hosts need not be in sync.
+
+Example usage::
+
+    from kingfisher.locks import FileLock
+    with FileLock(file_zip + '.lock'):
+        if not exists(file_zip):
+            download(...)
+"""
+
+import errno
+import os
+import socket
+import threading
+import time
+import uuid
+
+from kingfisher.exceptions import LockTimeout
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+# seconds without heartbeat after which a lock is considered abandoned
+STALE = 300
+
+# seconds between two attempts to acquire a held lock
+POLL = 1
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+
+class FileLock(object):
+    """Exclusive lock file with heartbeat and stale lock detection."""
+
+    def __init__(self, path, timeout=None, stale=STALE, poll=POLL):
+        """
+        :param path: path of the lock file
+        :param timeout: seconds to wait for the lock, None to wait until it is released or stale
+        :param stale: seconds without heartbeat after which the lock of another worker is broken
+        :param poll: seconds between two attempts to acquire the lock
+        """
+        self.path = path
+        self.timeout = timeout
+        self.stale = stale
+        self.poll = poll
+        self.owner = '{} {} {}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self._stop = None
+
+    def _read(self, path=None):
+        try:
+            with open(path or self.path) as fp:
+                return fp.read()
+        except (IOError, OSError):
+            return None
+
+    def _state(self, path=None):
+        # modification time and owner of a lock file
+        return os.stat(path or self.path).st_mtime, self._read(path)
+
+    def _dead(self, owner):
+        # only holders on this host can be checked directly
+        try:
+            host, pid, _ = owner.split()
+            return host == socket.gethostname() and not _pid_alive(int(pid))
+        except (AttributeError, ValueError):
+            return False
+
+    def _break(self, state):
+        # renaming first makes sure only one waiting worker removes the abandoned lock
+        broken = '{}.{}.stale'.format(self.path, uuid.uuid4().hex)
+        try:
+            os.rename(self.path, broken)
+        except OSError:
+            return
+        try:
+            renamed = self._state(broken)
+        except OSError:
+            renamed = None
+        if renamed == state:
+            os.remove(broken)
+            LOGGER.warning('broke abandoned lock {}'.format(self.path))
+            return
+        # released and acquired again, or refreshed, since it was seen stale: the lock is put back,
+        # unless yet another worker created the lock in the meantime (a link never replaces a file)
+        try:
+            os.link(broken, self.path)
+        except OSError:
+            LOGGER.warning('lock {} was acquired again while a live lock was broken'.format(self.path))
+        os.remove(broken)
+
+    def _heartbeat(self, stop):
+        while not stop.wait(self.stale / 3.):
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                LOGGER.exception('failed to refresh lock {}'.format(self.path))
+
+    def acquire(self):
+        """
+        waits for the lock and acquires it
+
+        :raises LockTimeout: if the lock is not acquired within ``timeout`` seconds
+        """
+        start = time.time()
+        seen, since = None, start
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+            else:
+                os.write(fd, self.owner.encode('utf-8'))
+                os.close(fd)
+                self._stop = threading.Event()
+                heartbeat = threading.Thread(target=self._heartbeat, args=(self._stop,))
+                heartbeat.daemon = True
+                heartbeat.start()
+                return
+
+            now = time.time()
+            try:
+                state = self._state()
+            except OSError:
+                # released in the meantime
+                continue
+            if state != seen:
+                seen, since = state, now
+            if self._dead(state[1]) or now - since > self.stale:
+                self._break(state)
+                continue
+            if self.timeout is not None and now - start > self.timeout:
+                raise LockTimeout('failed to acquire lock {} within {} seconds'.format(self.path, self.timeout))
+            time.sleep(self.poll)
+
+    def release(self):
+        """
+        releases the lock
+        """
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+        if self._read() == self.owner:
+            os.remove(self.path)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+Staged producer/consumer pipeline overlapping the processing steps of several items.
+
+Each stage runs on its own threads and hands its results to the next stage through a bounded queue,
+so item N is computed while item N+1 is still downloading. The latency of many items approaches the
+time of the slowest stage instead of the sum of all stages. An item failing in one stage skips the
+remaining stages and is reported with its error.
+
+Example usage::
+
+    from kingfisher.pipeline import Pipeline
+    pipeline = Pipeline([('download', download, 2), ('extract', extract, 1), ('compute', compute, 4)])
+    for i, result, error in pipeline.run(keys):
+        ...
+"""
+
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+# marks the end of the items in a queue
+_DONE = object()
+
+
+class Pipeline(object):
+    """Runs items through a sequence of stages, each with its own number of threads."""
+
+    def __init__(self, stages, maxsize=2):
+        """
+        :param stages: list of (name, func, threads) tuples. ``func`` gets the result of the previous stage
+                       (the item itself for the first stage) and returns its result for the next stage.
+        :param maxsize: number of items waiting in front of each stage, bounding the work in progress
+        """
+        self.stages = [(name, func, max(1, threads)) for name, func, threads in stages]
+        self.maxsize = maxsize
+
+    def _work(self, stage, inbox, outbox, finished, lock):
+        name, func, threads = self.stages[stage]
+        while True:
+            task = inbox.get()
+            if task is _DONE:
+                break
+            i, value, error = task
+            if error is None:
+                try:
+                    value = func(value)
+                except Exception as ex:
+                    LOGGER.exception('{} failed for item {}'.format(name, i))
+                    value, error = None, '{} failed: {}'.format(name, ex)
+            outbox.put((i, value, error))
+        # the last thread of a stage closes the queue of the next stage
+        with lock:
+            finished[stage] += 1
+            last = finished[stage] == threads
+        if last:
+            following = self.stages[stage + 1][2] if stage + 1 < len(self.stages) else 1
+            for _ in range(following):
+                outbox.put(_DONE)
+
+    def _feed(self, items, inbox):
+        for i, item in enumerate(items):
+            inbox.put((i, item, None))
+        for _ in range(self.stages[0][2]):
+            inbox.put(_DONE)
+
+    def run(self, items):
+        """
+        runs items through all stages
+
+        :param items: iterable of items for the first stage
+
+        :return generator: (index of the item, result of the last stage, error message or None) tuples
+                           in the order the items complete
+        """
+        queues = [Queue(self.maxsize) for _ in self.stages] + [Queue()]
+        finished = [0] * len(self.stages)
+        lock = threading.Lock()
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]))]
+        for stage, (name, _, count) in enumerate(self.stages):
+            for _ in range(count):
+                threads.append(threading.Thread(target=self._work,
+                                                args=(stage, queues[stage], queues[stage + 1], finished, lock)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        while True:
+            task = queues[-1].get()
+            if task is _DONE:
+                break
+            yield task
+        for thread in threads:
+            thread.join()
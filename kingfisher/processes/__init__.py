@@ -2,6 +2,7 @@ from .wps_say_hello import SayHello
 # from .wps_COP_search import COP_searchProcess
 # from .wps_COP_fetch import COP_fetchProcess
 # from .wps_COP_indices import COP_indicesProcess
+# from .wps_COP_composite import COP_compositeProcess
 
 
 processes = [
@@ -9,4 +10,5 @@ processes = [
     # COP_searchProcess(),
     # COP_fetchProcess(),
     # COP_indicesProcess(),
+    # COP_compositeProcess(),
 ]
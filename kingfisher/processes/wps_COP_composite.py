@@ -0,0 +1,277 @@
+import logging
+from datetime import datetime as dt
+from datetime import date, timedelta, time
+from os.path import join
+
+from pywps import Format
+from pywps import LiteralInput, ComplexOutput
+from pywps import Process
+from pywps.app.Common import Metadata
+from sentinelsat import SentinelAPI, geojson_to_wkt
+
+from eggshell.utils import archive
+
+from kingfisher import eodata
+from kingfisher.cache import QueryCache
+from kingfisher.config import get_option
+from kingfisher.indices import INDICES, get_index
+from kingfisher.processes.wps_COP_indices import compute_products
+
+import kingfisher
+from eggshell.config import Paths
+from eggshell.log import init_process_logger
+
+LOGGER = logging.getLogger("PYWPS")
+
+
+class COP_compositeProcess(Process):
+    def __init__(self):
+        inputs = [
+            LiteralInput("index", "Earth Observation Product Indice",
+                         abstract="Index computed for every acquisition of the period and composited per tile.",
+                         default='NDVI',
+                         data_type='string',
+                         min_occurs=1,
+                         max_occurs=1,
+                         allowed_values=list(INDICES.keys())
+                         ),
+
+            LiteralInput('reducer', 'Reducer',
+                         abstract="Reduction of the dated index values of a pixel: max (e.g. max-NDVI composites),"
+                                  " min, mean, count of valid values, median approximated from a histogram"
+                                  " or median_exact.",
+                         default='max',
+                         data_type='string',
+                         min_occurs=0,
+                         max_occurs=1,
+                         allowed_values=eodata.REDUCERS
+                         ),
+
+            LiteralInput('output_format', 'Output Format',
+                         abstract="Format of the composite files. COG writes Cloud-Optimized GeoTIFFs"
+                                  " (internally tiled, with overviews), GTiff plain striped GeoTIFFs.",
+                         default='COG',
+                         data_type='string',
+                         min_occurs=0,
+                         max_occurs=1,
+                         allowed_values=eodata.OUTPUT_FORMATS
+                         ),
+
+            LiteralInput('compression', 'Compression',
+                         abstract="Compression of the composite files.",
+                         default='DEFLATE',
+                         data_type='string',
+                         min_occurs=0,
+                         max_occurs=1,
+                         allowed_values=eodata.COMPRESSIONS
+                         ),
+
+            LiteralInput('resolution', 'Resolution',
+                         abstract="Resolution in meter of the composite files. Bands of other resolutions are"
+                                  " resampled. If not set, the finest resolution of the bands needed by the index"
+                                  " is used.",
+                         data_type='integer',
+                         min_occurs=0,
+                         max_occurs=1,
+                         allowed_values=[10, 20, 60]
+                         ),
+
+            LiteralInput('BBox', 'Bounding Box',
+                         data_type='string',
+                         abstract="Enter a bbox: min_lon, max_lon, min_lat, max_lat."
+                                  " min_lon=Western longitude,"
+                                  " max_lon=Eastern longitude,"
+                                  " min_lat=Southern or northern latitude,"
+                                  " max_lat=Northern or southern latitude."
+                                  " For example: -80,50,20,70",
+                         min_occurs=1,
+                         max_occurs=1,
+                         default='14,15,8,9',
+                         ),
+
+            LiteralInput('start', 'Start Date',
+                         data_type='date',
+                         abstract='First day of the period to be composited.'
+                                  '(if not set, 90 days befor end of period will be selected',
+                         default=(dt.now() - timedelta(days=90)).strftime('%Y-%m-%d'),
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+
+            LiteralInput('end', 'End Date',
+                         data_type='date',
+                         abstract='Last day of the period to be composited.'
+                                  '(if not set, current day is set.)',
+                         default=dt.now().strftime('%Y-%m-%d'),
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+
+            LiteralInput('cloud_cover', 'Cloud Cover',
+                         data_type='integer',
+                         abstract='Max tollerated percentage of cloud cover',
+                         default="30",
+                         allowed_values=[0, 10, 20, 30, 40, 50, 60, 70, 80, 100]
+                         ),
+
+            LiteralInput('username', 'User Name',
+                         data_type='string',
+                         abstract='Authentification user name for the COPERNICUS Sci-hub ',
+                         min_occurs=1,
+                         max_occurs=1,
+                         ),
+
+            LiteralInput('password', 'Password',
+                         data_type='string',
+                         abstract='Authentification password for the COPERNICUS Sci-hub ',
+                         min_occurs=1,
+                         max_occurs=1,
+                         ),
+        ]
+
+        outputs = [
+            ComplexOutput("output_plot", "Composite example file",
+                          abstract="Plot of a composite",
+                          supported_formats=[Format('image/png')],
+                          as_reference=True,
+                          ),
+
+            ComplexOutput("output_archive", "Tar archive",
+                          abstract="Tar archive of the composites and their plots",
+                          supported_formats=[Format("application/x-tar")],
+                          as_reference=True,
+                          ),
+
+            ComplexOutput("output_log", "Logging information",
+                          abstract="Collected logs during process run.",
+                          supported_formats=[Format("text/plain")],
+                          as_reference=True,
+                          )
+        ]
+
+        super(COP_compositeProcess, self).__init__(
+            self._handler,
+            identifier="COPERNICUS_composite",
+            title="EO composites",
+            version="0.1",
+            abstract="Composites of an index over a period (e.g. max-NDVI or median), one per Sentinel2 tile",
+            metadata=[
+                Metadata('Documentation', 'http://kingfisher.readthedocs.io/en/latest/'),
+            ],
+            inputs=inputs,
+            outputs=outputs,
+            status_supported=True,
+            store_supported=True,
+        )
+
+    def _handler(self, request, response):
+        response.update_status("start fetching resource", 10)
+
+        init_process_logger('log.txt')
+        response.outputs['output_log'].file = 'log.txt'
+
+        indice = request.inputs['index'][0].data
+        reducer = request.inputs['reducer'][0].data if 'reducer' in request.inputs else 'max'
+
+        bbox = []  # order xmin ymin xmax ymax
+        bboxStr = request.inputs['BBox'][0].data
+        bboxStr = bboxStr.split(',')
+        bbox.append(float(bboxStr[0]))
+        bbox.append(float(bboxStr[2]))
+        bbox.append(float(bboxStr[1]))
+        bbox.append(float(bboxStr[3]))
+
+        # the dated index files are cut to the bbox, so all files of a tile share the same grid
+        options = {'bbox': bbox}
+        if 'resolution' in request.inputs:
+            options['resolution'] = request.inputs['resolution'][0].data
+        # part of the derived cache key, so it is resolved here and not by get_indices
+        options['cloud_mask'] = get_option('cloud_mask', True)
+        composite_options = {}
+        if 'output_format' in request.inputs:
+            composite_options['output_format'] = request.inputs['output_format'][0].data
+        if 'compression' in request.inputs:
+            composite_options['compress'] = request.inputs['compression'][0].data
+
+        if 'end' in request.inputs:
+            end = request.inputs['end'][0].data
+            end = dt.combine(end, time(23, 59, 59))
+        else:
+            # the end of today, so the query is the same all day long and its cached result is reused
+            end = dt.combine(date.today(), time(23, 59, 59))
+
+        if 'start' in request.inputs:
+            start = request.inputs['start'][0].data
+            start = dt.combine(start, time(0, 0, 0))
+        else:
+            start = end - timedelta(days=90)
+
+        if start > end:
+            end = dt.combine(date.today(), time(23, 59, 59))
+            start = end - timedelta(days=90)
+            LOGGER.exception('period ends before period starts; period now set to the last 90 days from now')
+
+        username = request.inputs['username'][0].data
+        password = request.inputs['password'][0].data
+        cloud_cover = request.inputs['cloud_cover'][0].data
+
+        api = SentinelAPI(username, password)
+
+        geom = {
+            "type": "Polygon",
+            "coordinates": [[[bbox[0], bbox[1]],
+                             [bbox[2], bbox[1]],
+                             [bbox[2], bbox[3]],
+                             [bbox[0], bbox[3]],
+                             [bbox[0], bbox[1]]]]}
+
+        footprint = geojson_to_wkt(geom)
+
+        response.update_status('start searching tiles according to query', 15)
+
+        cache = QueryCache(join(Paths(kingfisher).cache, 'queries.sqlite'),
+                           ttl=get_option('query_cache_ttl', 3600, int),
+                           max_entries=get_option('query_cache_size', 256, int))
+        products = cache.query(api, footprint,
+                               date=(start, end),
+                               platformname='Sentinel-2',
+                               cloudcoverpercentage=(0, cloud_cover),
+                               )
+
+        LOGGER.debug('{} products found'.format(len(products.keys())))
+
+        # the dated index files are computed the same way as by the indices process and cached with them,
+        # only the compressed GeoTIFFs (no COG overviews) and no plots are needed for the composite
+        options.update(output_format='GTiff')
+        tiles, _, failed = compute_products(api, products, [indice], options, response, quicklooks=False)
+
+        if failed:
+            LOGGER.warning('{} of {} products failed:\n{}'.format(len(failed), len(products), '\n'.join(failed)))
+        dated = [tile for _, tile, _ in tiles]
+        if not dated:
+            msg = 'no {} calculated: {}'.format(indice, '; '.join(failed) or 'no products found')
+            LOGGER.error(msg)
+            raise Exception(msg)
+
+        # one composite per tile, acquisitions of other tiles do not share the grid
+        stacks = eodata.group_by_tile(dated)
+        colorscheme = get_index(indice).colorscheme if reducer != 'count' else None
+        files = []
+        for n, (tile, rasters) in enumerate(stacks.items()):
+            response.update_status('{} composite of {} acquisitions of tile {}'.format(reducer, len(rasters), tile),
+                                   80 + 15 * n // len(stacks))
+            try:
+                composite = eodata.composite(rasters, reducer=reducer,
+                                             prefix='{}_{}_{}_'.format(indice, reducer, tile),
+                                             value_range=get_index(indice).value_range, **composite_options)
+                files.extend([composite, eodata.quicklook(composite, colorscheme=colorscheme)])
+            except Exception as ex:
+                msg = 'failed to composite {} of tile {}: {}'.format(indice, tile, str(ex))
+                LOGGER.exception(msg)
+                raise Exception(msg)
+
+        response.outputs['output_archive'].file = archive(files)
+        response.outputs['output_plot'].file = files[1]
+
+        response.update_status("done", 100)
+        return response
@@ -5,10 +5,9 @@ from pywps import Format, FORMATS
 from pywps.app.Common import Metadata
 
 import logging
-import zipfile
 
 from datetime import datetime as dt
-from datetime import timedelta, time
+from datetime import date, timedelta, time
 from os import makedirs
 from os.path import exists, join
 from tempfile import mkstemp
@@ -16,6 +15,12 @@ from tempfile import mkstemp
 from sentinelsat import SentinelAPI, geojson_to_wkt
 
 import kingfisher
+from kingfisher import eodata
+from kingfisher.cache import CacheManager, QueryCache
+from kingfisher.catalog import Catalog, parse_size
+from kingfisher.config import get_option
+from kingfisher.download import DownloadManager
+from kingfisher.indices import INDICES, required_bands
 from eggshell.config import Paths
 from eggshell.log import init_process_logger
 from eggshell.utils import rename_complexinputs
@@ -40,6 +45,15 @@ class COP_fetchProcess(Process):
                          allowed_values=['Sentinel-2']
                          ),
 
+            LiteralInput("indices", "Earth Observation Product Indice",
+                         abstract="Indices the products are fetched for. Only the bands needed by"
+                                  " these indices are extracted. If not set, the whole products are extracted.",
+                         data_type='string',
+                         min_occurs=0,
+                         max_occurs=len(INDICES),
+                         allowed_values=list(INDICES.keys())
+                         ),
+
             LiteralInput('BBox', 'Bounding Box',
                          data_type='string',
                          abstract="Bounding box coordinates: min_lon, max_lon, min_lat, max_lat."
@@ -140,6 +154,11 @@ class COP_fetchProcess(Process):
 
         products = [inpt.data for inpt in request.inputs['products']]
 
+        if 'indices' in request.inputs:
+            bands = required_bands([inpt.data for inpt in request.inputs['indices']])
+        else:
+            bands = None
+
         bbox = []  # order xmin ymin xmax ymax
         bboxStr = request.inputs['BBox'][0].data
         bboxStr = bboxStr.split(',')
@@ -152,7 +171,8 @@ class COP_fetchProcess(Process):
             end = request.inputs['end'][0].data
             end = dt.combine(end, time(23, 59, 59))
         else:
-            end = dt.now()
+            # the end of today, so the query is the same all day long and its cached result is reused
+            end = dt.combine(date.today(), time(23, 59, 59))
 
         if 'start' in request.inputs:
             start = request.inputs['start'][0].data
@@ -161,8 +181,8 @@ class COP_fetchProcess(Process):
             start = end - timedelta(days=30)
 
         if (start > end):
-            start = dt.now() - timedelta(days=30)
-            end = dt.now()
+            end = dt.combine(date.today(), time(23, 59, 59))
+            start = end - timedelta(days=30)
             LOGGER.exception('period ends before period starts; period now set to the last 30 days from now')
 
         username = request.inputs['username'][0].data
@@ -183,13 +203,16 @@ class COP_fetchProcess(Process):
 
         response.update_status("start searching tiles according to query", 15)
 
-        products = api.query(footprint,
-                             date=(start, end),
-                             platformname='Sentinel-2',
-                             cloudcoverpercentage=(0, cloud_cover),
-                             # producttype='SLC',
-                             # orbitdirection='ASCENDING',
-                             )
+        cache = QueryCache(join(Paths(kingfisher).cache, 'queries.sqlite'),
+                           ttl=get_option('query_cache_ttl', 3600, int),
+                           max_entries=get_option('query_cache_size', 256, int))
+        products = cache.query(api, footprint,
+                               date=(start, end),
+                               platformname='Sentinel-2',
+                               cloudcoverpercentage=(0, cloud_cover),
+                               # producttype='SLC',
+                               # orbitdirection='ASCENDING',
+                               )
 
         try:
             DIR_EO = join(Paths(kingfisher).cache, 'eo-data')
@@ -200,67 +223,85 @@ class COP_fetchProcess(Process):
         if not exists(DIR_EO):
             makedirs(DIR_EO)
 
-        # api.download_all(products)
-        _, filepaths = mkstemp(dir='.', suffix='.txt')
+        # without extraction the bands are read straight from the zip archives
+        extract = get_option('extract', True)
+
+        catalog = Catalog(join(DIR_EO, 'catalog.sqlite'))
+
+        # products of this job are pinned, least recently used other products are evicted beyond the budget
+        cache_manager = CacheManager(catalog, budget=get_option('cache_budget', 0, parse_size),
+                                     lockfile=join(DIR_EO, 'cache.lock'))
+        owner = cache_manager.pin(str(products[key]['identifier']) for key in products.keys())
         try:
-            with open(filepaths, 'w') as fp:
-                fp.write('############################################\n')
-                fp.write('###     Following files are fetched      ###\n')
-                fp.write('############################################\n')
-                fp.write('\n')
-                for key in products.keys():
-                    try:
-
-                        filename = products[key]['filename']
-                        # TODO: form unused
-                        # form = products[key]['format']
-                        response.update_status("fetch file {}".format(filename), 20)
-                        ID = str(products[key]['identifier'])
-                        file_zip = join(DIR_EO, '{}.zip'.format(ID))
-                        DIR_tile = join(DIR_EO, str(filename))
-
-                        if exists(file_zip):
-                            LOGGER.debug('file {}.zip already fetched'.format(ID))
-                        else:
-                            try:
-                                api.download(key, directory_path=DIR_EO)
-                                # Does the '***' denote a string formatting function?
-                                response.update_status("***%s sucessfully fetched" % ID, 20)
-                                LOGGER.debug('Tile {} fetched'.format(ID))
-                            except Exception as ex:
-                                msg = 'failed to extract file {}: {}'.format(filename, str(ex))
-                                LOGGER.exception(msg)
-                                raise Exception(msg)
-
-                        if exists(DIR_tile):
-                            LOGGER.debug('file {} already unzipped'.format(filename))
-                        else:
-                            try:
-                                # zipfile = join(DIR_EO, '%szip' % (filename)).strip(form)
-                                zip_ref = zipfile.ZipFile(file_zip, 'r')
-                                zip_ref.extractall(DIR_EO)
-                                zip_ref.close()
-                                LOGGER.debug('Tile {} unzipped'.format(ID))
-                            except Exception as ex:
-                                msg = 'failed to extract {}: {}'.format(file_zip, str(ex))
-                                LOGGER.exception(msg)
-                                raise Exception(msg)
-
-                    except Exception as ex:
-                        msg = 'failed to fetch {}: {}'.format(filename, str(ex))
-                        LOGGER.exception(msg)
-                        raise Exception(msg)
-
-                    response.update_status("write out information about files", 80)
-                    size = float(products[key]['size'].split(' ')[0])
-                    producttype = products[key]['producttype']
-                    beginposition = str(products[key]['beginposition'])
-                    fp.write('{} \t {} \t {} \t {} \t {} \n'.format(ID, size, producttype, beginposition, key))
-            response.outputs['output_txt'].file = filepaths
-        except Exception as ex:
-            msg = 'failed to fetch resource: {}'.format(str(ex))
-            LOGGER.exception(msg)
-            raise Exception(msg)
+            missing = [key for key in products.keys()
+                       if not exists(join(DIR_EO, '{}.zip'.format(products[key]['identifier'])))]
+            cache_manager.evict(reserve=sum(parse_size(products[key]['size']) for key in missing))
+
+            def progress(done, total):
+                response.update_status('{:.0f} of {:.0f} MB fetched'.format(done / 1024. ** 2, total / 1024. ** 2),
+                                       20 + 55 * done // max(total, 1))
+
+            # products are downloaded concurrently, partial downloads are resumed
+            downloads = DownloadManager(api, DIR_EO, workers=get_option('download_workers', 2, int), progress=progress)
+            _, failed = downloads.download_all(missing)
+
+            _, filepaths = mkstemp(dir='.', suffix='.txt')
+            try:
+                with open(filepaths, 'w') as fp:
+                    fp.write('############################################\n')
+                    fp.write('###     Following files are fetched      ###\n')
+                    fp.write('############################################\n')
+                    fp.write('\n')
+                    for key in products.keys():
+                        try:
+
+                            filename = products[key]['filename']
+                            # TODO: form unused
+                            # form = products[key]['format']
+                            ID = str(products[key]['identifier'])
+                            file_zip = join(DIR_EO, '{}.zip'.format(ID))
+
+                            if key in failed:
+                                raise Exception(failed[key])
+                            LOGGER.debug('Tile {} fetched'.format(ID))
+                            catalog.add_from_query(key, products[key], zip_path=file_zip)
+
+                            if not extract:
+                                LOGGER.debug('file {}.zip is not extracted'.format(ID))
+                            else:
+                                try:
+                                    # already extracted members are kept
+                                    DIR_tile = eodata.extract(file_zip, DIR_EO, bands=bands)
+                                    catalog.add_product(ID, safe_path=DIR_tile)
+                                    LOGGER.debug('Tile {} unzipped'.format(ID))
+                                except Exception as ex:
+                                    msg = 'failed to extract {}: {}'.format(file_zip, str(ex))
+                                    LOGGER.exception(msg)
+                                    raise Exception(msg)
+
+                        except Exception as ex:
+                            msg = 'failed to fetch {}: {}'.format(filename, str(ex))
+                            LOGGER.exception(msg)
+                            raise Exception(msg)
+
+                        response.update_status("write out information about files", 80)
+                        size = float(products[key]['size'].split(' ')[0])
+                        producttype = products[key]['producttype']
+                        beginposition = str(products[key]['beginposition'])
+                        fp.write('{} \t {} \t {} \t {} \t {} \n'.format(ID, size, producttype, beginposition, key))
+
+                    inventory = catalog.inventory()
+                    fp.write('\n')
+                    fp.write('cache: {products} products, {zips} zip archives ({size} bytes), '
+                             '{extracted} extracted, {derived} derived products\n'.format(**inventory))
+                response.outputs['output_txt'].file = filepaths
+            except Exception as ex:
+                msg = 'failed to fetch resource: {}'.format(str(ex))
+                LOGGER.exception(msg)
+                raise Exception(msg)
+        finally:
+            cache_manager.unpin(owner)
+        cache_manager.evict()
 
         # response.outputs['output'].file = filepaths
         try:
@@ -1,13 +1,16 @@
+import json
 import logging
-import zipfile
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
 from datetime import datetime as dt
-from datetime import timedelta, time
-from os import makedirs
-from os.path import exists, join
+from datetime import date, timedelta, time
+from os import makedirs, remove
+from os.path import basename, exists, join, normpath
 
 from pywps import Format
 # from pywps import LiteralInput
-from pywps import LiteralInput, ComplexOutput
+from pywps import ComplexInput, LiteralInput, ComplexOutput
 from pywps import Process
 from pywps.app.Common import Metadata
 from sentinelsat import SentinelAPI, geojson_to_wkt
@@ -15,25 +18,294 @@ from sentinelsat import SentinelAPI, geojson_to_wkt
 from eggshell.utils import rename_complexinputs, archive
 
 from kingfisher import eodata
+from kingfisher.cache import CacheManager, DerivedCache, QueryCache
+from kingfisher.catalog import Catalog, parse_size
+from kingfisher.config import get_option
+from kingfisher.download import DownloadManager
+from kingfisher.indices import INDICES, get_index, required_bands
+from kingfisher.pipeline import Pipeline
+from kingfisher.stats import sidecar_path
+from kingfisher.zonal import ZonalStatistics, to_csv, to_json
 
 import kingfisher
 from eggshell.config import Paths
 from eggshell.log import init_process_logger
-from eggshell.visual import vs_eodata
 
 LOGGER = logging.getLogger("PYWPS")
 
 
+def compute_tile(args):
+    """
+    computes and plots the indices of one tile.
+    Runs in a worker process; failures are returned instead of raised
+    to keep the other tiles of a request alive.
+    Indices computed before with the same options are taken from the derived cache.
+
+    :param args: tuple of the resource (path of the Sentinel2 directory tree), the list of indices,
+                 a dict of options passed to :func:`kingfisher.eodata.get_indices`,
+                 the eo-data directory holding the derived cache (None to compute all indices),
+                 GeoJSON features of zones to compute the zonal statistics of (or None),
+                 whether to write the index files and whether to plot them
+
+    :return tuple: resource, list of (indice, tile, image) tuples (image None without plot),
+                   list of zonal statistics, (hits, misses) of the derived cache and the error message or None
+    """
+    resource, indices, options, DIR_EO, zones, write, quicklooks = args
+    try:
+        product_id = basename(normpath(resource)).split('.')[0]
+        zonal = ZonalStatistics(zones, indices) if zones else None
+        files = OrderedDict((indice, None) for indice in indices)
+        derived = None
+        if DIR_EO is not None:
+            derived = DerivedCache(join(DIR_EO, 'derived'), catalog=Catalog(join(DIR_EO, 'catalog.sqlite')))
+            for indice in indices:
+                files[indice] = derived.get(product_id, indice, **options)
+                if zonal is not None and files[indice] is not None:
+                    zonal.add_raster(indice, files[indice])
+        missing = [indice for indice, tile in files.items() if tile is None]
+        if missing:
+            LOGGER.debug('Calculate {} for {}'.format(', '.join(missing), resource))
+            # the zonal statistics are accumulated while the indices are computed
+            files.update(eodata.get_indices(resource, missing, accumulators=[zonal] if zonal else None,
+                                            write=write, **options))
+            LOGGER.debug('resources {} calculated'.format(', '.join(missing)))
+            if DIR_EO is not None and write:
+                for indice in missing:
+                    derived.put(product_id, indice, files[indice], **options)
+        results = []
+        for indice, tile in files.items():
+            if tile is None:
+                continue
+            if not write:
+                # without write, cache hits only feed the zonal statistics, their links are dropped
+                for filename in (tile, sidecar_path(tile)):
+                    if exists(filename):
+                        remove(filename)
+                continue
+            img = None
+            if quicklooks:
+                LOGGER.debug('Plot tile {}'.format(tile))
+                img = eodata.quicklook(tile, colorscheme=get_index(indice).colorscheme)
+            results.append((indice, tile, img))
+        stats = zonal.rows(product=product_id) if zonal is not None else []
+        cache_stats = (derived.hits, derived.misses) if derived is not None else (0, 0)
+        return resource, results, stats, cache_stats, None
+    except Exception as ex:
+        msg = 'failed to calculate indice for {}: {}'.format(resource, str(ex))
+        LOGGER.exception(msg)
+        return resource, [], [], (0, 0), msg
+
+
+def compute_products(api, products, indices, options, response, zones=None, write=True, quicklooks=True):
+    """
+    downloads, extracts and computes the indices of scihub products in a pipeline.
+    Tile N is computed while tile N+1 is downloaded and extracted. Products are recorded in the catalog,
+    pinned in the eo-data cache while the job runs and taken from the derived cache when their indices
+    were computed before with the same options.
+
+    :param api: SentinelAPI
+    :param products: products of a scihub query
+    :param indices: list of indices
+    :param options: dict of options passed to :func:`kingfisher.eodata.get_indices`
+    :param response: WPS response the progress is reported to
+    :param zones: GeoJSON features of zones to compute the zonal statistics of (or None)
+    :param write: write the index files
+    :param quicklooks: plot the index files
+
+    :return tuple: list of (indice, tile, image) tuples in the order of the products,
+                   list of zonal statistics and list of error messages of failed products
+    """
+    try:
+        DIR_EO = join(Paths(kingfisher).cache, 'eo-data')
+    except Exception:
+        LOGGER.exception("failed to define DIR_EO")
+        DIR_EO = '~/eo-data'
+
+    if not exists(DIR_EO):
+        makedirs(DIR_EO)
+
+    # without extraction the bands are read straight from the zip archives
+    extract = get_option('extract', True)
+
+    catalog = Catalog(join(DIR_EO, 'catalog.sqlite'))
+
+    # derived products are cached, outdated kernel versions are discarded first
+    derived = None
+    if get_option('derived_cache', True):
+        derived = DerivedCache(join(DIR_EO, 'derived'), catalog=catalog)
+        derived.purge()
+
+    # products of this job are pinned, least recently used other products are evicted beyond the budget
+    cache_manager = CacheManager(catalog, budget=get_option('cache_budget', 0, parse_size),
+                                 lockfile=join(DIR_EO, 'cache.lock'))
+    owner = cache_manager.pin(str(products[key]['identifier']) for key in products.keys())
+    try:
+        # products whose indices are all cached are neither downloaded nor extracted.
+        # Looked up after pinning, so other jobs cannot evict them in between.
+        cached = [key for key in products.keys()
+                  if derived is not None and all(derived.contains(str(products[key]['identifier']), indice,
+                                                                  **options) for indice in indices)]
+        missing = [key for key in products.keys()
+                   if key not in cached and not exists(join(DIR_EO, '{}.zip'.format(products[key]['identifier'])))]
+        cache_manager.evict(reserve=sum(parse_size(products[key]['size']) for key in missing))
+
+        keys = list(products.keys())
+        status = {'fetched': 0, 'total': 0, 'tiles': 0}
+        status_lock = threading.Lock()
+
+        def report():
+            with status_lock:
+                fetched = float(status['fetched']) / status['total'] if status['total'] else 1.
+                response.update_status('{:.0f} of {:.0f} MB fetched, {} calculated for {} of {} tiles'.format(
+                    status['fetched'] / 1024. ** 2, status['total'] / 1024. ** 2, ', '.join(indices),
+                    status['tiles'], len(keys)), 20 + int(20 * fetched + 40 * status['tiles'] / max(len(keys), 1)))
+
+        def progress(done, total):
+            status.update(fetched=done, total=total)
+            report()
+
+        # products are downloaded concurrently, partial downloads are resumed
+        downloads = DownloadManager(api, DIR_EO, progress=progress,
+                                    total=sum(parse_size(products[key]['size']) for key in missing))
+
+        def fetch(key):
+            if key in missing:
+                downloads.download(api.get_product_odata(key))
+                LOGGER.debug('Tile {} fetched'.format(products[key]['identifier']))
+            if key not in cached:
+                catalog.add_from_query(key, products[key],
+                                       zip_path=join(DIR_EO, '{}.zip'.format(products[key]['identifier'])))
+            return key
+
+        def unpack(key):
+            ID = str(products[key]['identifier'])
+            file_zip = join(DIR_EO, '{}.zip'.format(ID))
+            DIR_tile = join(DIR_EO, str(products[key]['filename']))
+            if key in cached:
+                LOGGER.debug('{} of {} are cached'.format(', '.join(indices), ID))
+            elif not extract:
+                LOGGER.debug('bands of {} are read from {}'.format(ID, file_zip))
+            else:
+                # only the bands of the requested indices, already extracted members are kept
+                eodata.extract(file_zip, DIR_EO, bands=required_bands(indices))
+                catalog.add_product(ID, safe_path=DIR_tile)
+                LOGGER.debug('Tile {} unzipped'.format(ID))
+            return DIR_tile if extract else file_zip
+
+        workers = max(1, min(get_option('tile_workers', 1, int), len(keys)))
+        pool = Pool(workers) if workers > 1 else None
+
+        def compute(resource):
+            job = (resource, indices, options, DIR_EO if derived is not None else None, zones, write, quicklooks)
+            return pool.apply(compute_tile, (job,)) if pool is not None else compute_tile(job)
+
+        pipeline = Pipeline([('download', fetch, get_option('download_workers', 2, int)),
+                             ('extract', unpack, get_option('extract_workers', 1, int)),
+                             ('compute', compute, workers)])
+        response.update_status('Calculating {} for {} tiles with {} workers'.format(
+            ', '.join(indices), len(keys), workers), 20)
+
+        results = {}
+        stats = []
+        failed = []
+        hits = misses = 0
+        try:
+            for i, result, error in pipeline.run(keys):
+                tiles = []
+                if error is None:
+                    _, tiles, tile_stats, (tile_hits, tile_misses), error = result
+                    stats.extend(tile_stats)
+                    hits += tile_hits
+                    misses += tile_misses
+                else:
+                    error = 'failed to process {}: {}'.format(products[keys[i]]['identifier'], error)
+                if error:
+                    failed.append(error)
+                results[i] = tiles
+                with status_lock:
+                    status['tiles'] += 1
+                report()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    finally:
+        cache_manager.unpin(owner)
+    cache_manager.evict()
+    if derived is not None:
+        # the hits of other jobs are in the counters of the cache
+        LOGGER.info('derived cache: {} hits, {} misses, hit rate {:.0%} of this job, {hit_rate:.0%} overall'.format(
+            hits, misses, float(hits) / max(hits + misses, 1), **derived.stats()))
+
+    # the outputs keep the order of the products, whatever tile finishes first
+    return [tile for i in sorted(results) for tile in results[i]], stats, failed
+
+
 class COP_indicesProcess(Process):
     def __init__(self):
         inputs = [
             LiteralInput("indices", "Earth Observation Product Indice",
-                         abstract="Choose an indice based on Earth Observation Data",
+                         abstract="Choose one or several indices based on Earth Observation Data."
+                                  " All chosen indices are computed in one pass over the bands.",
                          default='NDVI',
                          data_type='string',
                          min_occurs=1,
+                         max_occurs=len(INDICES),
+                         allowed_values=list(INDICES.keys())
+                         ),
+
+            LiteralInput('output_format', 'Output Format',
+                         abstract="Format of the index files. COG writes Cloud-Optimized GeoTIFFs"
+                                  " (internally tiled, with overviews), GTiff plain striped GeoTIFFs.",
+                         default='COG',
+                         data_type='string',
+                         min_occurs=0,
+                         max_occurs=1,
+                         allowed_values=eodata.OUTPUT_FORMATS
+                         ),
+
+            LiteralInput('compression', 'Compression',
+                         abstract="Compression of the index files.",
+                         default='DEFLATE',
+                         data_type='string',
+                         min_occurs=0,
+                         max_occurs=1,
+                         allowed_values=eodata.COMPRESSIONS
+                         ),
+
+            LiteralInput('resolution', 'Resolution',
+                         abstract="Resolution in meter of the index files. Bands of other resolutions are resampled."
+                                  " If not set, the finest resolution of the bands needed by the indices is used.",
+                         data_type='integer',
+                         min_occurs=0,
+                         max_occurs=1,
+                         allowed_values=[10, 20, 60]
+                         ),
+
+            LiteralInput('daily_mosaics', 'Daily Mosaics',
+                         abstract="Mosaic the tiles of each index acquired on the same day"
+                                  " and plot the daily mosaics in addition to the tiles.",
+                         default='0',
+                         data_type='boolean',
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+
+            ComplexInput('zones', 'Zones',
+                         abstract="GeoJSON polygons (e.g. fields) to compute zonal statistics of the indices for:"
+                                  " count, mean, standard deviation, min, max, 10th, 50th and 90th percentile per"
+                                  " polygon and tile. The bounding box of the polygons replaces the BBox input.",
+                         supported_formats=[Format('application/geo+json')],
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+
+            LiteralInput('write_indices', 'Write Indices',
+                         abstract="Write and plot the index files. Without, only the zonal statistics are returned.",
+                         default='1',
+                         data_type='boolean',
+                         min_occurs=0,
                          max_occurs=1,
-                         allowed_values=['NDVI', 'BAI']
                          ),
 
             LiteralInput('BBox', 'Bounding Box',
@@ -109,6 +381,18 @@ class COP_indicesProcess(Process):
                           as_reference=True,
                           ),
 
+            ComplexOutput("output_zonal", "Zonal statistics",
+                          abstract="Statistics of the indices per zone and tile",
+                          supported_formats=[Format('application/json')],
+                          as_reference=True,
+                          ),
+
+            ComplexOutput("output_zonal_csv", "Zonal statistics as CSV",
+                          abstract="Statistics of the indices per zone and tile",
+                          supported_formats=[Format('text/csv')],
+                          as_reference=True,
+                          ),
+
             ComplexOutput("output_log", "Logging information",
                           abstract="Collected logs during process run.",
                           supported_formats=[Format("text/plain")],
@@ -137,9 +421,7 @@ class COP_indicesProcess(Process):
         init_process_logger('log.txt')
         response.outputs['output_log'].file = 'log.txt'
 
-        # products = [inpt.data for inpt in request.inputs['indices']]
-
-        indice = request.inputs['indices'][0].data
+        indices = [inpt.data for inpt in request.inputs['indices']]
 
         bbox = []  # order xmin ymin xmax ymax
         bboxStr = request.inputs['BBox'][0].data
@@ -149,11 +431,36 @@ class COP_indicesProcess(Process):
         bbox.append(float(bboxStr[1]))
         bbox.append(float(bboxStr[3]))
 
+        zones = None
+        if 'zones' in request.inputs:
+            with open(request.inputs['zones'][0].file) as fp:
+                geojson = json.load(fp)
+            zones = geojson.get('features', [geojson] if geojson.get('type') == 'Feature' else None)
+            if zones is None:
+                zones = [{'type': 'Feature', 'geometry': geojson, 'properties': {}}]
+            bbox = list(ZonalStatistics(zones, indices).bbox())
+            LOGGER.debug('zonal statistics of {} zones within {}'.format(len(zones), bbox))
+        write = request.inputs['write_indices'][0].data if 'write_indices' in request.inputs else True
+        if zones is None:
+            write = True
+
+        # only the part of the tiles inside the bbox is read and computed
+        options = {'bbox': bbox}
+        if 'output_format' in request.inputs:
+            options['output_format'] = request.inputs['output_format'][0].data
+        if 'compression' in request.inputs:
+            options['compress'] = request.inputs['compression'][0].data
+        if 'resolution' in request.inputs:
+            options['resolution'] = request.inputs['resolution'][0].data
+        # part of the derived cache key, so it is resolved here and not by get_indices
+        options['cloud_mask'] = get_option('cloud_mask', True)
+
         if 'end' in request.inputs:
             end = request.inputs['end'][0].data
             end = dt.combine(end, time(23, 59, 59))
         else:
-            end = dt.now()
+            # the end of today, so the query is the same all day long and its cached result is reused
+            end = dt.combine(date.today(), time(23, 59, 59))
 
         if 'start' in request.inputs:
             start = request.inputs['start'][0].data
@@ -162,8 +469,8 @@ class COP_indicesProcess(Process):
             start = end - timedelta(days=30)
 
         if start > end:
-            start = dt.now() - timedelta(days=30)
-            end = dt.now()
+            end = dt.combine(date.today(), time(23, 59, 59))
+            start = end - timedelta(days=30)
             LOGGER.exception('period ends before period starts; period now set to the last 30 days from now')
 
         username = request.inputs['username'][0].data
@@ -184,113 +491,59 @@ class COP_indicesProcess(Process):
 
         response.update_status('start searching tiles according to query', 15)
 
-        products = api.query(footprint,
-                             date=(start, end),
-                             platformname='Sentinel-2',
-                             cloudcoverpercentage=(0, cloud_cover),
-                             # producttype='SLC',
-                             # orbitdirection='ASCENDING',
-                             )
+        cache = QueryCache(join(Paths(kingfisher).cache, 'queries.sqlite'),
+                           ttl=get_option('query_cache_ttl', 3600, int),
+                           max_entries=get_option('query_cache_size', 256, int))
+        products = cache.query(api, footprint,
+                               date=(start, end),
+                               platformname='Sentinel-2',
+                               cloudcoverpercentage=(0, cloud_cover),
+                               # producttype='SLC',
+                               # orbitdirection='ASCENDING',
+                               )
 
         LOGGER.debug('{} products found'.format(len(products.keys())))
 
-        try:
-            DIR_EO = join(Paths(kingfisher).cache, 'eo-data')
-        except Exception:
-            LOGGER.exception("failed to define DIR_EO")
-            DIR_EO = '~/eo-data'
-
-        if not exists(DIR_EO):
-            makedirs(DIR_EO)
-
-        resources = []
-
-        for key in products.keys():
-            try:
-                filename = products[key]['filename']
-                # form = products[key]['format']
-                ID = str(products[key]['identifier'])
-                file_zip = join(DIR_EO, '{}.zip'.format(ID))
-                DIR_tile = join(DIR_EO, str(filename))
-                response.update_status('fetch file {}'.format(ID), 20)
-                LOGGER.debug('path: {}'.format(DIR_tile))
-                if exists(file_zip):
-                    LOGGER.debug('file %s.zip already fetched' % ID)
-                else:
-                    try:
-                        api.download(key, directory_path=DIR_EO)
-                        # Does the '***' denote a string formatting function?
-                        response.update_status("***%s sucessfully fetched" % ID, 20)
-                        # TODO: Figure out why these are duplicate
-                        LOGGER.debug('Tile {} fetched'.format(ID))
-                        LOGGER.debug('Files {} fetched'.format(ID))
-                    except Exception as ex:
-                        msg = 'failed to extract file {}: {}'.format(filename, str(ex))
-                        LOGGER.exception(msg)
-                        raise Exception(msg)
-
-                if exists(DIR_tile):
-                    LOGGER.debug('file {} already unzipped'.format(filename))
-                else:
-                    try:
-                        # zipfile = join(DIR_EO, '%szip' % (filename)).strip(form)
-                        zip_ref = zipfile.ZipFile(file_zip, 'r')
-                        zip_ref.extractall(DIR_EO)
-                        zip_ref.close()
-                        LOGGER.debug('Tile {} unzipped'.format(ID))
-                    except Exception:
-                        msg = 'failed to extract {}'.format(file_zip)
-                        LOGGER.exception(msg)
-                        raise Exception(msg)
-
-                resources.append(DIR_tile)
-            except Exception as ex:
-                msg = 'failed to fetch {}: {}'.format(key, str(ex))
-                LOGGER.exception(msg)
-                raise Exception(msg)
-
-        # TODO: Find a place for these variables or remove them
-        # size = float(products[key]['size'].split(' ')[0])
-        # producttype = products[key]['producttype']
-        # beginposition = str(products[key]['beginposition'])
+        tiles, stats, failed = compute_products(api, products, indices, options, response, zones=zones, write=write)
 
         imgs = []
-        tiles = []
-        for resource in resources:
-            try:
-                response.update_status('Calculating {} indices'.format(indice), 40)
-                if indice == 'NDVI':
-                    LOGGER.debug('Calculate NDVI for {}'.format(resource))
-                    tile = eodata.get_ndvi(resource)
-                    LOGGER.debug('resources BAI calculated')
-                if indice == 'BAI':
-                    LOGGER.debug('Calculate BAI for {}'.format(resource))
-                    tile = eodata.get_bai(resource)
-                    LOGGER.debug('resources BAI calculated')
-                tiles.append(tile)
-            except Exception as ex:
-                msg = 'failed to calculate indice for {}: {}'.format(resource, str(ex))
-                LOGGER.exception(msg)
-                raise Exception(msg)
-
-        for tile in tiles:
-            try:
-                LOGGER.debug('Plot tile {}'.format(tile))
-                img = vs_eodata.plot_band(tile, file_extension='PNG', colorscheem=indice)
-                imgs.append(img)
-            except Exception as ex:
-                msg = 'Failed to plot tile {}: {}'.format(tile, str(ex))
-                LOGGER.exception(msg)
-                raise Exception(msg)
-
-        tarf = archive(imgs)
+        index_tiles = OrderedDict((indice, []) for indice in indices)
+        for indice, tile, img in tiles:
+            index_tiles[indice].append(tile)
+            imgs.append(img)
+
+        if failed:
+            LOGGER.warning('{} of {} tiles failed:\n{}'.format(len(failed), len(products), '\n'.join(failed)))
+        if zones is not None:
+            response.update_status('write zonal statistics of {} zones'.format(len(zones)), 90)
+            to_json(stats, 'zonal.json')
+            to_csv(stats, 'zonal.csv')
+            response.outputs['output_zonal'].file = 'zonal.json'
+            response.outputs['output_zonal_csv'].file = 'zonal.csv'
+        if not imgs and not stats:
+            msg = 'no indices calculated: {}'.format('; '.join(failed) or 'no products found')
+            LOGGER.error(msg)
+            raise Exception(msg)
+
+        if write and 'daily_mosaics' in request.inputs and request.inputs['daily_mosaics'][0].data:
+            response.update_status('mosaic tiles per acquisition day', 90)
+            for indice, tiles in index_tiles.items():
+                try:
+                    for day, mosaic in eodata.merge_daily(tiles, prefix='{}_mosaic_'.format(indice)).items():
+                        LOGGER.debug('Plot mosaic of {} for {}'.format(indice, day))
+                        imgs.append(eodata.quicklook(mosaic, colorscheme=get_index(indice).colorscheme))
+                except Exception as ex:
+                    msg = 'failed to mosaic {} tiles: {}'.format(indice, str(ex))
+                    LOGGER.exception(msg)
+                    raise Exception(msg)
+
+        tarf = archive(imgs or ['zonal.json', 'zonal.csv'])
 
         response.outputs['output_archive'].file = tarf
 
         i = next((i for i, x in enumerate(imgs) if x), None)
-        if i is None:
-            i = "dummy.png"
-        response.outputs['output_plot'].file = imgs[i]
+        if i is not None:
+            response.outputs['output_plot'].file = imgs[i]
 
         response.update_status("done", 100)
         return response
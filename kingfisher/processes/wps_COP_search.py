@@ -11,11 +11,17 @@ from eggshell.utils import rename_complexinputs
 
 import logging
 from datetime import datetime as dt
-from datetime import timedelta, time
+from datetime import date, timedelta, time
+from os.path import join
 from tempfile import mkstemp
 
 from sentinelsat import SentinelAPI, geojson_to_wkt
 
+import kingfisher
+from kingfisher.cache import QueryCache
+from kingfisher.config import get_option
+from eggshell.config import Paths
+
 LOGGER = logging.getLogger("PYWPS")
 
 
@@ -145,7 +151,8 @@ class COP_searchProcess(Process):
             end = request.inputs['end'][0].data
             end = dt.combine(end, time(23, 59, 59))
         else:
-            end = dt.now()
+            # the end of today, so the query is the same all day long and its cached result is reused
+            end = dt.combine(date.today(), time(23, 59, 59))
 
         if 'start' in request.inputs:
             start = request.inputs['start'][0].data
@@ -154,8 +161,8 @@ class COP_searchProcess(Process):
             start = end - timedelta(days=30)
 
         if start > end:
-            start = dt.now() - timedelta(days=30)
-            end = dt.now()
+            end = dt.combine(date.today(), time(23, 59, 59))
+            start = end - timedelta(days=30)
             LOGGER.exception('period ends before period starts; period now set to the last 30 days from now')
 
         username = request.inputs['username'][0].data
@@ -176,13 +183,16 @@ class COP_searchProcess(Process):
 
         response.update_status("start searching tiles according to query", 15)
 
-        products = api.query(footprint,
-                             date=(start, end),
-                             platformname='Sentinel-2',
-                             cloudcoverpercentage=(0, cloud_cover),
-                             # producttype='SLC',
-                             # orbitdirection='ASCENDING',
-                             )
+        cache = QueryCache(join(Paths(kingfisher).cache, 'queries.sqlite'),
+                           ttl=get_option('query_cache_ttl', 3600, int),
+                           max_entries=get_option('query_cache_size', 256, int))
+        products = cache.query(api, footprint,
+                               date=(start, end),
+                               platformname='Sentinel-2',
+                               cloudcoverpercentage=(0, cloud_cover),
+                               # producttype='SLC',
+                               # orbitdirection='ASCENDING',
+                               )
 
         response.update_status("write out information about files", 20)
         # api.download_all(products)
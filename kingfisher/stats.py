@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Single-pass statistics of index rasters.
+
+The statistics (count, min, max, mean, standard deviation and a fixed-bin histogram over the value range
+of the index) are accumulated while the windows of an index are computed (see the ``accumulators`` of
+:func:`kingfisher.eodata.get_indices`). They are stored as GDAL statistics metadata of the band
+(``STATISTICS_MINIMUM`` ...) and as JSON sidecar next to the raster, so renderers need no further read
+of the raster to stretch its colors.
+
+Example usage::
+
+    from kingfisher.stats import read_sidecar
+    stats = read_sidecar('S2A_..._NDVI.tif')
+    vmin, vmax = stats['percentiles']['2'], stats['percentiles']['98']
+"""
+
+import json
+from os import path
+
+import numpy as np
+
+from kingfisher.indices import get_index
+
+STATS_BINS = 256
+# percentiles of the sidecar, e.g. for color stretching
+STATS_PERCENTILES = [2, 10, 50, 90, 98]
+
+
+def histogram_bins(values, value_range, bins):
+    """
+    returns the histogram bin of every value, values out of the range fall into the first or last bin
+
+    :param values: float array
+    :param value_range: (min, max) covered by the bins
+    :param bins: number of bins
+
+    :return: intp array of bin numbers
+    """
+    low, high = value_range
+    return np.clip(((values - low) * (bins / float(high - low))).astype(np.intp), 0, bins - 1)
+
+
+def histogram_percentiles(counts, value_range, percentiles, vmin=-np.inf, vmax=np.inf):
+    """
+    returns percentiles estimated from a histogram, at the centers of their bins
+
+    :param counts: counts of the bins
+    :param value_range: (min, max) covered by the bins
+    :param percentiles: percentiles to estimate (e.g. [10, 50, 90])
+    :param vmin: exact minimum, the estimates are clipped to it
+    :param vmax: exact maximum, the estimates are clipped to it
+
+    :return list: estimated values
+    """
+    low, high = value_range
+    cumulated = np.cumsum(counts)
+    values = []
+    for percentile in percentiles:
+        i = int(np.searchsorted(cumulated, percentile / 100. * cumulated[-1]))
+        value = low + (i + 0.5) * (high - low) / len(counts)
+        # the histogram is coarser than the exact extremes
+        values.append(float(min(max(value, vmin), vmax)))
+    return values
+
+
+def sidecar_path(filename):
+    """
+    returns the path of the statistics sidecar of a raster
+    """
+    return path.splitext(filename)[0] + '.stats.json'
+
+
+def read_sidecar(filename):
+    """
+    returns the statistics of a raster stored in its sidecar
+
+    :param filename: path of the raster
+
+    :return dict: statistics as returned by :meth:`RasterStats.statistics`, None without sidecar
+    """
+    sidecar = sidecar_path(filename)
+    if not path.exists(sidecar):
+        return None
+    with open(sidecar) as fp:
+        return json.load(fp)
+
+
+class RasterStats(object):
+    """Statistics and histogram of index rasters, accumulated window by window."""
+
+    def __init__(self, names, bins=STATS_BINS):
+        """
+        :param names: names of the indices
+        :param bins: number of histogram bins over the value range of an index, see ``Index.value_range``
+        """
+        self.names = list(names)
+        self.bins = bins
+        self._stats = {}
+
+    def start(self, profile):
+        """
+        resets the statistics
+
+        :param profile: rasterio profile of the grid
+        """
+        for name in self.names:
+            self._stats[name] = {'pixels': 0, 'count': 0, 'sum': 0., 'sumsq': 0., 'min': np.inf, 'max': -np.inf,
+                                 'hist': np.zeros(self.bins, dtype=np.int64)}
+
+    def update(self, name, window, values):
+        """
+        adds the values of a window
+
+        :param name: name of the index
+        :param window: window of the grid
+        :param values: float32 values of the window, NaN for masked pixels
+        """
+        if name not in self._stats:
+            return
+        stats = self._stats[name]
+        stats['pixels'] += values.size
+        values = values[np.isfinite(values)].astype(np.float64)
+        if not values.size:
+            return
+        stats['count'] += values.size
+        stats['sum'] += values.sum()
+        stats['sumsq'] += np.dot(values, values)
+        stats['min'] = min(stats['min'], values.min())
+        stats['max'] = max(stats['max'], values.max())
+        stats['hist'] += np.bincount(histogram_bins(values, get_index(name).value_range, self.bins),
+                                     minlength=self.bins)
+
+    def statistics(self, name):
+        """
+        returns the statistics of an index
+
+        :param name: name of the index
+
+        :return dict: count, valid_percent, min, max, mean, stddev, histogram (min, max and counts of the bins)
+                      and percentiles; min, max, mean and stddev are None without valid values
+        """
+        stats = self._stats[name]
+        low, high = get_index(name).value_range
+        count = stats['count']
+        result = {'count': count, 'valid_percent': 100. * count / stats['pixels'] if stats['pixels'] else 0.,
+                  'min': None, 'max': None, 'mean': None, 'stddev': None,
+                  'histogram': {'min': low, 'max': high, 'counts': stats['hist'].tolist()}, 'percentiles': {}}
+        if count:
+            mean = stats['sum'] / count
+            result.update(min=float(stats['min']), max=float(stats['max']), mean=float(mean),
+                          stddev=float(np.sqrt(max(stats['sumsq'] / count - mean * mean, 0.))))
+            values = histogram_percentiles(stats['hist'], (low, high), STATS_PERCENTILES, stats['min'], stats['max'])
+            result['percentiles'] = dict((str(p), v) for p, v in zip(STATS_PERCENTILES, values))
+        return result
+
+    def tags(self, name):
+        """
+        returns the GDAL statistics metadata of an index
+
+        :param name: name of the index
+
+        :return dict: ``STATISTICS_*`` band tags, empty without valid values
+        """
+        stats = self.statistics(name)
+        if not stats['count']:
+            return {}
+        return {'STATISTICS_MINIMUM': stats['min'], 'STATISTICS_MAXIMUM': stats['max'],
+                'STATISTICS_MEAN': stats['mean'], 'STATISTICS_STDDEV': stats['stddev'],
+                'STATISTICS_VALID_PERCENT': stats['valid_percent']}
+
+    def write_sidecar(self, name, filename):
+        """
+        writes the statistics of an index into the sidecar of its raster
+
+        :param name: name of the index
+        :param filename: path of the raster
+
+        :return str: path of the sidecar
+        """
+        sidecar = sidecar_path(filename)
+        with open(sidecar, 'w') as fp:
+            json.dump(self.statistics(name), fp)
+        return sidecar
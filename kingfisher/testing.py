@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+Generator of synthetic Sentinel2 products for the tests and benchmarks.
+
+The products mimic the layout of L1C SAFE directory trees (band files at their native resolution,
+product and granule metadata, a nodata border of zeros and a cloud classification mask) and of the
+zip archives downloaded from the scihub, so the tests and benchmarks run offline.
+
+Example usage::
+
+    from kingfisher.testing import make_safe, zip_safe
+    safe = make_safe('/tmp/eo-data', size=1098, bands=['B04', 'B08'])
+    archive = zip_safe(safe)
+"""
+
+import os
+import zipfile
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+RESOLUTIONS = {'B02': 10, 'B03': 10, 'B04': 10, 'B08': 10,
+               'B05': 20, 'B06': 20, 'B07': 20, 'B8A': 20, 'B11': 20, 'B12': 20,
+               'B01': 60, 'B09': 60, 'B10': 60}
+# upper left corner of tile 32TQM
+ORIGIN = (600000, 5000040)
+PRODUCT_ID = 'S2A_MSIL1C_20180101T101021_N0206_R022_T32TQM_20180101T122129'
+# band_id of the bands in the product metadata
+BAND_IDS = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B10', 'B11', 'B12']
+MTD = """<n1:Level-1C_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-1C.xsd">
+  <n1:General_Info>
+    <Product_Image_Characteristics>
+      <QUANTIFICATION_VALUE unit="none">10000</QUANTIFICATION_VALUE>
+      <Radiometric_Offset_List>{}</Radiometric_Offset_List>
+    </Product_Image_Characteristics>
+  </n1:General_Info>
+</n1:Level-1C_User_Product>
+"""
+
+
+def _driver():
+    # band files are JPEG2000 like in real products if GDAL supports writing them
+    with rasterio.Env() as env:
+        if 'JP2OpenJPEG' in env.drivers():
+            # lossless, like real products: lossy coding would blur the zeros of the nodata border
+            return {'driver': 'JP2OpenJPEG', 'REVERSIBLE': 'YES', 'QUALITY': 100}
+        return {'driver': 'GTiff'}
+
+
+def make_safe(directory, size=1098, bands=None, product_id=PRODUCT_ID, seed=0, origin=ORIGIN, cloud_mask=True,
+              offset=0):
+    """
+    writes a synthetic SAFE directory tree of a Sentinel2 L1C product
+
+    :param directory: directory the SAFE directory tree is written into
+    :param size: edge length in pixel of the 10 m bands (a real tile has 10980)
+    :param bands: band names (default: all 13 bands)
+    :param product_id: name of the product, the sensing time and tile are taken from it
+    :param seed: seed of the random digital numbers
+    :param origin: upper left corner of the tile in EPSG:32632
+    :param cloud_mask: write a cloud classification mask (QI_DATA/MSK_CLASSI_B00.jp2) covering a corner
+    :param offset: radiometric offset of the bands (-1000 from processing baseline 04.00 on), the digital numbers
+                   are shifted by it, so the reflectances do not depend on it
+
+    :return str: path of the SAFE directory
+    """
+    rng = np.random.RandomState(seed)
+    safe = os.path.join(directory, product_id + '.SAFE')
+    tile = product_id.split('_')[5]
+    granule = os.path.join(safe, 'GRANULE', 'L1C_{}_A013_20180101T101021'.format(tile))
+    os.makedirs(os.path.join(granule, 'IMG_DATA'))
+    os.makedirs(os.path.join(granule, 'QI_DATA'))
+    # products before processing baseline 04.00 have no offsets
+    offsets = ''.join('<RADIO_ADD_OFFSET band_id="{}">{}</RADIO_ADD_OFFSET>'.format(i, offset)
+                      for i in range(len(BAND_IDS))) if offset else ''
+    with open(os.path.join(safe, 'MTD_MSIL1C.xml'), 'w') as fp:
+        fp.write(MTD.format(offsets))
+    with open(os.path.join(granule, 'MTD_TL.xml'), 'w') as fp:
+        fp.write('<n1:Level-1C_Tile_ID/>')
+
+    driver = _driver()
+    sensing = product_id.split('_')[2]
+    for band in bands or sorted(RESOLUTIONS):
+        resolution = RESOLUTIONS[band]
+        width = size * 10 // resolution
+        data = (rng.randint(1, 10000, (1, width, width)) - offset).astype(np.uint16)
+        # nodata border of a tile at the edge of the swath
+        data[:, :, :width // 10] = 0
+        filename = os.path.join(granule, 'IMG_DATA', '{}_{}_{}.jp2'.format(tile, sensing, band))
+        transform = from_origin(origin[0], origin[1], resolution, resolution)
+        with rasterio.open(filename, 'w', width=width, height=width, count=1, dtype=rasterio.uint16,
+                           crs='EPSG:32632', transform=transform, **driver) as dst:
+            dst.write(data)
+
+    if cloud_mask:
+        width = size * 10 // 60
+        classes = np.zeros((3, width, width), dtype=np.uint8)
+        classes[0, width // 2:, width // 2:] = 1
+        with rasterio.open(os.path.join(granule, 'QI_DATA', 'MSK_CLASSI_B00.jp2'), 'w', width=width,
+                           height=width, count=3, dtype=rasterio.uint8, crs='EPSG:32632',
+                           transform=from_origin(origin[0], origin[1], 60, 60), **driver) as dst:
+            dst.write(classes)
+    return safe
+
+
+def zip_safe(safe, filename=None):
+    """
+    packs a SAFE directory tree into a zip archive as downloaded from the scihub
+
+    :param safe: path of the SAFE directory
+    :param filename: path of the zip archive (default: the SAFE path with the extension .zip)
+
+    :return str: path of the zip archive
+    """
+    safe = os.path.normpath(safe)
+    if filename is None:
+        filename = os.path.splitext(safe)[0] + '.zip'
+    with zipfile.ZipFile(filename, 'w') as zf:
+        for root, _, files in os.walk(safe):
+            for name in sorted(files):
+                member = os.path.join(root, name)
+                # band files are already compressed
+                zf.write(member, os.path.relpath(member, os.path.dirname(safe)),
+                         zipfile.ZIP_STORED if name.endswith('.jp2') else zipfile.ZIP_DEFLATED)
+    return filename
+
+
+def make_index(filename, size=1098, origin=ORIGIN, seed=0):
+    """
+    writes a synthetic float32 index raster (e.g. NDVI) with NaN for nodata
+
+    :param filename: path of the geotiff
+    :param size: edge length in pixel at 10 m resolution
+    :param origin: upper left corner in EPSG:32632
+    :param seed: seed of the random values
+
+    :return str: path of the geotiff
+    """
+    rng = np.random.RandomState(seed)
+    data = rng.uniform(-1, 1, (1, size, size)).astype(np.float32)
+    data[:, :, :size // 10] = np.nan
+    with rasterio.open(filename, 'w', driver='GTiff', width=size, height=size, count=1, dtype=rasterio.float32,
+                       nodata=float('nan'), crs='EPSG:32632', transform=from_origin(origin[0], origin[1], 10, 10),
+                       tiled=True, blockxsize=512, blockysize=512, compress='DEFLATE') as dst:
+        dst.write(data)
+    return filename
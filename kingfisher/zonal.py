@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""
+Zonal statistics of index rasters for a set of polygons (e.g. the fields of a farm).
+
+The polygons are rasterized once onto the output grid of a tile. The statistics are accumulated window by
+window while the indices are computed (see the ``accumulators`` of :func:`kingfisher.eodata.get_indices`),
+so the index rasters do not need to be written. Count, sum, sum of squares, min and max are accumulated per
+zone with ``np.bincount``. Medians and percentiles of small zones (up to ``ZONAL_EXACT`` pixels, e.g. fields)
+are exact, the values of these zones are kept. Larger zones fall back to a histogram per zone over the
+value range of the index, their percentiles are quantized to the bin width (e.g. 5 for BAI).
+
+Example usage::
+
+    from kingfisher.zonal import ZonalStatistics, to_csv
+    zonal = ZonalStatistics(features, ['NDVI'])
+    eodata.get_indices(basedir, ['NDVI'], bbox=zonal.bbox(), accumulators=[zonal], write=False)
+    to_csv(zonal.rows(product='S2A_...'), 'zonal.csv')
+"""
+
+import csv
+import json
+from collections import OrderedDict
+
+import numpy as np
+import rasterio
+from rasterio.features import rasterize
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+
+from kingfisher.indices import get_index
+from kingfisher.stats import histogram_bins, histogram_percentiles
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+ZONAL_BINS = 200
+# zones of up to this many pixels (1 km² at 10 m) get exact percentiles
+ZONAL_EXACT = 10000
+PERCENTILES = [10, 50, 90]
+COLUMNS = ['zone', 'index', 'count', 'mean', 'std', 'min', 'max', 'p10', 'median', 'p90']
+
+
+def _bounds(coordinates):
+    # nested coordinate lists of any geometry type
+    if isinstance(coordinates[0], (int, float)):
+        return coordinates[0], coordinates[1], coordinates[0], coordinates[1]
+    bounds = [_bounds(c) for c in coordinates]
+    return (min(b[0] for b in bounds), min(b[1] for b in bounds),
+            max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+
+class ZonalStatistics(object):
+    """Per zone statistics of indices, accumulated window by window on the grid of one tile."""
+
+    def __init__(self, features, names, crs='EPSG:4326', bins=ZONAL_BINS, exact=ZONAL_EXACT):
+        """
+        :param features: GeoJSON features (or geometries) of the zones. The zone is named after the ``id``
+                         of the feature or its ``id`` property, otherwise after its position.
+                         Pixels of overlapping zones count for the last zone.
+        :param names: names of the indices
+        :param crs: CRS of the features (default: 'EPSG:4326')
+        :param bins: number of histogram bins over the value range of an index, see ``Index.value_range``
+        :param exact: zones of up to this many pixels get exact percentiles instead of histogram estimates
+        """
+        self.geometries = []
+        self.ids = []
+        for i, feature in enumerate(features):
+            if feature.get('type') == 'Feature':
+                properties = feature.get('properties') or {}
+                self.ids.append(feature.get('id', properties.get('id', i)))
+                self.geometries.append(feature['geometry'])
+            else:
+                self.ids.append(i)
+                self.geometries.append(feature)
+        self.names = list(names)
+        self.crs = crs
+        self.bins = bins
+        self.exact = exact
+        self.zones = None
+        self._grid = None
+        self._stats = {}
+
+    def bbox(self):
+        """
+        returns the bounding box of all zones
+
+        :return tuple: (min_x, min_y, max_x, max_y) in the CRS of the features
+        """
+        bounds = [_bounds(geometry['coordinates']) for geometry in self.geometries]
+        return (min(b[0] for b in bounds), min(b[1] for b in bounds),
+                max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+    def start(self, profile):
+        """
+        rasterizes the zones onto a grid, the statistics are reset whenever the grid changes
+
+        :param profile: rasterio profile of the grid (crs, transform, width and height)
+        """
+        grid = (str(profile['crs']), tuple(profile['transform']), profile['width'], profile['height'])
+        if grid == self._grid:
+            return
+        self._grid = grid
+        shapes = [(transform_geom(self.crs, profile['crs'], geometry), zone)
+                  for zone, geometry in enumerate(self.geometries, 1)]
+        # zone 0 is outside of all polygons
+        dtype = rasterio.uint16 if len(shapes) < np.iinfo(np.uint16).max else rasterio.uint32
+        self.zones = rasterize(shapes, out_shape=(profile['height'], profile['width']),
+                               transform=profile['transform'], fill=0, dtype=dtype)
+        size = len(shapes) + 1
+        self._stats = {}
+        for name in self.names:
+            self._stats[name] = {
+                'count': np.zeros(size, dtype=np.int64),
+                'sum': np.zeros(size, dtype=np.float64),
+                'sumsq': np.zeros(size, dtype=np.float64),
+                'min': np.full(size, np.inf),
+                'max': np.full(size, -np.inf),
+                'hist': np.zeros((size, self.bins), dtype=np.int64),
+                # values of the zones with at most ``exact`` pixels
+                'values': {},
+            }
+        LOGGER.debug('{} zones rasterized onto a grid of {} x {}'.format(
+            len(shapes), profile['width'], profile['height']))
+
+    def update(self, name, window, values):
+        """
+        adds the values of a window
+
+        :param name: name of the index
+        :param window: window of the grid
+        :param values: float32 values of the window, NaN for masked pixels
+        """
+        if name not in self._stats:
+            return
+        row, col = int(window.row_off), int(window.col_off)
+        zones = self.zones[row:row + values.shape[0], col:col + values.shape[1]]
+        valid = (zones > 0) & np.isfinite(values)
+        if not valid.any():
+            return
+        zones = zones[valid].astype(np.intp)
+        values = values[valid].astype(np.float64)
+        stats = self._stats[name]
+        size = len(stats['count'])
+        stats['count'] += np.bincount(zones, minlength=size)
+        stats['sum'] += np.bincount(zones, weights=values, minlength=size)
+        stats['sumsq'] += np.bincount(zones, weights=values * values, minlength=size)
+        np.minimum.at(stats['min'], zones, values)
+        np.maximum.at(stats['max'], zones, values)
+        bins = histogram_bins(values, get_index(name).value_range, self.bins)
+        stats['hist'] += np.bincount(zones * self.bins + bins, minlength=size * self.bins).reshape(size, self.bins)
+        # split the values by zone
+        order = np.argsort(zones, kind='mergesort')
+        zones, values = zones[order], values[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(zones)) + 1))
+        for start, end in zip(starts, np.append(starts[1:], len(zones))):
+            zone = zones[start]
+            if stats['count'][zone] <= self.exact:
+                stats['values'].setdefault(zone, []).append(values[start:end])
+            else:
+                # too large, the histogram estimates the percentiles
+                stats['values'].pop(zone, None)
+
+    def add_raster(self, name, filename, window_size=1024):
+        """
+        adds the values of an index raster, e.g. a cached index file of the tile
+
+        :param name: name of the index
+        :param filename: path of the index raster
+        :param window_size: edge length in pixel of the windows read at once
+        """
+        with rasterio.open(filename) as src:
+            self.start(src.profile)
+            # strips of full rows, the zones cover the whole grid anyway
+            for row in range(0, src.height, window_size):
+                window = Window(0, row, src.width, min(window_size, src.height - row))
+                self.update(name, window, src.read(1, window=window, out_dtype=np.float32))
+
+    def rows(self, **extra):
+        """
+        returns the statistics of the zones with values
+
+        :param extra: columns added to every row (e.g. product=...)
+
+        :return list: OrderedDict per zone and index with the ``COLUMNS`` and the extra columns
+        """
+        rows = []
+        for name in self.names:
+            stats = self._stats.get(name)
+            if stats is None:
+                continue
+            for zone in np.flatnonzero(stats['count'][1:]) + 1:
+                count = int(stats['count'][zone])
+                mean = stats['sum'][zone] / count
+                variance = max(stats['sumsq'][zone] / count - mean * mean, 0.)
+                row = OrderedDict([('zone', self.ids[zone - 1]), ('index', name), ('count', count),
+                                   ('mean', float(mean)), ('std', float(np.sqrt(variance))),
+                                   ('min', float(stats['min'][zone])), ('max', float(stats['max'][zone]))])
+                if zone in stats['values']:
+                    percentiles = np.percentile(np.concatenate(stats['values'][zone]), PERCENTILES).tolist()
+                else:
+                    percentiles = histogram_percentiles(stats['hist'][zone], get_index(name).value_range,
+                                                        PERCENTILES, stats['min'][zone], stats['max'][zone])
+                row.update(zip(COLUMNS[-3:], percentiles))
+                row.update(extra)
+                rows.append(row)
+        return rows
+
+
+def to_csv(rows, filename):
+    """
+    writes zonal statistics into a CSV file
+
+    :param rows: rows of :meth:`ZonalStatistics.rows`
+    :param filename: path of the CSV file
+    """
+    columns = list(COLUMNS)
+    for row in rows:
+        columns.extend(key for key in row if key not in columns)
+    with open(filename, 'w') as fp:
+        writer = csv.DictWriter(fp, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def to_json(rows, filename):
+    """
+    writes zonal statistics into a JSON file
+
+    :param rows: rows of :meth:`ZonalStatistics.rows`
+    :param filename: path of the JSON file
+    """
+    with open(filename, 'w') as fp:
+        json.dump(rows, fp, indent=1)
@@ -0,0 +1,112 @@
+import os
+import socket
+from collections import OrderedDict
+from datetime import datetime as dt
+
+from kingfisher.cache import CacheManager, DerivedCache, QueryCache, derived_key, normalize_footprint, query_key
+from kingfisher.catalog import Catalog
+from kingfisher.indices import get_index
+from kingfisher.stats import sidecar_path
+
+FOOTPRINT = 'POLYGON((14.0 8.0,15.0 8.0,15.0 9.0,14.0 9.0,14.0 8.0))'
+
+
+class DummyAPI(object):
+    calls = 0
+
+    def query(self, footprint, **kwargs):
+        self.calls += 1
+        return OrderedDict([('uuid-1', {'identifier': 'S2A_1', 'beginposition': dt(2018, 1, 1)})])
+
+
+def test_query_key():
+    assert normalize_footprint(FOOTPRINT) == normalize_footprint('POLYGON ((14 8, 15 8, 15 9, 14 9, 14 8))')
+    period = (dt(2018, 1, 1), dt(2018, 1, 31))
+    assert query_key(FOOTPRINT, date=period) == query_key(FOOTPRINT, date=period)
+    assert query_key(FOOTPRINT, date=period) != query_key(FOOTPRINT, date=period, cloudcoverpercentage=(0, 30))
+
+
+def test_query_cache(tmpdir):
+    api = DummyAPI()
+    cache = QueryCache(str(tmpdir.join('queries.sqlite')), max_entries=1)
+    products = cache.query(api, FOOTPRINT, date=(dt(2018, 1, 1), dt(2018, 1, 31)))
+    assert cache.query(api, FOOTPRINT, date=(dt(2018, 1, 1), dt(2018, 1, 31))) == products
+    assert api.calls == 1
+
+    cache.query(api, FOOTPRINT, date=(dt(2018, 2, 1), dt(2018, 2, 28)))
+    cache.query(api, FOOTPRINT, date=(dt(2018, 1, 1), dt(2018, 1, 31)))
+    assert api.calls == 3
+
+    cache.ttl = 0
+    cache.query(api, FOOTPRINT, date=(dt(2018, 1, 1), dt(2018, 1, 31)))
+    assert api.calls == 4
+
+
+def test_cache_manager(tmpdir):
+    catalog = Catalog(str(tmpdir.join('catalog.sqlite')))
+    for name in ['old', 'new']:
+        zip_path = tmpdir.join('{}.zip'.format(name))
+        zip_path.write_binary(b'z' * 1000)
+        safe_path = tmpdir.mkdir('{}.SAFE'.format(name))
+        safe_path.join('B04.jp2').write_binary(b's' * 1000)
+        catalog.add_product(name, zip_path=str(zip_path), safe_path=str(safe_path))
+    catalog.add_derived('old', 'NDVI', str(tmpdir.join('ndvi.tif')))
+    tmpdir.join('ndvi.tif').write_binary(b'd' * 1000)
+
+    manager = CacheManager(catalog, budget=4000, lockfile=str(tmpdir.join('cache.lock')))
+    owner = manager.pin(['old'])
+    manager.pin(['new'])
+    catalog.unpin(owner)
+
+    # extracted trees are evicted before zip archives and derived products, pinned products are kept
+    assert manager.evict() == [str(tmpdir.join('old.SAFE'))]
+    assert manager.evict(reserve=1000) == [str(tmpdir.join('old.zip'))]
+    assert not tmpdir.join('old.zip').exists()
+    assert catalog.get('old')['zip_path'] is None
+    assert tmpdir.join('new.SAFE').exists()
+
+    # pins of dead processes are released
+    catalog.pin('gone', ['new'], host=socket.gethostname(), pid=2 ** 22 + 1)
+    catalog.unpin([pin for pin in catalog.pins() if pin['owner'] != 'gone'][0]['owner'])
+    manager.budget = 1
+    assert len(manager.evict()) == 3
+    assert catalog.pins() == []
+
+
+def test_derived_cache(tmpdir, monkeypatch):
+    catalog = Catalog(str(tmpdir.join('catalog.sqlite')))
+    derived = DerivedCache(str(tmpdir.join('derived')), catalog=catalog)
+    tile = tmpdir.join('S2A_1_NDVI.tif')
+    tile.write_binary(b'ndvi')
+    tmpdir.join('S2A_1_NDVI.stats.json').write('{}')
+    jobdir = tmpdir.mkdir('job')
+
+    assert derived_key('S2A_1', 'NDVI', window_size=512) == derived_key('S2A_1', 'NDVI', threads=4)
+    assert derived_key('S2A_1', 'NDVI') != derived_key('S2A_1', 'NDVI', bbox=(14, 8, 15, 9))
+    assert derived_key('S2A_1', 'NDVI') != derived_key('S2A_1', 'NDVI', cloud_mask=False)
+
+    assert derived.get('S2A_1', 'NDVI', directory=str(jobdir), bbox=(14, 8, 15, 9)) is None
+    derived.put('S2A_1', 'NDVI', str(tile), bbox=(14, 8, 15, 9))
+    assert derived.contains('S2A_1', 'NDVI', bbox=(14, 8, 15, 9))
+    linked = derived.get('S2A_1', 'NDVI', directory=str(jobdir), bbox=(14, 8, 15, 9))
+    assert open(linked, 'rb').read() == b'ndvi'
+    # the statistics sidecar is linked along
+    assert open(sidecar_path(linked)).read() == '{}'
+    assert derived.stats() == {'hits': 1, 'misses': 1, 'entries': 1, 'hit_rate': 0.5}
+    # counters of this instance and of all workers
+    other = DerivedCache(str(tmpdir.join('derived')))
+    assert other.get('S2A_1', 'NDVI', directory=str(jobdir), bbox=(14, 8, 15, 9)) is not None
+    assert (other.hits, other.misses) == (1, 0) and (derived.hits, derived.misses) == (1, 1)
+    assert derived.stats()['hits'] == 2
+    assert len(catalog.derived('S2A_1')) == 1
+
+    cached = derived.path(derived_key('S2A_1', 'NDVI', bbox=(14, 8, 15, 9)))
+    assert os.path.exists(sidecar_path(cached))
+
+    # a new kernel version invalidates the cached files
+    monkeypatch.setattr(get_index('NDVI'), 'version', get_index('NDVI').version + 1)
+    assert not derived.contains('S2A_1', 'NDVI', bbox=(14, 8, 15, 9))
+    assert derived.purge() == 1
+    assert not os.path.exists(cached) and not os.path.exists(sidecar_path(cached))
+    assert catalog.derived('S2A_1') == []
+    assert open(linked, 'rb').read() == b'ndvi'
@@ -0,0 +1,39 @@
+from datetime import datetime as dt
+
+from kingfisher.catalog import Catalog, footprint_bounds, parse_size
+
+FOOTPRINT = 'POLYGON((14.0 8.0,15.0 8.0,15.0 9.0,14.0 9.0,14.0 8.0))'
+
+
+def test_footprint_bounds():
+    assert footprint_bounds(FOOTPRINT) == (14.0, 8.0, 15.0, 9.0)
+
+
+def test_parse_size():
+    assert parse_size('1.5 KB') == 1536
+    assert parse_size(2048) == 2048
+
+
+def test_catalog(tmpdir):
+    catalog = Catalog(str(tmpdir.join('catalog.sqlite')))
+    catalog.add_from_query('uuid-1', {'identifier': 'S2A_1', 'footprint': FOOTPRINT,
+                                      'beginposition': dt(2018, 1, 1, 10), 'cloudcoverpercentage': 10.,
+                                      'size': '10 MB'}, zip_path='/eo-data/S2A_1.zip')
+    catalog.add_product('S2A_2', footprint='POLYGON((20 40,21 40,21 41,20 41,20 40))',
+                        sensing_time=dt(2018, 2, 1), cloud_cover=50.)
+    catalog.add_product('S2A_1', safe_path='/eo-data/S2A_1.SAFE')
+    catalog.add_derived('S2A_1', 'NDVI', '/outputs/ndvi.tif')
+
+    product = catalog.get('S2A_1')
+    assert product['zip_path'] == '/eo-data/S2A_1.zip'
+    assert product['safe_path'] == '/eo-data/S2A_1.SAFE'
+    assert product['size'] == 10 * 1024 ** 2
+
+    assert [p['id'] for p in catalog.query()] == ['S2A_1', 'S2A_2']
+    assert [p['id'] for p in catalog.query(bbox=(14.5, 8.5, 16, 10))] == ['S2A_1']
+    assert [p['id'] for p in catalog.query(start=dt(2018, 1, 15))] == ['S2A_2']
+    assert [p['id'] for p in catalog.query(max_cloud_cover=20)] == ['S2A_1']
+    assert catalog.query(bbox=(0, 0, 1, 1)) == []
+
+    assert catalog.derived('S2A_1')[0]['name'] == 'NDVI'
+    assert catalog.inventory() == {'products': 2, 'zips': 1, 'extracted': 1, 'derived': 1, 'size': 10 * 1024 ** 2}
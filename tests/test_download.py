@@ -0,0 +1,92 @@
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+from kingfisher.download import DownloadManager
+
+CONTENT = b'0123456789' * 1000
+
+
+class DummyResponse(object):
+    def __init__(self, content, status_code):
+        self.content = content
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class DummySession(object):
+    calls = 0
+
+    def get(self, url, headers=None, stream=False):
+        self.calls += 1
+        if headers and 'Range' in headers:
+            start = int(headers['Range'].split('=')[1].rstrip('-'))
+            return DummyResponse(CONTENT[start:], 206)
+        return DummyResponse(CONTENT, 200)
+
+
+class DummyAPI(object):
+    def __init__(self):
+        self.session = DummySession()
+
+    def get_product_odata(self, uuid):
+        if uuid == 'missing':
+            raise ValueError('product not found')
+        return {'id': uuid, 'title': 'S2A_{}'.format(uuid), 'size': len(CONTENT), 'url': 'http://scihub',
+                'md5': hashlib.md5(CONTENT).hexdigest()}
+
+
+def test_download_all(tmpdir):
+    # an interrupted download is resumed
+    tmpdir.join('S2A_1.zip.part').write_binary(CONTENT[:2500])
+    reported = []
+    manager = DownloadManager(DummyAPI(), str(tmpdir), workers=2, chunk_size=1000,
+                              progress=lambda done, total: reported.append((done, total)))
+    downloaded, failed = manager.download_all(['1', 'missing', '2'])
+
+    assert list(downloaded) == ['1', '2']
+    assert list(failed) == ['missing']
+    for uuid in downloaded:
+        assert tmpdir.join('S2A_{}.zip'.format(uuid)).read_binary() == CONTENT
+    assert not tmpdir.join('S2A_1.zip.part').exists()
+    assert reported[-1] == (2 * len(CONTENT), 2 * len(CONTENT))
+
+
+def test_checksum_mismatch(tmpdir):
+    tmpdir.join('S2A_1.zip.part').write_binary(b'x' * 2500)
+    downloaded, failed = DownloadManager(DummyAPI(), str(tmpdir)).download_all(['1'])
+    assert 'checksum' in failed['1']
+    assert not tmpdir.join('S2A_1.zip.part').exists()
+
+
+def test_checksum_fallback(tmpdir, monkeypatch):
+    api = DummyAPI()
+    odata = api.get_product_odata
+    api.get_product_odata = lambda uuid: dict(odata(uuid), **{'sha3-256': '0' * 64})
+    # sha3-256 is preferred
+    downloaded, failed = DownloadManager(api, str(tmpdir)).download_all(['1'])
+    assert 'checksum' in failed['1']
+    # python 2.7 has no sha3-256, md5 is checked instead
+    monkeypatch.setattr(hashlib, 'algorithms_available', set(['md5', 'sha1', 'sha256']))
+    downloaded, failed = DownloadManager(api, str(tmpdir)).download_all(['1'])
+    assert list(downloaded) == ['1'] and not failed
+    assert tmpdir.join('S2A_1.zip').read_binary() == CONTENT
+
+
+def test_concurrent_downloads(tmpdir):
+    # two jobs requesting the same product download it once
+    api = DummyAPI()
+    pool = ThreadPool(2)
+    results = pool.map(lambda _: DownloadManager(api, str(tmpdir)).download_all(['1']), range(2))
+    pool.close()
+    assert [list(downloaded) for downloaded, _ in results] == [['1'], ['1']]
+    assert api.session.calls == 1
+    assert tmpdir.join('S2A_1.zip').read_binary() == CONTENT
@@ -0,0 +1,307 @@
+import glob
+import os
+import warnings
+
+import numpy as np
+import pytest
+import rasterio
+from PIL import Image
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+from kingfisher.testing import ORIGIN, make_index, make_safe, zip_safe
+
+# eodata needs GDAL's python bindings and eggshell
+eodata = pytest.importorskip('kingfisher.eodata')
+
+PROFILE = {'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'crs': 'EPSG:32632',
+           'transform': from_origin(600000, 5000040, 10, 10), 'width': 64, 'height': 48, 'nodata': float('nan')}
+
+
+def write_raster(filename, values, **tags):
+    with rasterio.open(filename, 'w', **PROFILE) as dst:
+        dst.write(values.astype(np.float32), 1)
+        if tags:
+            dst.update_tags(1, **tags)
+    return filename
+
+
+def read(filename):
+    with rasterio.open(filename) as src:
+        return src.read(1)
+
+
+@pytest.fixture
+def stack(tmpdir):
+    tmpdir.chdir()
+    rng = np.random.RandomState(0)
+    values = rng.uniform(-1, 1, (5, 48, 64)).astype(np.float32)
+    values[:, :4] = np.nan
+    values[:2, 10:20, 10:20] = np.nan
+    rasters = [write_raster(str(tmpdir.join('S2A_MSIL1C_2018010{}T101021_NDVI.tif'.format(i + 1))), v)
+               for i, v in enumerate(values)]
+    return rasters, values
+
+
+@pytest.mark.parametrize('reducer', ['max', 'min', 'mean', 'count', 'median_exact'])
+def test_composite(stack, reducer):
+    rasters, values = stack
+    expected = {'max': np.nanmax, 'min': np.nanmin, 'mean': np.nanmean, 'median_exact': np.nanmedian,
+                'count': lambda v, axis: np.isfinite(v).sum(axis=axis)}[reducer]
+    with warnings.catch_warnings():
+        # all-NaN pixels
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = expected(values, axis=0)
+    # windows smaller than the raster
+    result = read(eodata.composite(rasters, reducer=reducer, output_format='GTiff', window_size=16))
+    np.testing.assert_allclose(result, expected, rtol=1e-6, equal_nan=True)
+
+
+def test_composite_median(stack):
+    rasters, values = stack
+    median = read(eodata.composite(rasters, reducer='median', output_format='GTiff'))
+    exact = read(eodata.composite(rasters, reducer='median_exact', output_format='GTiff'))
+    assert np.array_equal(np.isnan(median), np.isnan(exact))
+    # within a histogram bin
+    assert np.nanmax(np.abs(median - exact)) <= 2. / eodata.MEDIAN_BINS
+
+
+def test_composite_median_value_range(tmpdir):
+    tmpdir.chdir()
+    rng = np.random.RandomState(0)
+    # BAI is far beyond the default range of -1 to 1
+    values = rng.uniform(1.5, 2.5, (4, 48, 64))
+    rasters = [write_raster('S2A_MSIL1C_2018010{}T101021_BAI.tif'.format(i + 1), v) for i, v in enumerate(values)]
+    exact = read(eodata.composite(rasters, reducer='median_exact', output_format='GTiff'))
+    median = read(eodata.composite(rasters, reducer='median', output_format='GTiff', value_range=(0., 1000.)))
+    assert np.abs(median - exact).max() <= 1000. / eodata.MEDIAN_BINS
+
+    # the statistics of the rasters narrow the range of the bins
+    rasters = [write_raster(raster, v, STATISTICS_MINIMUM=v.min(), STATISTICS_MAXIMUM=v.max())
+               for raster, v in zip(rasters, values)]
+    median = read(eodata.composite(rasters, reducer='median', output_format='GTiff', value_range=(0., 1000.)))
+    assert np.abs(median - exact).max() <= 1. / eodata.MEDIAN_BINS
+
+
+def test_composite_cog(stack):
+    rasters, _ = stack
+    with rasterio.open(eodata.composite(rasters, reducer='max')) as src:
+        assert src.tags()['COMPOSITE_REDUCER'] == 'max'
+        assert src.tags()['COMPOSITE_COUNT'] == '5'
+        assert src.tags()['COMPOSITE_START'].startswith('2018-01-01')
+        assert src.tags()['COMPOSITE_END'].startswith('2018-01-05')
+
+
+def test_composite_errors(stack):
+    rasters, _ = stack
+    with pytest.raises(ValueError):
+        eodata.composite(rasters, reducer='sum')
+    with pytest.raises(ValueError):
+        eodata.composite([])
+
+
+def zero_band(safe, band, rows, cols):
+    # digital number 0 marks pixels without data
+    filename = glob.glob(os.path.join(safe, 'GRANULE', '*', 'IMG_DATA', '*_{}.jp2'.format(band)))[0]
+    with rasterio.open(filename) as src:
+        profile, data = src.profile, src.read()
+    data[:, rows, cols] = 0
+    profile.update(driver='GTiff')
+    with rasterio.open(filename, 'w', **profile) as dst:
+        dst.write(data)
+
+
+def test_get_indices_nodata(tmpdir):
+    tmpdir.chdir()
+    safe = make_safe(str(tmpdir), size=120, bands=['B04', 'B08', 'B8A', 'B12'], cloud_mask=False)
+    zero_band(safe, 'B12', slice(0, 30), slice(30, 60))
+
+    # on the grid of the 20 m bands, the 10 m bands are averaged without blurring the nodata
+    options = dict(window_size=16, cloud_mask=False, resolution=20)
+    ndvi = read(eodata.get_indices(safe, ['NDVI'], **options)['NDVI'])
+    files = eodata.get_indices(safe, ['NDVI', 'NBR'], **options)
+    # the nodata of NBR does not leak into NDVI
+    assert np.array_equal(read(files['NDVI']), ndvi, equal_nan=True)
+    nbr = read(files['NBR'])
+    assert np.isnan(nbr[:30, 30:]).all()
+    assert np.isfinite(nbr[:30, 6:30]).all() and np.isfinite(nbr[30:, 6:]).all()
+    # the nodata border of all bands
+    assert np.isnan(ndvi[:, :6]).all() and np.isnan(nbr[:, :6]).all()
+    assert np.isfinite(ndvi[:, 6:]).all()
+
+
+def test_get_indices_cloud_mask(tmpdir):
+    tmpdir.chdir()
+    safe = make_safe(str(tmpdir), size=120, bands=['B04', 'B08', 'B8A', 'B12'])
+    files = eodata.get_indices(safe, ['NDVI', 'NBR'], window_size=16, resolution=20, cloud_mask=True)
+    for name in files:
+        values = read(files[name])
+        # the classification mask covers the lower right quarter
+        assert np.isnan(values[30:, 30:]).all()
+        assert np.isfinite(values[:30, 6:]).all() and np.isfinite(values[30:, 6:30]).all()
+    unmasked = read(eodata.get_indices(safe, ['NDVI'], window_size=16, resolution=20, cloud_mask=False)['NDVI'])
+    assert np.isfinite(unmasked[30:, 30:]).all()
+
+
+def test_get_indices_skips_masked_windows(tmpdir, monkeypatch):
+    tmpdir.chdir()
+    safe = make_safe(str(tmpdir), size=320, bands=['B04', 'B08'], cloud_mask=False)
+    decoded = []
+    to_reflectance = eodata.to_reflectance
+
+    def count(dn, out, **kwargs):
+        decoded.append(dn.shape)
+        return to_reflectance(dn, out, **kwargs)
+
+    monkeypatch.setattr(eodata, 'to_reflectance', count)
+    ndvi = read(eodata.get_indices(safe, ['NDVI'], window_size=16, cloud_mask=False, threads=1)['NDVI'])
+    # the windows of the first 32 columns lie in the nodata border
+    assert len(decoded) == 2 * (20 * 20 - 2 * 20)
+    assert np.isnan(ndvi[:, :32]).all() and np.isfinite(ndvi[:, 32:]).all()
+
+
+@pytest.fixture
+def safe(tmpdir):
+    tmpdir.chdir()
+    return make_safe(str(tmpdir.mkdir('eo-data')), size=300, bands=['B04', 'B08', 'B8A', 'B12'])
+
+
+def test_get_indices_threads(safe):
+    serial = eodata.get_indices(safe, ['NDVI', 'BAI'], window_size=64, threads=1, output_format='GTiff')
+    threaded = eodata.get_indices(safe, ['NDVI', 'BAI'], window_size=64, threads=3, output_format='GTiff')
+    for name in serial:
+        assert np.array_equal(read(serial[name]), read(threaded[name]), equal_nan=True)
+
+
+def test_get_indices_cog(tmpdir):
+    tmpdir.chdir()
+    safe = make_safe(str(tmpdir), size=600, bands=['B04', 'B08'])
+    cog = eodata.get_indices(safe, ['NDVI'], output_format='COG')['NDVI']
+    with rasterio.open(cog) as src:
+        assert src.profile['tiled'] and src.block_shapes == [(eodata.COG_BLOCKSIZE, eodata.COG_BLOCKSIZE)]
+        assert src.overviews(1) == eodata.overview_factors(600, 600) == [2]
+        assert src.tags()['TIFFTAG_DATETIME'] == '2018:01:01 10:10:21'
+        assert 'STATISTICS_MEAN' in src.tags(1)
+    assert os.path.exists(os.path.splitext(cog)[0] + '.stats.json')
+
+    tif = eodata.get_indices(safe, ['NDVI'], output_format='GTiff', compress='NONE')['NDVI']
+    with rasterio.open(tif) as src:
+        assert not src.profile.get('tiled') and src.overviews(1) == []
+    assert np.array_equal(read(cog), read(tif), equal_nan=True)
+
+
+def test_get_indices_zip(safe):
+    archive = zip_safe(safe)
+    assert sorted(eodata.get_zip_bands(archive)) == ['B04', 'B08', 'B12', 'B8A']
+    from_safe = eodata.get_indices(safe, ['NDVI', 'NBR'], output_format='GTiff')
+    from_zip = eodata.get_indices(archive, ['NDVI', 'NBR'], output_format='GTiff')
+    for name in from_safe:
+        assert np.array_equal(read(from_safe[name]), read(from_zip[name]), equal_nan=True)
+
+
+def test_radiometry(safe, tmpdir):
+    assert eodata.radiometry(safe) == ({}, 10000.)
+    baseline4 = make_safe(str(tmpdir.mkdir('baseline4')), size=60, bands=['B04'], offset=-1000)
+    offsets, quantification = eodata.radiometry(zip_safe(baseline4))
+    assert sorted(offsets) == sorted(eodata.BAND_IDS)
+    assert offsets['B8A'] == -1000. and quantification == 10000.
+
+
+def test_get_indices_offset(safe, tmpdir):
+    # the same reflectances, shifted by the offset of processing baseline 04.00
+    baseline4 = make_safe(str(tmpdir.mkdir('baseline4')), size=300, bands=['B04', 'B08', 'B8A', 'B12'],
+                          offset=-1000)
+    before = eodata.get_indices(safe, ['NDVI', 'BAI'], output_format='GTiff')
+    after = eodata.get_indices(baseline4, ['NDVI', 'BAI'], output_format='GTiff')
+    for name in before:
+        np.testing.assert_allclose(read(after[name]), read(before[name]), rtol=1e-5)
+
+
+def test_extract_bands(safe, tmpdir):
+    archive = zip_safe(safe)
+    directory = str(tmpdir.mkdir('extracted'))
+    extracted = eodata.extract(archive, directory, bands=['B04', 'B08'])
+    assert extracted == os.path.join(directory, os.path.basename(safe))
+    assert sorted(eodata.get_bands(extracted)) == ['B04', 'B08']
+    assert eodata.get_mask(extracted)[0] == 'MSK_CLASSI_B00.jp2'
+    assert os.path.exists(os.path.join(extracted, 'MTD_MSIL1C.xml'))
+    # bands of later requests are added
+    eodata.extract(archive, directory, bands=['B12'])
+    assert sorted(eodata.get_bands(extracted)) == ['B04', 'B08', 'B12']
+
+
+def test_bbox_window(safe):
+    utm = (ORIGIN[0] + 1000, ORIGIN[1] - 2000, ORIGIN[0] + 1500, ORIGIN[1] - 1200)
+    with rasterio.open(eodata.get_bands(safe)['B04']) as src:
+        assert eodata.bbox_window(src, utm, crs='EPSG:32632') == Window(100, 120, 50, 80)
+        assert eodata.bbox_window(src, (0, 0, 1, 1)) is None
+        bbox = transform_bounds('EPSG:32632', 'EPSG:4326', *utm)
+        window = eodata.bbox_window(src, bbox)
+    # the reprojected bbox covers the UTM box
+    assert window.col_off <= 100 and window.row_off <= 120
+    assert window.col_off + window.width >= 150 and window.row_off + window.height >= 200
+
+    full = read(eodata.get_indices(safe, ['NDVI'], output_format='GTiff')['NDVI'])
+    clipped = read(eodata.get_indices(safe, ['NDVI'], output_format='GTiff', bbox=bbox)['NDVI'])
+    assert clipped.shape == (window.height, window.width)
+    assert np.array_equal(clipped, full[window.toslices()], equal_nan=True)
+
+
+def test_get_indices_nodata_border(safe):
+    # the 20 m bands are upsampled, their nodata border does not blend into the valid pixels
+    nbr = read(eodata.get_indices(safe, ['NBR'], output_format='GTiff', resolution=10, cloud_mask=False)['NBR'])
+    assert nbr.shape == (300, 300)
+    assert np.isnan(nbr[:, :30]).all() and np.isfinite(nbr[:, 30:]).all()
+
+
+def test_resample(safe):
+    with eodata.resample(safe, 'B12', 10) as b12:
+        assert (b12.width, b12.height) == (300, 300) and b12.res == (10., 10.)
+    with eodata.resample(safe, 'B04', 20) as b04:
+        assert (b04.width, b04.height) == (150, 150) and b04.res == (20., 20.)
+        coarse = b04.read(1).astype(np.float64)
+    fine = read(eodata.get_bands(safe)['B04']).astype(np.float64)
+    averaged = fine.reshape(150, 2, 150, 2).mean(axis=(1, 3))
+    assert np.abs(coarse - averaged).max() <= 1
+
+
+def test_merge(tmpdir):
+    tmpdir.chdir()
+    left = make_index('left.tif', size=100)
+    right = make_index('right.tif', size=100, origin=(ORIGIN[0] + 1000, ORIGIN[1]), seed=1)
+    mosaic = eodata.merge([left, right], output_format='GTiff')
+    merged = read(mosaic)
+    assert merged.shape == (100, 200)
+    assert np.array_equal(merged[:, :100], read(left), equal_nan=True)
+    assert np.array_equal(merged[:, 100:], read(right), equal_nan=True)
+    assert eodata.merge([left, right], virtual=True).endswith('.vrt')
+
+
+def test_merge_daily(tmpdir):
+    tmpdir.chdir()
+    names = ['S2A_MSIL1C_20180101T101021_T32TQM_NDVI.tif', 'S2A_MSIL1C_20180101T101021_T32TRM_NDVI.tif',
+             'S2B_MSIL1C_20180103T101021_T32TQM_NDVI.tif']
+    origins = [ORIGIN, (ORIGIN[0] + 1000, ORIGIN[1]), ORIGIN]
+    tiles = [make_index(name, size=100, origin=origin, seed=i) for i, (name, origin) in enumerate(zip(names, origins))]
+    days = eodata.group_by_day(tiles)
+    assert [day.isoformat() for day in days] == ['2018-01-01', '2018-01-03']
+    mosaics = eodata.merge_daily(reversed(tiles), output_format='GTiff', workers=2)
+    assert list(mosaics) == list(days)
+    first, second = [read(mosaic) for mosaic in mosaics.values()]
+    assert first.shape == (100, 200) and second.shape == (100, 100)
+    with rasterio.open(mosaics[list(days)[1]]) as src:
+        assert src.tags()['TIFFTAG_DATETIME'] == '2018:01:03 10:10:21'
+
+
+def test_quicklook(tmpdir):
+    tmpdir.chdir()
+    cog = eodata.materialize(make_index('ndvi.tif', size=600))
+    png = eodata.quicklook(cog, colorscheme='NDVI', size=150)
+    assert png == os.path.splitext(cog)[0] + '.png'
+    image = np.asarray(Image.open(png))
+    assert image.shape == (150, 150, 4)
+    # the nodata border is transparent
+    assert (image[:, :10, 3] == 0).all() and (image[:, 20:, 3] == 255).all()
+    gray = np.asarray(Image.open(eodata.quicklook(cog, filename='gray.png')))
+    assert gray.shape == (600, 600, 4)
@@ -0,0 +1,66 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from kingfisher.indices import INDICES, get_index, required_bands, to_reflectance
+
+
+def test_required_bands():
+    assert required_bands(['NDVI', 'BAI']) == ['B04', 'B08']
+    assert required_bands(['NDVI', 'NDWI', 'EVI']) == ['B02', 'B03', 'B04', 'B08']
+
+
+def test_unknown_index():
+    with pytest.raises(ValueError):
+        get_index('FOO')
+
+
+def test_ndvi():
+    bands = {'B04': np.array([[1000., 2000.]], dtype=np.float32),
+             'B08': np.array([[3000., 2000.]], dtype=np.float32)}
+    np.testing.assert_allclose(get_index('NDVI')(bands), [[0.5, 0.]])
+
+
+def test_all_indices_vectorized():
+    shape = (4, 5)
+    bands = dict((band, np.full(shape, 1500., dtype=np.float32))
+                 for band in required_bands(INDICES.keys()))
+    for name in INDICES:
+        assert get_index(name)(bands).shape == shape
+
+
+def test_to_reflectance():
+    dn = np.array([[0, 5000, 10000]], dtype=np.uint16)
+    refl = to_reflectance(dn)
+    assert refl.dtype == np.float32
+    np.testing.assert_allclose(refl, [[0., 0.5, 1.]])
+    # processing baseline 04.00
+    dn = np.array([[1000, 6000, 11000]], dtype=np.uint16)
+    out = np.empty(dn.shape, dtype=np.float32)
+    assert to_reflectance(dn, out=out, offset=-1000.) is out
+    np.testing.assert_allclose(out, [[0., 0.5, 1.]])
+
+
+def test_kernels_allocate_no_temporaries():
+    shape = (256, 256)
+    rng = np.random.RandomState(0)
+    bands = dict((band, rng.uniform(0.01, 0.5, shape).astype(np.float32))
+                 for band in required_bands(INDICES.keys()))
+    out = np.empty(shape, dtype=np.float32)
+    tmp = np.empty(shape, dtype=np.float32)
+
+    # float64 expression as computed before the in-place kernels
+    tracemalloc.start()
+    (bands['B08'].astype(float) - bands['B04'].astype(float)) / (bands['B08'] + bands['B04'])
+    _, legacy_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert legacy_peak >= 3 * out.nbytes
+
+    for name in INDICES:
+        tracemalloc.start()
+        result = get_index(name)(bands, out=out, tmp=tmp)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert result is out
+        assert peak < out.nbytes / 10, name
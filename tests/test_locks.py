@@ -0,0 +1,45 @@
+import os
+import socket
+
+import pytest
+
+from kingfisher.exceptions import LockTimeout
+from kingfisher.locks import FileLock
+
+
+def test_lock(tmpdir):
+    path = str(tmpdir.join('product.lock'))
+    with FileLock(path):
+        assert os.path.exists(path)
+        with pytest.raises(LockTimeout):
+            FileLock(path, timeout=0.2, poll=0.05).acquire()
+    assert not os.path.exists(path)
+
+
+def test_stale_locks(tmpdir):
+    path = tmpdir.join('product.lock')
+    # holder died on this host
+    path.write('{} {} abc'.format(socket.gethostname(), 2 ** 22 + 1))
+    with FileLock(str(path), timeout=1, poll=0.05) as lock:
+        assert path.read() == lock.owner
+
+    # holder on another host stopped its heartbeat
+    path.write('otherhost 1 abc')
+    with FileLock(str(path), timeout=2, stale=0.2, poll=0.05) as lock:
+        assert path.read() == lock.owner
+
+
+def test_break_live_lock(tmpdir):
+    path = tmpdir.join('product.lock')
+    path.write('otherhost 1 abc')
+    lock = FileLock(str(path))
+    stale = lock._state()
+    # the lock is taken over by another worker before the waiting worker breaks it
+    path.remove()
+    path.write('otherhost 2 def')
+    lock._break(stale)
+    assert path.read() == 'otherhost 2 def'
+    assert tmpdir.listdir() == [path]
+
+    lock._break(lock._state())
+    assert not path.exists() and tmpdir.listdir() == []
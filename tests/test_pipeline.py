@@ -0,0 +1,32 @@
+import time
+
+from kingfisher.pipeline import Pipeline
+
+
+def test_pipeline():
+    def fail_odd(item):
+        if item % 2:
+            raise ValueError('odd item')
+        return item
+
+    pipeline = Pipeline([('double', lambda item: 2 * item, 2), ('check', fail_odd, 1),
+                         ('square', lambda item: item ** 2, 3)])
+    results = sorted(pipeline.run(range(5)))
+    assert [result for _, result, _ in results] == [0, 4, 16, 36, 64]
+
+    pipeline = Pipeline([('check', fail_odd, 2), ('square', lambda item: item ** 2, 1)])
+    results = sorted(pipeline.run(range(4)))
+    assert [result for _, result, _ in results] == [0, None, 4, None]
+    assert results[1][2] == 'check failed: odd item'
+
+
+def test_pipeline_overlaps_stages():
+    def slow(item):
+        time.sleep(0.1)
+        return item
+
+    start = time.time()
+    results = list(Pipeline([('download', slow, 1), ('compute', slow, 1)]).run(range(4)))
+    # 5 steps of the slowest stage instead of 8 sequential ones
+    assert time.time() - start < 0.75
+    assert sorted(i for i, _, _ in results) == [0, 1, 2, 3]
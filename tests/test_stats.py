@@ -0,0 +1,35 @@
+import numpy as np
+from rasterio.windows import Window
+
+from kingfisher.stats import RasterStats, histogram_percentiles, read_sidecar
+
+
+def test_raster_stats(tmpdir):
+    values = np.linspace(-1, 1, 100 * 100, dtype=np.float32).reshape(100, 100)
+    values[:10] = np.nan
+    stats = RasterStats(['NDVI'])
+    stats.start({})
+    for row in range(0, 100, 32):
+        stats.update('NDVI', Window(0, row, 100, min(32, 100 - row)), values[row:row + 32])
+
+    valid = values[np.isfinite(values)]
+    result = stats.statistics('NDVI')
+    assert result['count'] == valid.size
+    assert result['valid_percent'] == 90.
+    assert result['min'] == valid.min() and result['max'] == valid.max()
+    assert np.isclose(result['mean'], valid.mean())
+    assert np.isclose(result['stddev'], valid.std())
+    assert sum(result['histogram']['counts']) == valid.size
+    assert abs(result['percentiles']['98'] - np.percentile(valid, 98)) <= 2. / 256
+    assert stats.tags('NDVI')['STATISTICS_VALID_PERCENT'] == 90.
+
+    raster = str(tmpdir.join('ndvi.tif'))
+    assert read_sidecar(raster) is None
+    stats.write_sidecar('NDVI', raster)
+    assert read_sidecar(raster) == result
+
+
+def test_histogram_percentiles():
+    counts = np.array([0, 10, 0, 10])
+    assert histogram_percentiles(counts, (0., 4.), [25, 50, 100]) == [1.5, 1.5, 3.5]
+    assert histogram_percentiles(counts, (0., 4.), [50], vmin=1.7) == [1.7]
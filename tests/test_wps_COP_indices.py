@@ -0,0 +1,145 @@
+import hashlib
+import os
+from collections import OrderedDict
+from datetime import datetime
+
+import pytest
+from rasterio.warp import transform_bounds
+
+from kingfisher.testing import ORIGIN, make_safe, zip_safe
+
+# the processes need eggshell and GDAL's python bindings
+indices = pytest.importorskip('kingfisher.processes.wps_COP_indices')
+
+PRODUCT_IDS = ['S2A_MSIL1C_20180101T101021_N0206_R022_T32TQM_20180101T122129',
+               'S2B_MSIL1C_20180103T101021_N0206_R022_T32TQM_20180103T122129',
+               'S2A_MSIL1C_20180105T101021_N0206_R022_T32TQM_20180105T122129']
+
+
+class DummyResponse(object):
+    def __init__(self, content):
+        self.content = content
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class DummySession(object):
+    def __init__(self, archives):
+        self.archives = archives
+
+    def get(self, url, headers=None, stream=False):
+        return DummyResponse(self.archives[url])
+
+
+class DummyAPI(object):
+    """scihub serving the zip archives of synthetic products"""
+
+    def __init__(self, archives):
+        self.archives = archives
+        self.session = DummySession(archives)
+
+    def get_product_odata(self, uuid):
+        content = self.archives[uuid]
+        return {'id': uuid, 'title': PRODUCT_IDS[int(uuid)], 'size': len(content), 'url': uuid,
+                'md5': hashlib.md5(content).hexdigest()}
+
+
+class DummyStatus(object):
+    def update_status(self, message, status):
+        pass
+
+
+@pytest.fixture
+def scihub(tmpdir):
+    """products of a query and the api serving them, the second product lacks B08"""
+    directory = tmpdir.mkdir('scihub')
+    archives = {}
+    products = OrderedDict()
+    for i, product_id in enumerate(PRODUCT_IDS):
+        safe = make_safe(str(directory), size=120, bands=['B04'] if i == 1 else ['B04', 'B08'],
+                         product_id=product_id, seed=i)
+        with open(zip_safe(safe), 'rb') as fp:
+            archives[str(i)] = fp.read()
+        products[str(i)] = {'identifier': product_id, 'filename': product_id + '.SAFE',
+                            'size': '{} B'.format(len(archives[str(i)])),
+                            'footprint': 'POLYGON((14 8, 15 8, 15 9, 14 9, 14 8))',
+                            'beginposition': datetime(2018, 1, 1 + 2 * i)}
+    return DummyAPI(archives), products
+
+
+def configure(monkeypatch, cache, **options):
+    class Paths(object):
+        def __init__(self, module):
+            self.cache = cache
+
+    monkeypatch.setattr(indices, 'Paths', Paths)
+    monkeypatch.setattr(indices, 'get_option', lambda option, default=None, convert=None: options.get(option, default))
+
+
+def test_compute_tile_failure(tmpdir):
+    tmpdir.chdir()
+    safe = make_safe(str(tmpdir), size=120, bands=['B04'])
+    resource, results, stats, cache_stats, error = indices.compute_tile(
+        (safe, ['NDVI'], {}, None, None, True, False))
+    assert (resource, results, stats, cache_stats) == (safe, [], [], (0, 0))
+    assert 'B08' in error
+
+
+def test_compute_tile_cached_without_write(tmpdir):
+    eo_data = tmpdir.mkdir('eo-data')
+    safe = make_safe(str(eo_data), size=120, bands=['B04', 'B08'])
+    tmpdir.mkdir('first').chdir()
+    _, results, _, _, error = indices.compute_tile((safe, ['NDVI'], {}, str(eo_data), None, True, False))
+    assert error is None and len(results) == 1
+
+    west, south, east, north = transform_bounds('EPSG:32632', 'EPSG:4326', ORIGIN[0] + 400, ORIGIN[1] - 800,
+                                                ORIGIN[0] + 800, ORIGIN[1] - 400)
+    ring = [(west, north), (east, north), (east, south), (west, south), (west, north)]
+    zone = {'type': 'Feature', 'id': 'a', 'properties': {}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}}
+    job = tmpdir.mkdir('second')
+    job.chdir()
+    _, results, stats, cache_stats, error = indices.compute_tile(
+        (safe, ['NDVI'], {}, str(eo_data), [zone], False, True))
+    # the cache hit feeds the zonal statistics only, no files are emitted without write
+    assert error is None and results == [] and job.listdir() == []
+    assert cache_stats == (1, 0)
+    assert [(row['zone'], row['index']) for row in stats] == [('a', 'NDVI')] and stats[0]['count'] > 0
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_compute_products(scihub, tmpdir, monkeypatch, workers):
+    api, products = scihub
+    job = tmpdir.mkdir('job')
+    job.chdir()
+    configure(monkeypatch, str(tmpdir.mkdir('cache')), tile_workers=workers)
+    tiles, stats, failed = indices.compute_products(api, products, ['NDVI', 'BAI'], {'output_format': 'GTiff'},
+                                                    DummyStatus(), quicklooks=False)
+    # the tile without B08 fails, the others are computed in the order of the products
+    assert len(failed) == 1 and PRODUCT_IDS[1] in failed[0]
+    assert [(indice, os.path.basename(tile)[:len(PRODUCT_IDS[0])]) for indice, tile, _ in tiles] == \
+        [('NDVI', PRODUCT_IDS[0]), ('BAI', PRODUCT_IDS[0]), ('NDVI', PRODUCT_IDS[2]), ('BAI', PRODUCT_IDS[2])]
+    assert all(os.path.exists(tile) and image is None for _, tile, image in tiles)
+    assert stats == []
+
+
+def test_compute_products_pins_before_lookup(scihub, tmpdir, monkeypatch):
+    api, products = scihub
+    tmpdir.mkdir('job').chdir()
+    configure(monkeypatch, str(tmpdir.mkdir('cache')))
+    calls = []
+    pin, contains = indices.CacheManager.pin, indices.DerivedCache.contains
+    monkeypatch.setattr(indices.CacheManager, 'pin', lambda self, ids: calls.append('pin') or pin(self, ids))
+    monkeypatch.setattr(indices.DerivedCache, 'contains',
+                        lambda self, *args, **kwargs: calls.append('contains') or contains(self, *args, **kwargs))
+    indices.compute_products(api, products, ['NDVI'], {}, DummyStatus(), quicklooks=False)
+    # other jobs cannot evict the derived files between the lookup and their use
+    assert calls[0] == 'pin' and 'contains' in calls
@@ -0,0 +1,72 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from kingfisher.zonal import ZonalStatistics, to_csv, to_json
+
+PROFILE = {'crs': 'EPSG:32632', 'transform': from_origin(600000, 5000040, 10, 10), 'width': 100, 'height': 100}
+
+
+def square(x, y, size, id):
+    ring = [(x, y), (x + size, y), (x + size, y - size), (x, y - size), (x, y)]
+    return {'type': 'Feature', 'id': id, 'properties': {}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}}
+
+
+def test_zonal_statistics(tmpdir):
+    features = [square(600000, 5000040, 200, 'a'), square(600500, 5000040, 100, 'b'), square(601500, 5000040, 50, 'c')]
+    zonal = ZonalStatistics(features, ['NDVI'], crs='EPSG:32632')
+    assert zonal.bbox() == (600000, 4999840, 601550, 5000040)
+
+    values = np.linspace(-1, 1, 100 * 100, dtype=np.float32).reshape(100, 100)
+    values[0, 0] = np.nan
+    zonal.start(PROFILE)
+    for row in range(0, 100, 32):
+        window = Window(0, row, 100, min(32, 100 - row))
+        zonal.update('NDVI', window, values[row:row + 32])
+
+    rows = dict((row['zone'], row) for row in zonal.rows(product='S2A_1'))
+    # zone c lies outside of the grid
+    assert sorted(rows) == ['a', 'b']
+    a = values[:20, :20][np.isfinite(values[:20, :20])]
+    assert rows['a']['count'] == a.size == 399
+    assert np.isclose(rows['a']['mean'], a.mean())
+    assert np.isclose(rows['a']['std'], a.std())
+    assert rows['a']['min'] == a.min() and rows['a']['max'] == a.max()
+    # exact percentiles of small zones
+    assert np.isclose(rows['a']['median'], np.median(a))
+    assert np.isclose(rows['b']['p90'], np.percentile(values[:10, 50:60], 90))
+    assert rows['b']['product'] == 'S2A_1'
+
+    to_csv(list(rows.values()), str(tmpdir.join('zonal.csv')))
+    assert tmpdir.join('zonal.csv').readlines()[0].strip() == \
+        'zone,index,count,mean,std,min,max,p10,median,p90,product'
+    to_json(list(rows.values()), str(tmpdir.join('zonal.json')))
+
+
+def test_zonal_statistics_of_raster(tmpdir):
+    filename = str(tmpdir.join('ndvi.tif'))
+    with rasterio.open(filename, 'w', driver='GTiff', count=1, dtype='float32', **PROFILE) as dst:
+        dst.write(np.full((1, 100, 100), 0.5, dtype=np.float32))
+    zonal = ZonalStatistics([square(600000, 5000040, 100, 'a')], ['NDVI', 'BAI'], crs='EPSG:32632')
+    zonal.add_raster('NDVI', filename, window_size=30)
+    zonal.add_raster('BAI', filename, window_size=30)
+    rows = zonal.rows()
+    assert [(row['index'], row['count'], row['median']) for row in rows] == [('NDVI', 100, 0.5), ('BAI', 100, 0.5)]
+
+
+def test_zonal_statistics_histogram():
+    # BAI of a burned area, the histogram bins over (0, 1000) are 5 wide
+    values = np.random.RandomState(0).uniform(100, 120, (100, 100)).astype(np.float32)
+    features = [square(600000, 5000040, 300, 'small'), square(600500, 5000040, 500, 'large')]
+    zonal = ZonalStatistics(features, ['BAI'], crs='EPSG:32632', exact=2000)
+    zonal.start(PROFILE)
+    for row in range(0, 100, 32):
+        zonal.update('BAI', Window(0, row, 100, min(32, 100 - row)), values[row:row + 32])
+    rows = dict((row['zone'], row) for row in zonal.rows())
+    assert (rows['small']['count'], rows['large']['count']) == (900, 2500)
+    percentiles = [[row['p10'], row['median'], row['p90']] for row in (rows['small'], rows['large'])]
+    # the small zone is exact, the large one is estimated within a bin
+    np.testing.assert_allclose(percentiles[0], np.percentile(values[:30, :30], [10, 50, 90]))
+    np.testing.assert_allclose(percentiles[1], np.percentile(values[:50, 50:], [10, 50, 90]), atol=2.5)
+    assert not np.allclose(percentiles[1], np.percentile(values[:50, 50:], [10, 50, 90]))